@@ -0,0 +1,172 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+class PMLBatchPredictor:
+    """ Project Mona Lisa (PML) Batch Predictor class sits in front of
+        the PMLPredictor of a PMLModelManager, that is shared by many
+        request threads. Images submitted concurrently are collected for
+        at most <max_wait_ms> milliseconds, or until <max_batch_size>
+        images are waiting, and are then predicted with a single forward
+        pass. Each caller gets back only the label, or the top-k
+        labels, of its own image, with the version of the model that
+        predicted it. Requests that already hold a batch of images
+        predict it with predict_batch(), in one forward pass. All
+        forward passes hold <self.model_lock>, so the model is never
+        called concurrently.
+    """
+
+    def __init__(self, model_manager, max_batch_size=32, max_wait_ms=5):
+        """
+            Args:
+                model_manager (obj): an object with a get_current()
+                    method that returns (model version, PMLPredictor),
+                    such as PMLModelManager.
+                max_batch_size (int): the largest number of images
+                    predicted in one forward pass. The default is 32.
+                max_wait_ms (float): how long, in milliseconds, the
+                    first image of a batch waits for more images to
+                    arrive. The default is 5.
+        """
+        self.model_manager = model_manager
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.pending = queue.Queue()
+        self.worker = None
+        self.worker_lock = threading.Lock()
+        self.model_lock = threading.Lock()
+
+    def start(self):
+        """ Starts the background thread that runs the batches. This is
+            called by predict(), so it does not have to be called
+            directly.
+
+            Returns:
+                (bool) True if successful.
+        """
+        with self.worker_lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run_batches)
+                self.worker.daemon = True
+                self.worker.start()
+        return True
+
+    def predict(self, img_array):
+        """ Predicts the string label of a single image. Blocks until
+            the batch that contains the image has been predicted.
+
+            Args:
+                img_array (numpy array): image of shape (height, width).
+
+            Returns:
+                (str): the predicted label.
+        """
+        return self.predict_versioned(img_array)[1]
+
+    def predict_versioned(self, img_array):
+        """ Same as predict(), but also returns the version of the model
+            that made the prediction, which can differ from the version
+            in use once the call returns if the model was reloaded.
+
+            Args:
+                img_array (numpy array): image of shape (height, width).
+
+            Returns:
+                (tuple): (model version (str), predicted label (str))
+        """
+        model_version, preds = self.submit(img_array).result()
+        return model_version, preds[0]['label']
+
+    def predict_batch(self, img_arrays, top_k=3):
+        """ Predicts the <top_k> most likely labels of several images
+            with a single forward pass of one model version, without
+            queueing them. The images are not split into batches of
+            <self.max_batch_size>.
+
+            Args:
+                img_arrays (list(numpy array)): images of shape
+                    (height, width), all of the same shape.
+                top_k (int): the number of labels returned per image.
+                    The default is 3.
+
+            Returns:
+                (tuple): (model version (str), list(list(dict))), where
+                    the list holds, for each image in the same order as
+                    <img_arrays>, the labels as returned by
+                    PMLPredictor.predict_batch().
+        """
+        model_version, predictor = self.model_manager.get_current()
+        with self.model_lock:
+            return model_version, predictor.predict_batch(img_arrays, top_k)
+
+    def submit(self, img_array, top_k=1):
+        """ Queues a single image for the next batch.
+
+            Args:
+                img_array (numpy array): image of shape (height, width).
+                top_k (int): the number of labels predicted for the
+                    image. The default is 1.
+
+            Returns:
+                (concurrent.futures.Future): resolves to
+                    (model version, list(dict)), where the list holds
+                    the <top_k> labels as returned by
+                    PMLPredictor.predict_batch(), or to the error raised
+                    by the forward pass.
+        """
+        if top_k < 1:
+            raise ValueError('top_k must be at least 1')
+        self.start()
+        future = Future()
+        self.pending.put((img_array, top_k, future))
+        return future
+
+    def next_batch(self):
+        """ Helper function for run_batches(). Blocks for the first
+            image, then collects more images until the batch is full
+            or <self.max_wait_ms> has passed.
+
+            Returns:
+                list(tuple): (img_array, top_k, future) tuples.
+        """
+        batch = [self.pending.get()]
+        deadline = time.time() + self.max_wait_ms / 1000.
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batches(self):
+        """ Loop of the background thread: predicts one batch at a time
+            and hands each caller its result.
+        """
+        while True:
+            batch = self.next_batch()
+            img_arrays = [img_array for img_array, _, _ in batch]
+            max_top_k = max(top_k for _, top_k, _ in batch)
+            try:
+                # the whole batch is predicted by one model version,
+                # even if a reload swaps the model in the meantime:
+                model_version, predictor = self.model_manager.get_current()
+                with self.model_lock:
+                    preds = predictor.predict_batch(img_arrays, max_top_k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, top_k, future), img_preds in zip(batch, preds):
+                future.set_result((model_version, img_preds[:top_k]))
@@ -2,15 +2,16 @@
 
 from __future__ import print_function
 import os
-from subprocess import Popen, PIPE
 from shutil import rmtree
 from time import sleep
+import time
 
 import sys
 pml_services_path = 'path/to/this/repo/TODO'
 sys.path.insert(0, pml_services_path)
-from pml_database import PMLDatabase
+from pml_database import PMLDatabase, CREATED_INDEX_NAME
 from pml_storage import PMLStorage
+from pml_reconciler import PMLReconciler
 from pml_image_processor import PMLImageProcessor
 from pml_image import PMLImage
 
@@ -50,12 +51,33 @@ class PMLData:
         # complete:
         self.save_dir_imgs = '%s/imgs' % (self.data_dir)
         self.save_path_labels = '%s/labels.json' % (self.data_dir)
+        # high-water mark of the incremental download:
+        self.save_path_sync_state = '%s/sync_state.json' % (self.data_dir)
+        # diff reports of the reconciliation of the database and
+        # storage:
+        self.save_dir_reconcile = '%s/reconcile' % (self.data_dir)
 
         # parameters to be updated by the PML system admins:
         self.db_collect_name = 'TODO'
         self.db_prompt_name = 'TODO'
         self.storage_collect_name = 'TODO'
         self.storage_prompt_name = 'TODO'
+        # counts of the collect database, updated when the garbage
+        # collection deletes items:
+        self.db_counts_name = 'TODO'
+        # storage of the shards written by PMLShardCompactor:
+        self.storage_shards_name = 'TODO'
+        # global secondary index of the collect database on
+        # created_day/created_at, needed by the incremental download.
+        # Create it once with PMLDatabase.create_created_index(), e.g.
+        # by running pml_database.py:
+        self.db_collect_created_index = CREATED_INDEX_NAME
+        # items written up to this many milliseconds after they were
+        # created (e.g. by the ingestion queue) are still picked up by
+        # the next incremental download:
+        self.sync_overlap_ms = 10 * 60 * 1000
+        # number of threads downloading the images:
+        self.download_max_workers = 16
 
     def setup_dirs(self):
         """ Helper function for download_train_data(). Creates all of
@@ -74,14 +96,27 @@ class PMLData:
 
         for directory in dirs:
             if not os.path.exists(directory):
-                # make the directory
-                # TODO: try to use python instead of bash commands.
-                Popen(['mkdir', directory])
+                os.makedirs(directory)
 
         return True
 
-    def download_train_data(self):
-        """ Downloads the training images in <self.save_dir_original>
+    def download_train_data(self, incremental=False, use_shards=False):
+        """ Downloads the training images in <self.save_dir_original>,
+            and then greys, crops and resizes them into
+            <self.save_dir_imgs>.
+
+            Args:
+                incremental (bool): if True, only the items created
+                    since the last download are downloaded, and their
+                    labels are added to labels.json. The first
+                    incremental download, when there is no high-water
+                    mark yet, downloads everything. It needs the index
+                    <self.db_collect_created_index>. The default is
+                    False.
+                use_shards (bool): if True, the images packed by
+                    PMLShardCompactor are streamed from the shards first,
+                    and only the images that are not in a shard yet are
+                    downloaded one by one. The default is False.
 
             Returns:
                 bool: True if the images were sucessfully downloaded,
@@ -90,57 +125,83 @@ class PMLData:
         print('downloading training images . . .')
         self.setup_dirs()
 
-        # get the filenames of all images from the database.
-        filenames, labels = PMLDatabase(
-            self.db_collect_name,
-            self.mode)\
-            .get_all_items()
+        db_collect = PMLDatabase(self.db_collect_name, self.mode)
+        sync_state = {'created_at': None, 'shards': []}
+        if incremental:
+            # without the index, every incremental download would scan,
+            # and pay for, the whole table
+            if self.db_collect_created_index is None or \
+                    not db_collect.has_index(self.db_collect_created_index):
+                raise ValueError(
+                    'The incremental download needs the index %s of %s: '
+                    'create it with PMLDatabase.create_created_index()' % (
+                        self.db_collect_created_index,
+                        self.db_collect_name))
+            sync_state.update(self.load_sync_state())
+        last_created_at = sync_state['created_at']
 
-        # put the labels in the filenames
-        new_filenames = []
-        new_labels = []
-        # skip_labels = ['kiwi', 'questionmark', 'iphone', 'wifi']
-        for i_fn in range(len(filenames)):
-            ###################################
-            # if labels[i_fn] in skip_labels:
-                # continue
-            ###################################
-            new_filenames.append(filenames[i_fn])
-            new_labels.append(labels[i_fn])
-
-        filenames = new_filenames
-        labels = new_labels
-
-        # save the labels in a json file:
         labels_dict = {}
-        for i in range(len(filenames)):
-            labels_dict[filenames[i].split('.')[0]] = labels[i]
-        with open(self.save_path_labels, 'w') as fp:
-            json.dump(labels_dict, fp)
+        if last_created_at is not None:
+            labels_dict = self.load_labels()
+        shards = sync_state['shards']
+        if use_shards:
+            shards = self.download_shards(labels_dict, shards)
+
+        if last_created_at is None:
+            # get the id, label and creation time of all images from
+            # the database.
+            items = db_collect.export_items(
+                ProjectionExpression='id, label, created_at')
+        else:
+            # only the items created since the last download.
+            items = db_collect.get_items_since(
+                last_created_at - self.sync_overlap_ms,
+                index_name=self.db_collect_created_index)
+
+        # put the labels in the filenames
+        filenames = []
+        max_created_at = last_created_at
+        for item in items:
+            created_at = item.get('created_at')
+            if created_at is not None and (
+                    max_created_at is None or created_at > max_created_at):
+                max_created_at = int(created_at)
+            if item['id'] in labels_dict:
+                # downloaded from a shard, or by an earlier incremental
+                # download
+                continue
+            labels_dict[item['id']] = item['label']
+            filenames.append('%s.png' % (item['id']))
+        print('%d new images' % (len(filenames)))
 
         # download the image data and store it in
         # self.save_dir_original
         is_downloaded = PMLStorage(self.storage_collect_name)\
-            .download_imgs(filenames, self.save_dir_original)
+            .download_imgs(filenames, self.save_dir_original,
+                           max_workers=self.download_max_workers)
+        if not is_downloaded:
+            # the images that were downloaded are kept in
+            # <self.save_dir_original> and skipped by the next download.
+            return False
 
         print('to grey, crop, resize . . .')
         # grey, crop, and resize images:
         # resize from 3 color channels and saturation
         #  to only one saturation value from 0 to 255
         img_proc = PMLImageProcessor(
-            data.save_dir_original,
-            data.save_dir_greyed)
+            self.save_dir_original,
+            self.save_dir_greyed)
         img_proc.grey_imgs()
         # crop into a square shape
         img_proc = PMLImageProcessor(
-            data.save_dir_greyed,
-            data.save_dir_cropped)
+            self.save_dir_greyed,
+            self.save_dir_cropped)
         img_proc.crop_imgs()
         # resize the square to resize_dim x resize_dim
         #   as specified in PMLImageProcessor
         img_proc = PMLImageProcessor(
-            data.save_dir_cropped,
-            data.save_dir_imgs)
+            self.save_dir_cropped,
+            self.save_dir_imgs)
         img_proc.resize_imgs()
 
         # the resized_imgs directory is the final
@@ -154,6 +215,91 @@ class PMLData:
         for path in remove_dirs:
             rmtree(path)
 
+        # the labels and the high-water mark are only saved once the
+        # images are in <self.save_dir_imgs>, so an interrupted download
+        # is repeated by the next one.
+        self.save_json(labels_dict, self.save_path_labels)
+        self.save_json({'created_at': max_created_at, 'shards': shards},
+                       self.save_path_sync_state)
+        return True
+
+    def download_shards(self, labels_dict, done_shards=()):
+        """ Helper function for download_train_data(). Streams the
+            shards written by PMLShardCompactor, one request per shard,
+            and writes the images that are not in <labels_dict> yet to
+            <self.save_dir_original>.
+
+            Args:
+                labels_dict (dict): the labels of the downloaded images,
+                    by id. The labels of the images in the shards are
+                    added to it.
+                done_shards (list(str)): ids of the shards that were
+                    downloaded before, and are skipped.
+
+            Returns:
+                list(str): the ids of all downloaded shards, including
+                    <done_shards>.
+        """
+        storage_shards = PMLStorage(self.storage_shards_name)
+        shards = storage_shards.get_shard_manifest()['shards']
+        done_shards = list(done_shards)
+        start_time = time.time()
+        n_bytes = 0
+        n_imgs = 0
+        for shard in shards:
+            if shard['shard'] in done_shards:
+                continue
+            for entry, data in storage_shards.iter_shard(shard):
+                n_bytes += len(data)
+                if entry['id'] in labels_dict:
+                    continue
+                save_path = '%s/%s.png' % (
+                    self.save_dir_original, entry['id'])
+                with open(save_path, 'wb') as img_file:
+                    img_file.write(data)
+                labels_dict[entry['id']] = entry['label']
+                n_imgs += 1
+            done_shards.append(shard['shard'])
+
+        seconds = max(time.time() - start_time, 1e-9)
+        print('%d images (%.1f MB) from shards in %.1f s: %.2f MB/s' % (
+            n_imgs, n_bytes / 1e6, seconds, n_bytes / 1e6 / seconds))
+        return done_shards
+
+    def load_labels(self):
+        """
+            Returns:
+                (dict): labels.json, mapping the id of each downloaded
+                    image to its label, or an empty dict if nothing
+                    was downloaded yet.
+        """
+        if not os.path.isfile(self.save_path_labels):
+            return {}
+        with open(self.save_path_labels) as json_data:
+            return json.load(json_data)
+
+    def load_sync_state(self):
+        """
+            Returns:
+                (dict): the state of the incremental download,
+                    formatted like:
+                    {"created_at": <creation time in milliseconds of
+                        the newest downloaded item, or None>,
+                     "shards": [<ids of the downloaded shards>]}
+        """
+        if not os.path.isfile(self.save_path_sync_state):
+            return {'created_at': None, 'shards': []}
+        with open(self.save_path_sync_state) as json_data:
+            return json.load(json_data)
+
+    def save_json(self, obj, path):
+        """ Helper function. Saves <obj> as json at <path>, writing a
+            temporary file first so <path> is never left half written.
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(obj, fp)
+        os.rename(tmp_path, path)
         return True
 
     def load_data(self):
@@ -201,42 +347,115 @@ class PMLData:
 
         return (x_train, y_train), (x_test, y_test)
 
-    def sync_collect_db_and_storage(self):
-        """ This method currently returns how many items are out of
-            sync from the database and storage respectively, in a
-            print statement.
+    def get_reconciler(self, min_age_seconds=3600):
+        """ Helper function. Gets the PMLReconciler of the collect
+            database and storage, writing its diff reports in
+            <self.save_dir_reconcile>.
 
-            Method to syncronize the meta-data in the database and
-            the images in the storage. If an item is in the database
-            but the cooresponding item is not in the storage,
-            then that item is removed from the database. Likewise,
-            if an item is in the storage but the cooresponding item is
-            not in the database, then that item is removed from the storage.
+            Args:
+                min_age_seconds (float): items younger than this are
+                    never orphans, as they may still be in the middle of
+                    being written to both. The default is 3600.
 
             Returns:
-                bool: True if successful, otherwise an error is thrown.
+                (PMLReconciler)
         """
-        db_collect = PMLDatabase(self.db_collect_name)
-        db_filenames = db_collect.get_all_items()[0]
+        return PMLReconciler(
+            self.db_collect_name,
+            self.storage_collect_name,
+            self.save_dir_reconcile,
+            min_age_seconds=min_age_seconds,
+            shards_storage_name=self.storage_shards_name,
+            counts_db_name=self.db_counts_name)
 
-        storage_collect = PMLStorage(self.storage_collect_name)
-        storage_filenames = storage_collect.get_all_filenames()
+    def get_collect_diff(self, min_age_seconds=3600):
+        """ Reconciles the collect database and the collect storage.
 
-        # get filenames that are in the db but not in storage
-        db_extras = [fn for fn in db_filenames if fn not in storage_filenames]
-        db_key = 'id'
-        # strip off the ".png" at the end of the filenames
-        ids = [value[:-4] for value in db_extras]
-        # db_collect.remove_items(db_key, db_extras)
+            Args:
+                min_age_seconds (float): see get_reconciler().
 
-        # get filenames that are in storage but not in the db
-        storage_extras = [fn for fn in storage_filenames if fn not in db_filenames]
-        # storage_collect.remove_items(storage_extras)
+            Returns:
+                (tuple): (ids of the items in the database without an
+                    image in storage (list(str)), filenames of the
+                    images in storage without an item in the database
+                    (list(str)))
+        """
+        reconciler = self.get_reconciler(min_age_seconds)
+        report_path = reconciler.reconcile()['report_path']
+        db_extras = [entry['id'] for entry in
+                     reconciler.iter_report(report_path, 'db')]
+        storage_extras = ['%s.png' % (entry['id']) for entry in
+                          reconciler.iter_report(report_path, 'storage')]
+        return db_extras, storage_extras
+
+    def sync_collect_db_and_storage(self, repair=False,
+                                    min_age_seconds=3600):
+        """ Method to syncronize the meta-data in the database and
+            the images in the storage, with a streaming reconciliation
+            that writes the items out of sync to a diff report in
+            <self.save_dir_reconcile>.
+
+            With <repair>, if an item is in the database but the
+            cooresponding image is not in the storage, then the image
+            is restored from the shards, or, if it is not in a shard,
+            that item is removed from the database. Likewise, if an
+            item is in the storage but the cooresponding item is not in
+            the database, then that item is removed from the storage.
 
-        print('length of db extras = %d' % (len(db_extras)))
-        print('length of storage extras = %d' % (len(storage_extras)))
+            Args:
+                repair (bool): if True, the report is applied. The
+                    default is False, in which case only the number of
+                    items out of sync is printed.
+                min_age_seconds (float): see get_reconciler().
 
-        return True
+            Returns:
+                (dict): the summary of PMLReconciler.reconcile().
+        """
+        reconciler = self.get_reconciler(min_age_seconds)
+        summary = reconciler.reconcile()
+
+        print('length of db extras = %d' % (summary['db_only']))
+        print('length of storage extras = %d' % (summary['storage_only']))
+
+        if repair:
+            reconciler.repair(summary['report_path'])
+        return summary
+
+    def gc_collect_db_and_storage(self, dry_run=True, min_age_seconds=3600):
+        """ Garbage collection of the collect database and storage. If
+            an item is in the database but the cooresponding image is
+            not in the storage, then that item is removed from the
+            database. Likewise, if an image is in the storage but the
+            cooresponding item is not in the database, then that image
+            is removed from the storage.
+
+            Args:
+                dry_run (bool): if True, the orphans are only printed.
+                    The default is True.
+                min_age_seconds (float): see get_reconciler().
+
+            Returns:
+                (dict): the outcome of each deleted key, formatted like:
+                {
+                    "db": <outcome of PMLDatabase.delete_items()>,
+                    "storage": <outcome of PMLStorage.delete_items()>
+                }
+        """
+        reconciler = self.get_reconciler(min_age_seconds)
+        report_path = reconciler.reconcile()['report_path']
+        if dry_run:
+            for entry in reconciler.iter_report(report_path):
+                print('%s: %s' % (entry['side'], entry['id']))
+            return {
+                'db': {'deleted': [], 'errors': {}},
+                'storage': {'deleted': [], 'errors': {}},
+            }
+
+        outcome = reconciler.repair(report_path, restore=False)
+        for tier in ('db', 'storage'):
+            for key, error in sorted(outcome[tier]['errors'].items()):
+                print('%s: failed to delete %s: %s' % (tier, key, error))
+        return {'db': outcome['db'], 'storage': outcome['storage']}
 
 if __name__ == '__main__':
     data_dir = 'TODO'
@@ -251,5 +470,6 @@ if __name__ == '__main__':
     # need to activate virtual env from pml-services
     ###
 
-    # data.sync_collect_db_and_storage()
-    data.download_train_data()
+    # data.sync_collect_db_and_storage(repair=True)
+    # data.gc_collect_db_and_storage(dry_run=False)
+    data.download_train_data(incremental=True, use_shards=True)
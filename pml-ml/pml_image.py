@@ -2,6 +2,8 @@
 
 from __future__ import print_function
 
+from io import BytesIO
+
 import numpy as np
 from scipy import misc
 
@@ -13,11 +15,12 @@ class PMLImage:
         the processed image in the destination directory path.
     """
 
-    def __init__(self, source_path, destination_path):
+    def __init__(self, source_path=None, destination_path=None):
         """
             Args:
                 source_path (str): the source path where the image to be
-                    processed is stored.
+                    processed is stored. Not needed when only the
+                    in-memory process_img_data_for_predict() is used.
                 destination_dir (str): the destination path where the
                     image to be processed will be stored after any given
                     PMLImage process is taken effect.
@@ -44,6 +47,84 @@ class PMLImage:
         resized_img = self.resize_img()
         return True
 
+    def process_img_data_for_predict(self, img_data):
+        """ In-memory equivalent of process_img_for_predict() followed
+            by img_obj_to_array(). The image is greyed, cropped and
+            resized without touching the disk, so no temporary file is
+            shared between requests and the png is only decoded once.
+
+            Args:
+                img_data (bytes or numpy array): the encoded png image
+                    data, or the already decoded image as a numpy array
+                    of shape (height, width, 4) or (height, width).
+
+            Returns:
+                (numpy array): the processed image of shape
+                (<self.resize_dim>, <self.resize_dim>).
+        """
+        if isinstance(img_data, np.ndarray):
+            img = img_data
+        else:
+            img = misc.imread(BytesIO(img_data))
+
+        # a 2D array is treated as an image that is already greyed.
+        if img.ndim == 3:
+            img = self.grey_array(img)
+        img = self.crop_array(img)
+        return self.resize_array(img)
+
+    def grey_array(self, img):
+        """ Gets the saturation value of an RGBA image array as a
+            2D grey-scale array.
+
+            Args:
+                img (numpy array): image of shape (height, width, 4).
+
+            Returns:
+                (numpy array): uint8 array of shape (height, width).
+        """
+        # just get the saturation value in the third index of the
+        # third dimension, and then create a 2 dimensional numpy array.
+        greyed_img = np.clip(img[:, :, 3], 0, 255)
+        return greyed_img.astype(np.uint8)
+
+    def crop_array(self, img):
+        """ Crops a 2D image array into a centered square, where the
+            new sides of the square is the side of the shortest side
+            in the original image.
+
+            Args:
+                img (numpy array): image of shape (height, width).
+
+            Returns:
+                (numpy array): a view of <img> cropped to a square.
+        """
+        lx, ly = img.shape
+        # the shortest side:
+        coord_min = min(lx, ly)
+
+        # cropping the images into a centered square, and the cropped
+        # image will have side length of the shortest side (coord_min)
+        crop_x = (lx - coord_min) // 2
+        crop_y = (ly - coord_min) // 2
+
+        return img[crop_x: crop_x + coord_min,
+                   crop_y: crop_y + coord_min]
+
+    def resize_array(self, img):
+        """ Resizes a 2D image array into a square shape of
+            <self.resize_dim> by <self.resize_dim>.
+
+            Args:
+                img (numpy array): square image of shape (side, side).
+
+            Returns:
+                (numpy array): uint8 array of shape
+                (<self.resize_dim>, <self.resize_dim>).
+        """
+        size = (self.resize_dim, self.resize_dim)
+        return misc.imresize(img, size)
+
     def img_obj_to_array(self):
         """
             Returns: the saved image in the source directory as a numpy
@@ -62,12 +143,7 @@ class PMLImage:
         """
         # read the image as a numpy array
         img = misc.imread(self.source_path)
-        lx, ly, _ = img.shape
-        identity = np.identity(ly)
-
-        # just get the saturation value in the third index of the
-        # third dimension, and then create a 2 dimensional numpy array.
-        greyed_img = np.dot(img[:, :, 3], identity)
+        greyed_img = self.grey_array(img)
 
         # save the numpy array as a grey-scale png image.
         misc.toimage(greyed_img, cmin=0.0, cmax=255.0)\
@@ -84,22 +160,7 @@ class PMLImage:
                 thrown.
         """
         img = misc.imread(self.source_path)
-        lx, ly = img.shape
-        # the shortest side:
-        coord_min = min(lx, ly)
-
-        # cropping the images into a centered square, and the cropped
-        # image will have side length of the shortest side (coord_min)
-        crop_x = (lx - coord_min) / 2
-        crop_y = (ly - coord_min) / 2
-
-        new_x_coord_start = crop_x
-        new_x_coord_end = crop_x + coord_min
-        new_y_coord_start = crop_y
-        new_y_coord_end = crop_y + coord_min
-
-        crop_img = img[new_x_coord_start: new_x_coord_end,
-                       new_y_coord_start: new_y_coord_end]
+        crop_img = self.crop_array(img)
 
         # save the array as an image
         misc.imsave(self.destination_path, crop_img)
@@ -115,8 +176,7 @@ class PMLImage:
                 thrown.
         """
         img = misc.imread(self.source_path)
-        size = (self.resize_dim, self.resize_dim)
-        resized_img = misc.imresize(img, size)
+        resized_img = self.resize_array(img)
         misc.imsave(self.destination_path, resized_img)
         return True
 
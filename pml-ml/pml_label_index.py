@@ -0,0 +1,87 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import json
+
+
+class PMLLabelIndex:
+    """ Project Mona Lisa (PML) Label Index class maps the string
+        labels of the training images to the integers that the deep
+        learning model predicts, and back. The labels are sorted, so
+        the integer of a label is its position in the sorted list.
+    """
+
+    def __init__(self, labels):
+        """
+            Args:
+                labels (list(str)): the labels, where the position of
+                    each label is its integer label.
+        """
+        # int to label lookup is a plain list index:
+        self.int_to_label = list(labels)
+        self.label_to_int = dict(
+            (label, i_label)
+            for i_label, label in enumerate(self.int_to_label))
+
+    @classmethod
+    def from_labels(cls, y_array):
+        """ Creates the label index from all of the labels of the
+            training data.
+
+            Args:
+                y_array (iterable(str)): the label of every training
+                    image. Labels can occur more than once.
+
+            Returns:
+                (PMLLabelIndex)
+        """
+        return cls(sorted(set(y_array)))
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a label index saved with save().
+
+            Args:
+                path (str): path of the json file mapping the string
+                    labels to ints.
+
+            Returns:
+                (PMLLabelIndex)
+        """
+        with open(path) as json_data:
+            label_to_int_dict = json.load(json_data)
+        labels = sorted(label_to_int_dict, key=label_to_int_dict.get)
+        return cls(labels)
+
+    def save(self, path):
+        """ Saves the label index as a json file mapping the string
+            labels to ints, for example:
+            {"arrow": 0, "circle": 1, ...}
+
+            Args:
+                path (str): path of the json file.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        with open(path, 'w') as json_file:
+            json.dump(self.label_to_int, json_file, sort_keys=True)
+        return True
+
+    def __len__(self):
+        return len(self.int_to_label)
+
+    def to_int(self, label):
+        """
+            Returns:
+                (int): the integer label of the string label <label>.
+        """
+        return self.label_to_int[label]
+
+    def to_label(self, pred_int):
+        """
+            Returns:
+                (str): the string label of the integer label <pred_int>.
+        """
+        return self.int_to_label[int(pred_int)]
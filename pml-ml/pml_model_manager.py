@@ -0,0 +1,274 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import threading
+import time
+
+import numpy as np
+from pml_net import PMLNet
+from pml_predictor import PMLPredictor
+
+
+class PMLModelManager:
+    """ Project Mona Lisa (PML) Model Manager class owns the startup
+        lifecycle of the model used by the web services. The model is
+        loaded in a background thread, or on first use, and a synthetic
+        warm-up prediction is run before the manager reports that it is
+        ready, so the first real request does not pay for building the
+        graph.
+
+        When a new version is published to the PMLModelRegistry, the
+        manager can reload: the new model is loaded and warmed up in the
+        background while the old one keeps serving, and then both the
+        model and its label index are swapped in at once. A manager whose
+        model failed to load, e.g. because no model was published yet,
+        tries again on use and when the registry is checked.
+    """
+
+    def __init__(self, data_dir, warm_up=True, engine='keras',
+                 retry_interval=10):
+        """
+            Args:
+                data_dir (str): absolute path of the directory where
+                    the model and the label index are saved.
+                warm_up (bool): if True, a prediction on a blank image
+                    is run after loading. The default is True.
+                engine (str): the inference engine, as accepted by
+                    PMLNet.load_model(). The default is 'keras'.
+                retry_interval (float): the number of seconds after a
+                    failed load before start() loads again. The default
+                    is 10.
+        """
+        self.data_dir = data_dir
+        self.warm_up = warm_up
+        self.engine = engine
+        self.retry_interval = retry_interval
+        # (model version, PMLPredictor), set once the model is ready:
+        self.current = None
+        self.load_error = None
+        self.load_failed_at = None
+        self.ready_event = threading.Event()
+        self.load_lock = threading.Lock()
+        self.loader = None
+        self.reload_lock = threading.Lock()
+        self.watcher = None
+
+        # startup metrics, in seconds:
+        self.created_at = time.time()
+        self.metrics = {
+            'load_seconds': None,
+            'warm_up_seconds': None,
+            'cold_start_seconds': None,
+            'reloads': 0,
+        }
+
+    def start(self):
+        """ Starts loading the model in a background thread, if it is
+            not already loading or loaded. After a failed load, it loads
+            again once <self.retry_interval> seconds have passed.
+
+            Returns:
+                (bool) True if successful.
+        """
+        with self.load_lock:
+            if self.loader is None or self.should_retry():
+                # get_current() waits for this load
+                self.ready_event.clear()
+                self.loader = threading.Thread(target=self.load)
+                self.loader.daemon = True
+                self.loader.start()
+        return True
+
+    def load(self):
+        """ Loads the model and label index, runs the warm-up prediction
+            and marks the manager as ready. Any error is kept and raised
+            again by get_current().
+
+            Returns:
+                (bool) True if successful, otherwise False.
+        """
+        # a reload by the watcher does not load at the same time:
+        self.reload_lock.acquire()
+        try:
+            if self.current is None:
+                self.current = self.load_current_model()
+                self.metrics['cold_start_seconds'] = \
+                    time.time() - self.created_at
+                print('model %s ready after a cold start of %.2f seconds'
+                      % (self.current[0],
+                         self.metrics['cold_start_seconds']))
+            self.load_error = None
+            return True
+        except Exception as e:
+            self.load_error = e
+            self.load_failed_at = time.time()
+            print('model failed to load: %s' % (str(e)))
+            return False
+        finally:
+            self.reload_lock.release()
+            self.ready_event.set()
+
+    def should_retry(self):
+        """ Helper function for start().
+
+            Returns:
+                (bool): True if the last load failed, is finished, and
+                    failed at least <self.retry_interval> seconds ago.
+        """
+        return self.current is None and \
+            self.load_failed_at is not None and \
+            not self.loader.is_alive() and \
+            time.time() - self.load_failed_at >= self.retry_interval
+
+    def load_current_model(self):
+        """ Helper function. Loads and warms up the model in use, as
+            returned by PMLNet.get_current_model().
+
+            Returns:
+                (tuple): (model version (str), PMLPredictor)
+        """
+        start_time = time.time()
+        net = PMLNet(self.data_dir)
+        model_dir, model_version = net.get_current_model()
+        predictor = PMLPredictor(
+            self.data_dir,
+            net.load_model(model_dir, self.engine),
+            net.load_label_index(model_dir))
+        self.metrics['load_seconds'] = time.time() - start_time
+
+        if self.warm_up:
+            start_time = time.time()
+            self.warm_up_predictor(predictor)
+            self.metrics['warm_up_seconds'] = time.time() - start_time
+        return model_version, predictor
+
+    def reload(self):
+        """ Loads the model in use if it is not the model being served,
+            and then swaps it in. The model being served keeps serving
+            until the new model is warmed up. Does nothing if a reload
+            is already running.
+
+            Returns:
+                (bool): True if a new model was swapped in, otherwise
+                    False.
+        """
+        if not self.reload_lock.acquire(False):
+            return False
+        try:
+            _, model_version = PMLNet(self.data_dir).get_current_model()
+            if self.current is not None and \
+                    self.current[0] == model_version:
+                return False
+            # one assignment swaps the model and label index together:
+            self.current = self.load_current_model()
+            self.load_error = None
+            self.ready_event.set()
+            self.metrics['reloads'] += 1
+            print('model %s swapped in' % (self.current[0]))
+            return True
+        except Exception as e:
+            print('model failed to reload: %s' % (str(e)))
+            return False
+        finally:
+            self.reload_lock.release()
+
+    def reload_in_background(self):
+        """ Runs reload() in a background thread.
+
+            Returns:
+                (bool) True if successful.
+        """
+        reloader = threading.Thread(target=self.reload)
+        reloader.daemon = True
+        reloader.start()
+        return True
+
+    def watch(self, interval=30):
+        """ Starts a background thread that checks the model registry
+            every <interval> seconds and reloads when a new version is
+            published, or loads the model if no model could be loaded
+            yet.
+
+            Args:
+                interval (float): seconds between checks. The default
+                    is 30.
+
+            Returns:
+                (bool) True if successful.
+        """
+        def watch_registry():
+            while True:
+                time.sleep(interval)
+                # reload() does nothing while the first load is running
+                self.reload()
+
+        with self.load_lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=watch_registry)
+                self.watcher.daemon = True
+                self.watcher.start()
+        return True
+
+    def warm_up_predictor(self, predictor):
+        """ Runs a prediction on a blank image, so the graph and the
+            predict function are built before real requests arrive.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        input_shape = predictor.get_input_shape()
+        blank_img = np.zeros(input_shape[:2], dtype=np.uint8)
+        predictor.predict_arrays([blank_img])
+        return True
+
+    def is_ready(self):
+        """
+            Returns:
+                (bool): True if the model is loaded and warmed up.
+        """
+        return self.current is not None
+
+    def get_current(self, timeout=None):
+        """ Gets the model version and predictor in use, starting the
+            load if it was not started yet, and waiting for it to finish.
+
+            Args:
+                timeout (float): the number of seconds to wait for the
+                    model. The default is None, which waits until the
+                    model is loaded.
+
+            Returns:
+                (tuple): (model version (str), PMLPredictor)
+        """
+        self.start()
+        if not self.ready_event.wait(timeout):
+            raise RuntimeError('The model is still loading')
+        if self.current is None:
+            raise RuntimeError(
+                'The model failed to load: %s' % (str(self.load_error)))
+        return self.current
+
+    def predict_arrays(self, img_arrays):
+        """ PMLPredictor.predict_arrays() with the predictor in use.
+        """
+        _, predictor = self.get_current()
+        return predictor.predict_arrays(img_arrays)
+
+    def status(self):
+        """
+            Returns:
+                (dict): the readiness, model version and startup
+                    metrics of the manager.
+        """
+        status = {
+            'ready': self.is_ready(),
+            'model_version': None,
+            'error': None,
+        }
+        if self.current is not None:
+            status['model_version'] = self.current[0]
+        if self.load_error is not None:
+            status['error'] = str(self.load_error)
+        status.update(self.metrics)
+        return status
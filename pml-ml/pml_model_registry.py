@@ -0,0 +1,127 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import json
+import os
+import time
+
+
+class PMLModelRegistry:
+    """ Project Mona Lisa (PML) Model Registry class keeps every saved
+        model in its own version directory, and records which version
+        is in use. The layout in the data directory is:
+
+            <data_dir>/models/registry.json
+            <data_dir>/models/<version>/model.json
+            <data_dir>/models/<version>/model.h5
+            <data_dir>/models/<version>/labels_to_ints.json
+
+        A version is only used after it is published, so a model can be
+        written completely before the web services pick it up.
+    """
+
+    def __init__(self, data_dir):
+        """
+            Args:
+                data_dir (str): absolute path of the directory where
+                    all of the downloaded data will be stored.
+        """
+        self.models_dir = '%s/models' % (data_dir)
+        self.registry_path = '%s/registry.json' % (self.models_dir)
+
+    def exists(self):
+        """
+            Returns:
+                (bool): True if a version was published to the registry.
+        """
+        return os.path.isfile(self.registry_path)
+
+    def load_registry(self):
+        """ Helper function. Loads the registry json file.
+
+            Returns:
+                (dict): formatted like:
+                {
+                    "current": "<version>",
+                    "versions": [
+                        {"version": "<version>", "created_at": <time>},
+                    ]
+                }
+        """
+        if not self.exists():
+            return {'current': None, 'versions': []}
+        with open(self.registry_path) as json_data:
+            return json.load(json_data)
+
+    def save_registry(self, registry):
+        """ Helper function. Saves the registry json file atomically, so
+            readers never see a partially written file.
+        """
+        tmp_path = '%s.%d.tmp' % (self.registry_path, os.getpid())
+        with open(tmp_path, 'w') as json_file:
+            json.dump(registry, json_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.registry_path)
+        return True
+
+    def create_version(self):
+        """ Creates the directory of a new, unpublished version, named
+            after the current time.
+
+            Returns:
+                (tuple): (version (str), directory of the version (str))
+        """
+        version = time.strftime('%Y%m%d-%H%M%S')
+        version_dir = self.get_version_dir(version)
+        i_suffix = 1
+        while os.path.exists(version_dir):
+            version = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), i_suffix)
+            version_dir = self.get_version_dir(version)
+            i_suffix += 1
+        os.makedirs(version_dir)
+        return version, version_dir
+
+    def publish(self, version):
+        """ Makes <version> the version in use. Web services watching the
+            registry will load it and swap it in.
+
+            Args:
+                version (str): a version created by create_version().
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        if not os.path.isdir(self.get_version_dir(version)):
+            raise ValueError('The model version: %s does not exist'
+                             % (version))
+        registry = self.load_registry()
+        versions = [v['version'] for v in registry['versions']]
+        if version not in versions:
+            registry['versions'].append(
+                {'version': version, 'created_at': time.time()})
+        registry['current'] = version
+        self.save_registry(registry)
+        print('published model version %s' % (version))
+        return True
+
+    def get_current_version(self):
+        """
+            Returns:
+                (str): the published version, or None if no version
+                    was published.
+        """
+        return self.load_registry()['current']
+
+    def get_versions(self):
+        """
+            Returns:
+                list(str): all published versions, oldest first.
+        """
+        return [v['version'] for v in self.load_registry()['versions']]
+
+    def get_version_dir(self, version):
+        """
+            Returns:
+                (str): the directory of the model files of <version>.
+        """
+        return '%s/%s' % (self.models_dir, version)
@@ -2,17 +2,14 @@
 
 from __future__ import print_function
 
-import keras
-from keras.models import Sequential
-from keras.models import model_from_json
-from keras.layers import Conv2D, MaxPooling2D, Activation
-from keras.layers import Dropout, Flatten, Dense
-from keras.layers import Conv2D, MaxPooling2D
-from keras.layers.normalization import BatchNormalization
+# keras is imported inside the methods that use it, so importing
+# PMLNet (e.g. in the web services) does not initialize the backend.
 
 from pml_data import PMLData
+from pml_label_index import PMLLabelIndex
+from pml_model_registry import PMLModelRegistry
 import numpy as np
-import json
+import os
 
 
 class PMLNet:
@@ -34,6 +31,11 @@ class PMLNet:
         self.data_dir = data_dir
         self.model_json_fn = 'model.json'
         self.model_weights_fn = 'model.h5'
+        # written by PMLQuantizer:
+        self.model_int8_fn = 'model_int8.npz'
+        self.labels_fn = 'labels_to_ints.json'
+        # loaded once by get_label_index():
+        self.label_index = None
 
     def load_data(self):
         """ Uses PMLData's load_data() method to load data from the
@@ -60,8 +62,10 @@ class PMLNet:
         x_test = x_test.reshape(
             x_test.shape[0], x_test.shape[1], x_test.shape[2], 1)
 
-        y_train = self.labels_to_ints(y_train)
-        y_test = self.labels_to_ints(y_test)
+        # convert the train and test labels together, so both use
+        # the same mapping from labels to ints:
+        y_ints = self.labels_to_ints(np.concatenate((y_train, y_test)))
+        y_train, y_test = y_ints[:len(y_train)], y_ints[len(y_train):]
 
         x_train = x_train.astype('float32')
         x_test = x_test.astype('float32')
@@ -69,8 +73,9 @@ class PMLNet:
         x_train /= 255.
         x_test /= 255.
 
-        n_classes = len(set(y_train))
+        n_classes = len(self.label_index)
 
+        import keras
         y_train = keras.utils.to_categorical(y_train, n_classes)
         y_test = keras.utils.to_categorical(y_test, n_classes)
 
@@ -89,6 +94,7 @@ class PMLNet:
     def conv_section(self, model, kernel_size, n_filters, input_shape=None, max_pool=True):
         """
         """
+        from keras.layers import Conv2D, MaxPooling2D, Activation
         if input_shape == None:
             model.add(Conv2D(n_filters, kernel_size))
         else:
@@ -102,6 +108,8 @@ class PMLNet:
     def create_model(self):
         """
         """
+        from keras.models import Sequential
+        from keras.layers import Activation, Dropout, Flatten, Dense
         input_shape = self.get_input_shape()
         n_classes = self.get_n_classes()
         model = Sequential()
@@ -126,30 +134,31 @@ class PMLNet:
             and saves the result as a json file, mapping strings
             to integers.
         """
-        y_list = list(set([elem for elem in y_array]))
-        y_list.sort()  # mutates
-
-        # map the string labels to ints
-        label_to_int_dict = {}
-        int_labels = range(len(y_list))
-        for i_label in int_labels:
-            label_to_int_dict[y_list[i_label]] = i_label
+        self.label_index = PMLLabelIndex.from_labels(y_array)
 
         # save the mapping from labels to ints
         # to be used for predicting later:
-        self.save_labels(label_to_int_dict)
+        self.save_labels(self.label_index)
 
         # create the new array with ints instead of strings
-        y_int_array = []
-        for label in y_array:
-            y_int_array.append(label_to_int_dict[label])
+        y_int_array = [self.label_index.to_int(label) for label in y_array]
 
         return np.array(y_int_array)
 
-    def save_model(self, model):
-        """
+    def save_model(self, model, publish=True):
+        """ Saves the model, its weights and the label index as a new
+            version in the model registry.
+
+            Args:
+                model (obj): the Keras model.
+                publish (bool): if True, the new version is published,
+                    so the web services load it. The default is True.
+
+            Returns:
+                (str): the new model version.
         """
-        save_dir_model = self.data_dir
+        registry = PMLModelRegistry(self.data_dir)
+        version, save_dir_model = registry.create_version()
         json_path = '%s/%s' % (save_dir_model, self.model_json_fn)
         weights_path = '%s/%s' % (save_dir_model, self.model_weights_fn)
         # serialize model to JSON
@@ -161,18 +170,65 @@ class PMLNet:
         model.save_weights(weights_path)
         print('saved model and weights to disk at %s and %s' % (
             json_path, weights_path))
-        return True
 
-    def load_model(self, load_dir_model=''):
+        # keep the label index of the training data with the model
+        if self.label_index is not None:
+            self.save_labels(self.label_index, save_dir_model)
+
+        if publish:
+            registry.publish(version)
+        return version
+
+    def get_current_model(self):
+        """ Gets the directory and version of the model in use: the
+            published version of the model registry, or the model saved
+            directly in <self.data_dir> if nothing was published.
+
+            Returns:
+                (tuple): (directory of the model files (str),
+                    model version (str))
+        """
+        registry = PMLModelRegistry(self.data_dir)
+        version = registry.get_current_version()
+        if version is None:
+            return self.data_dir, self.get_model_version()
+        return registry.get_version_dir(version), version
+
+    def load_model(self, load_dir_model='', engine='keras'):
         """ Loads the Keras model and returns the result as the
             Keras model object.
+
+            Args:
+                load_dir_model (str): directory of the saved model.
+                    The default is the model in use, as returned by
+                    get_current_model().
+                engine (str): can be one of:
+                    keras: the model is loaded with Keras.
+                    numpy: the model is loaded as a PMLNumpyNet, which
+                        only predicts, and does not need Keras.
+                    int8: the model quantized by PMLQuantizer is loaded
+                        as a PMLQuantizedNet.
+                    The default is 'keras'.
         """
         if load_dir_model == '':
-            load_dir_model = self.data_dir
+            load_dir_model = self.get_current_model()[0]
         json_path = '%s/%s' % (load_dir_model, self.model_json_fn)
         weights_path = '%s/%s' % (
             load_dir_model, self.model_weights_fn)
 
+        if engine == 'numpy':
+            from pml_numpy_net import PMLNumpyNet
+            model = PMLNumpyNet.load(json_path, weights_path)
+            print('model loaded from disk')
+            return model
+        if engine == 'int8':
+            from pml_quantizer import PMLQuantizedNet
+            model = PMLQuantizedNet.load(
+                '%s/%s' % (load_dir_model, self.model_int8_fn))
+            print('quantized model loaded from disk')
+            return model
+
+        from keras.models import model_from_json
         json_file = open(json_path)
         model_json = json_file.read()
         json_file.close()
@@ -183,28 +239,78 @@ class PMLNet:
         print('model loaded from disk')
         return model
 
-    def save_labels(self, label_to_int_dict):
-        """ TODO: save the dictionary mapping the (17) string labels
-            to the integers that are produced by numpy.
+    def get_model_version(self, load_dir_model=''):
+        """ Gets a version string of the saved model, that changes
+            whenever the saved weights change.
+
+            Args:
+                load_dir_model (str): directory of the saved model.
+                    The default is <self.data_dir>.
+
+            Returns:
+                (str): the version, formatted as
+                    <modification time>-<size> of the weights file.
         """
-        # TODO: this is currently being done manually.
-        return NotImplemented
+        if load_dir_model == '':
+            load_dir_model = self.data_dir
+        weights_path = '%s/%s' % (load_dir_model, self.model_weights_fn)
+        weights_stat = os.stat(weights_path)
+        return '%d-%d' % (weights_stat.st_mtime, weights_stat.st_size)
+
+    def save_labels(self, label_index, save_dir_model=''):
+        """ Saves the label index mapping the string labels to the
+            integers predicted by the model, next to the saved model.
+
+            Args:
+                label_index (PMLLabelIndex).
+                save_dir_model (str): directory of the saved model.
+                    The default is <self.data_dir>.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        if save_dir_model == '':
+            save_dir_model = self.data_dir
+        labels_path = '%s/%s' % (save_dir_model, self.labels_fn)
+        label_index.save(labels_path)
+        print('saved label index to disk at %s' % (labels_path))
+        return True
 
-    def int_label_to_str_label(self, pred_int, load_path_labels=''):
+    def load_label_index(self, load_dir_model=''):
+        """ Loads the label index saved by save_labels().
+
+            Args:
+                load_dir_model (str): directory of the saved model.
+                    The default is the model in use, as returned by
+                    get_current_model().
+
+            Returns:
+                (PMLLabelIndex)
         """
+        if load_dir_model == '':
+            load_dir_model = self.get_current_model()[0]
+        labels_path = '%s/%s' % (load_dir_model, self.labels_fn)
+        return PMLLabelIndex.load(labels_path)
+
+    def get_label_index(self):
+        """ Gets the label index, loading it from disk only the first
+            time it is needed.
+
+            Returns:
+                (PMLLabelIndex)
         """
-        # need to save labels to int json
-        # or other way around
-        # todo: make serparate fn and path for labels_dict json
+        if self.label_index is None:
+            self.label_index = self.load_label_index()
+        return self.label_index
 
-        labels_path = '%s/labels_to_ints.json' % (self.data_dir)
-        with open(labels_path) as json_data:
-            labels_dict = json.load(json_data)
-        ints_to_labels_dict = {}
-        for label in labels_dict.keys():
-            ints_to_labels_dict[str(labels_dict[label])] = label
-        pred_str = ints_to_labels_dict[str(pred_int)]
-        return pred_str
+    def int_label_to_str_label(self, pred_int):
+        """
+            Returns:
+                (str): the string label of the integer label
+                    <pred_int> predicted by the model.
+        """
+        return self.get_label_index().to_label(pred_int)
 
     def synthesize_train_imgs(self, n_per_img=20):
         """
@@ -0,0 +1,246 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import json
+
+import h5py
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class PMLNumpyNet:
+    """ Project Mona Lisa (PML) NumPy Net class is an inference-only
+        engine for the sequential models built by PMLNet.create_model().
+        It loads the model json and the HDF5 weights saved by
+        PMLNet.save_model() and runs the forward pass with NumPy, so
+        predicting does not need Keras or its backend to be installed
+        or loaded. It has the same predict() method as a Keras model,
+        so it can be given to PMLPredictor in place of one.
+
+        Supported layers are Conv2D, MaxPooling2D, Activation, Flatten,
+        Dropout and Dense.
+    """
+
+    def __init__(self, layers):
+        """
+            Args:
+                layers (list(dict)): the layers, in order. Each layer is
+                    a dictionary with the key 'class_name', the Keras
+                    layer config, and the numpy weights of the layer.
+        """
+        self.layers = layers
+        # number of images run through the layers at once, to bound
+        # the memory used by the im2col matrices:
+        self.max_chunk_size = 16
+
+    @classmethod
+    def load(cls, json_path, weights_path):
+        """ Loads a model saved by PMLNet.save_model().
+
+            Args:
+                json_path (str): path of the model json file.
+                weights_path (str): path of the HDF5 weights file.
+
+            Returns:
+                (PMLNumpyNet)
+        """
+        with open(json_path) as json_file:
+            model_config = json.load(json_file)['config']
+        # Keras 2.0 saves the layers of a Sequential model as a list,
+        # later versions as a dict with the key 'layers'.
+        if isinstance(model_config, dict):
+            model_config = model_config['layers']
+
+        layers = []
+        with h5py.File(weights_path, 'r') as weights_file:
+            if 'model_weights' in weights_file:
+                weights_file = weights_file['model_weights']
+            for layer_config in model_config:
+                config = layer_config['config']
+                layer = {
+                    'class_name': layer_config['class_name'],
+                    'config': config,
+                    'weights': [],
+                }
+                if config['name'] in weights_file:
+                    group = weights_file[config['name']]
+                    for weight_name in group.attrs.get('weight_names', []):
+                        if not isinstance(weight_name, str):
+                            weight_name = weight_name.decode('utf8')
+                        layer['weights'].append(
+                            np.asarray(group[weight_name], dtype=np.float32))
+                layers.append(layer)
+        return cls(layers)
+
+    def predict(self, x, batch_size=None):
+        """ Runs the forward pass.
+
+            Args:
+                x (numpy array): images of shape
+                    (<n_images>, height, width, channels).
+                batch_size (int): not used, accepted so the method can
+                    be called like the predict() method of a Keras
+                    model.
+
+            Returns:
+                (numpy array): the output of the last layer, of shape
+                    (<n_images>, <n_classes>).
+        """
+        x = np.asarray(x, dtype=np.float32)
+        outputs = [self.forward(x[i:i + self.max_chunk_size])
+                   for i in range(0, x.shape[0], self.max_chunk_size)]
+        return np.concatenate(outputs)
+
+    def forward(self, x):
+        """ Helper function for predict(). Runs the forward pass of a
+            chunk of images through all layers.
+        """
+        data_format = 'channels_last'
+        for layer in self.layers:
+            class_name = layer['class_name']
+            config = layer['config']
+            if class_name == 'Conv2D':
+                data_format = config.get('data_format', 'channels_last')
+                if data_format == 'channels_first':
+                    x = x.transpose(0, 2, 3, 1)
+                x = self.conv2d(x, layer['weights'], config)
+                x = self.activation(x, config.get('activation', 'linear'))
+                if data_format == 'channels_first':
+                    x = x.transpose(0, 3, 1, 2)
+            elif class_name == 'MaxPooling2D':
+                if data_format == 'channels_first':
+                    x = x.transpose(0, 2, 3, 1)
+                x = self.max_pooling2d(x, config)
+                if data_format == 'channels_first':
+                    x = x.transpose(0, 3, 1, 2)
+            elif class_name == 'Activation':
+                x = self.activation(x, config['activation'])
+            elif class_name == 'Flatten':
+                x = x.reshape(x.shape[0], -1)
+            elif class_name == 'Dropout':
+                # dropout is only used in training
+                continue
+            elif class_name == 'Dense':
+                x = self.dense(x, layer['weights'], config)
+                x = self.activation(x, config.get('activation', 'linear'))
+            else:
+                raise ValueError('The layer: %s is not supported'
+                                 % (class_name))
+        return x
+
+    def conv2d(self, x, weights, config):
+        """ 2D convolution (cross-correlation, like Keras) with im2col:
+            all patches of the image are gathered into one matrix, so
+            the convolution is a single matrix product.
+
+            Args:
+                x (numpy array): of shape (n, height, width, channels).
+                weights (list(numpy array)): the kernel, of shape
+                    (kernel height, kernel width, channels, filters),
+                    and optionally the bias, of shape (filters,).
+                config (dict): the Keras layer config.
+
+            Returns:
+                (numpy array): of shape (n, out height, out width,
+                    filters).
+        """
+        kernel = weights[0]
+        kh, kw, c_in, c_out = kernel.shape
+        sh, sw = config.get('strides', (1, 1))
+        if config.get('padding', 'valid') == 'same':
+            x = self.pad_same(x, (kh, kw), (sh, sw))
+
+        cols = self.windows(x, (kh, kw), (sh, sw))
+        n, oh, ow = cols.shape[:3]
+        # (n, oh, ow, kh, kw, c) -> (n * oh * ow, kh * kw * c)
+        cols = cols.reshape(n * oh * ow, kh * kw * c_in)
+        out = np.dot(cols, kernel.reshape(kh * kw * c_in, c_out))
+        if len(weights) > 1:
+            out += weights[1]
+        return out.reshape(n, oh, ow, c_out)
+
+    def max_pooling2d(self, x, config):
+        """ 2D max pooling.
+
+            Args:
+                x (numpy array): of shape (n, height, width, channels).
+                config (dict): the Keras layer config.
+
+            Returns:
+                (numpy array): of shape (n, out height, out width,
+                    channels).
+        """
+        pool_size = tuple(config.get('pool_size', (2, 2)))
+        strides = config.get('strides') or pool_size
+        if config.get('padding', 'valid') == 'same':
+            x = self.pad_same(x, pool_size, strides, -np.inf)
+        return self.windows(x, pool_size, strides).max(axis=(3, 4))
+
+    def dense(self, x, weights, config):
+        """ Fully connected layer.
+
+            Args:
+                x (numpy array): of shape (n, inputs).
+                weights (list(numpy array)): the kernel, of shape
+                    (inputs, units), and optionally the bias, of shape
+                    (units,).
+                config (dict): the Keras layer config.
+
+            Returns:
+                (numpy array): of shape (n, units).
+        """
+        out = np.dot(x, weights[0])
+        if len(weights) > 1:
+            out += weights[1]
+        return out
+
+    def activation(self, x, name):
+        """
+            Returns:
+                (numpy array): the activation function <name> applied
+                    to <x>.
+        """
+        if name == 'linear':
+            return x
+        if name == 'relu':
+            return np.maximum(x, 0)
+        if name == 'softmax':
+            x = np.exp(x - x.max(axis=-1, keepdims=True))
+            return x / x.sum(axis=-1, keepdims=True)
+        if name == 'sigmoid':
+            return 1. / (1. + np.exp(-x))
+        if name == 'tanh':
+            return np.tanh(x)
+        raise ValueError('The activation: %s is not supported' % (name))
+
+    def windows(self, x, window, strides):
+        """ Helper function. Gets a strided view of all windows of <x>,
+            without copying.
+
+            Returns:
+                (numpy array): view of shape (n, out height, out width,
+                    window height, window width, channels).
+        """
+        n, h, w, c = x.shape
+        kh, kw = window
+        sh, sw = strides
+        oh = (h - kh) // sh + 1
+        ow = (w - kw) // sw + 1
+        s_n, s_h, s_w, s_c = x.strides
+        return as_strided(
+            x,
+            shape=(n, oh, ow, kh, kw, c),
+            strides=(s_n, s_h * sh, s_w * sw, s_h, s_w, s_c),
+            writeable=False)
+
+    def pad_same(self, x, window, strides, value=0.):
+        """ Helper function. Pads <x> like the 'same' padding of the
+            TensorFlow backend.
+        """
+        pads = [(0, 0)]
+        for size, k, s in zip(x.shape[1:3], window, strides):
+            out = (size + s - 1) // s
+            total = max((out - 1) * s + k - size, 0)
+            pads.append((total // 2, total - total // 2))
+        pads.append((0, 0))
+        return np.pad(x, pads, mode='constant', constant_values=value)
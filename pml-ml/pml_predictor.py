@@ -4,7 +4,7 @@ from __future__ import print_function
 
 from pml_net import PMLNet
 #import keras
-#import numpy as np
+import numpy as np
 
 
 class PMLPredictor(PMLNet):
@@ -13,24 +13,93 @@ class PMLPredictor(PMLNet):
         from training.
     """
 
-    def __init__(self, data_dir, model):
+    def __init__(self, data_dir, model, label_index=None):
         """
+            Args:
+                data_dir (str): absolute path of the directory where
+                    the model and the label index are saved.
+                model (obj): the loaded Keras model.
+                label_index (PMLLabelIndex): the label index saved with
+                    the model. If it is not given, it is loaded from
+                    <data_dir> the first time it is needed.
         """
         PMLNet.__init__(self, data_dir)
         self.model = model
+        self.label_index = label_index
 
     def predict(self, img_array):
         """ Predicts the string label from an image as a numpy array,
             given the <self.model> model.
         """
-        # reshape the image from (height, width) to:
-        # (1,height, width, 1)
-        img_array = img_array.reshape(
-            1, img_array.shape[0], img_array.shape[1], 1)
+        return self.predict_arrays([img_array])[0]
 
-        pred_arr = self.model.predict(img_array, batch_size=1)
-        pred_int = pred_arr.argmax()
+    def predict_arrays(self, img_arrays):
+        """ Predicts the string labels of several images with a single
+            forward pass of <self.model>.
 
-        pred_str = self.int_label_to_str_label(pred_int)
+            Args:
+                img_arrays (list(numpy array)): images of shape
+                    (height, width), all of the same shape.
 
-        return pred_str
+            Returns:
+                list(str): the predicted label of each image, in the
+                    same order as <img_arrays>.
+        """
+        pred_ints = self.predict_proba(img_arrays).argmax(axis=1)
+
+        return [self.int_label_to_str_label(pred_int)
+                for pred_int in pred_ints]
+
+    def predict_batch(self, img_arrays, top_k=3):
+        """ Predicts the <top_k> most likely string labels, and their
+            probabilities, of several images with a single forward pass
+            of <self.model>.
+
+            Args:
+                img_arrays (list(numpy array)): images of shape
+                    (height, width), all of the same shape.
+                top_k (int): the number of labels returned per image,
+                    at least 1. The default is 3.
+
+            Returns:
+                list(list(dict)): for each image, in the same order as
+                    <img_arrays>, the <top_k> labels, most likely first,
+                    formatted like:
+                    [{"label": "<label>", "probability": <probability>},
+                     ...]
+        """
+        if top_k < 1:
+            raise ValueError('top_k must be at least 1')
+        pred_arr = self.predict_proba(img_arrays)
+        top_k = min(top_k, pred_arr.shape[1])
+        # indices of the most likely ints first:
+        top_ints = np.argsort(-pred_arr, axis=1)[:, :top_k]
+
+        predictions = []
+        for i_img in range(pred_arr.shape[0]):
+            predictions.append([
+                {
+                    'label': self.int_label_to_str_label(pred_int),
+                    'probability': float(pred_arr[i_img, pred_int]),
+                }
+                for pred_int in top_ints[i_img]])
+        return predictions
+
+    def predict_proba(self, img_arrays):
+        """ Runs a single forward pass of <self.model> over several
+            images.
+
+            Args:
+                img_arrays (list(numpy array)): images of shape
+                    (height, width), all of the same shape.
+
+            Returns:
+                (numpy array): the probability of each int label, of
+                    shape (<n_images>, <n_classes>).
+        """
+        # stack the images from (height, width) to:
+        # (n_images, height, width, 1)
+        img_stack = np.stack(img_arrays)
+        img_stack = img_stack.reshape(img_stack.shape + (1,))
+
+        return self.model.predict(img_stack, batch_size=len(img_arrays))
@@ -0,0 +1,338 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import json
+import time
+
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+from pml_data import PMLData
+from pml_net import PMLNet
+from pml_numpy_net import PMLNumpyNet
+
+
+class PMLQuantizedNet(PMLNumpyNet):
+    """ PMLQuantizedNet is a subclass of PMLNumpyNet that predicts with
+        int8 weights. The kernels of the Conv2D and Dense layers are
+        quantized with one scale per output channel, and the input of
+        each of these layers is quantized with one scale per layer,
+        calibrated on a set of training images. The integer products
+        are accumulated in float32 so NumPy can use BLAS, and the bias
+        and the activations stay float32.
+
+        Only the int8 kernels are kept in memory. The float32 copy of a
+        kernel that BLAS needs is made when its layer runs, and is freed
+        before the next layer runs, so there is at most one float32
+        kernel in memory at a time.
+    """
+
+    def __init__(self, layers):
+        """
+            Args:
+                layers (list(dict)): the layers, as in PMLNumpyNet.
+                    The kernel of a quantized layer is an int8 array,
+                    and the layer also has the keys 'w_scale' and
+                    'x_scale'.
+        """
+        PMLNumpyNet.__init__(self, layers)
+        # layer name -> largest absolute input, while calibrating:
+        self.calibration_max = None
+
+    @classmethod
+    def from_float(cls, float_net, x_calibration):
+        """ Quantizes a float PMLNumpyNet.
+
+            Args:
+                float_net (PMLNumpyNet): the float model.
+                x_calibration (numpy array): calibration images, of the
+                    same shape and scale as the images that will be
+                    predicted.
+
+            Returns:
+                (PMLQuantizedNet)
+        """
+        layers = [dict(layer, weights=list(layer['weights']))
+                  for layer in float_net.layers]
+        quantized_net = cls(layers)
+        quantized_net.calibrate(x_calibration)
+        quantized_net.quantize_weights()
+        return quantized_net
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a model saved by save().
+
+            Args:
+                path (str): path of the .npz file.
+
+            Returns:
+                (PMLQuantizedNet)
+        """
+        with np.load(path) as npz_file:
+            layers = json.loads(str(npz_file['layers_json']))
+            for i_layer, layer in enumerate(layers):
+                layer['weights'] = [
+                    npz_file['%d_w%d' % (i_layer, i_weight)]
+                    for i_weight in range(layer.pop('n_weights'))]
+                w_scale_key = '%d_w_scale' % (i_layer)
+                if w_scale_key in npz_file.files:
+                    layer['w_scale'] = npz_file[w_scale_key]
+        return cls(layers)
+
+    def save(self, path):
+        """ Saves the quantized model as a single .npz file.
+
+            Args:
+                path (str): path of the .npz file.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        arrays = {}
+        layers = []
+        for i_layer, layer in enumerate(self.layers):
+            for i_weight, weight in enumerate(layer['weights']):
+                arrays['%d_w%d' % (i_layer, i_weight)] = weight
+            if 'w_scale' in layer:
+                arrays['%d_w_scale' % (i_layer)] = layer['w_scale']
+            layer_json = dict((key, value) for key, value in layer.items()
+                              if key not in ('weights', 'w_scale'))
+            layer_json['n_weights'] = len(layer['weights'])
+            layers.append(layer_json)
+        arrays['layers_json'] = np.array(json.dumps(layers))
+        np.savez(path, **arrays)
+        print('saved quantized model to disk at %s' % (path))
+        return True
+
+    def calibrate(self, x_calibration):
+        """ Runs the float model on the calibration images and sets the
+            input scale of each quantized layer from the largest
+            absolute input it sees.
+
+            Returns:
+                (bool) True if successful.
+        """
+        self.calibration_max = {}
+        self.predict(x_calibration)
+        for layer in self.layers:
+            name = layer['config']['name']
+            if name in self.calibration_max:
+                layer['x_scale'] = \
+                    max(self.calibration_max[name], 1e-8) / 127.
+        self.calibration_max = None
+        return True
+
+    def quantize_weights(self):
+        """ Replaces the float kernel of each Conv2D and Dense layer with
+            an int8 kernel and its per-output-channel scale.
+
+            Returns:
+                (bool) True if successful.
+        """
+        for layer in self.layers:
+            if layer['class_name'] not in ('Conv2D', 'Dense'):
+                continue
+            kernel = layer['weights'][0]
+            # the output channel is the last axis of the kernel
+            reduce_axes = tuple(range(kernel.ndim - 1))
+            w_scale = np.abs(kernel).max(axis=reduce_axes) / 127.
+            w_scale = np.maximum(w_scale, 1e-12).astype(np.float32)
+            layer['weights'][0] = np.clip(
+                np.round(kernel / w_scale), -127, 127).astype(np.int8)
+            layer['w_scale'] = w_scale
+        return True
+
+    def get_layer(self, config):
+        """ Helper function. Gets the layer with the config <config>.
+        """
+        for layer in self.layers:
+            if layer['config'] is config:
+                return layer
+        raise ValueError('Unknown layer: %s' % (config['name']))
+
+    def quantize_input(self, x, layer):
+        """ Helper function. Rounds <x> to int8 steps of the input scale
+            of <layer>, stored as float32 for the BLAS matrix product.
+        """
+        return np.clip(np.round(x / layer['x_scale']), -127, 127)\
+            .astype(np.float32)
+
+    def record_input(self, x, config):
+        """ Helper function. Keeps the largest absolute input of the
+            layer while calibrating.
+        """
+        name = config['name']
+        self.calibration_max[name] = max(
+            self.calibration_max.get(name, 0.), float(np.abs(x).max()))
+
+    def conv2d(self, x, weights, config):
+        """ PMLNumpyNet.conv2d() with the int8 kernel. """
+        if self.calibration_max is not None:
+            self.record_input(x, config)
+            return PMLNumpyNet.conv2d(self, x, weights, config)
+        layer = self.get_layer(config)
+        out = PMLNumpyNet.conv2d(
+            self,
+            self.quantize_input(x, layer),
+            # the float32 kernel only lives for this layer
+            [weights[0].astype(np.float32)],
+            config)
+        out *= layer['x_scale'] * layer['w_scale']
+        if len(weights) > 1:
+            out += weights[1]
+        return out
+
+    def dense(self, x, weights, config):
+        """ PMLNumpyNet.dense() with the int8 kernel. """
+        if self.calibration_max is not None:
+            self.record_input(x, config)
+            return PMLNumpyNet.dense(self, x, weights, config)
+        layer = self.get_layer(config)
+        out = np.dot(self.quantize_input(x, layer),
+                     weights[0].astype(np.float32))
+        out *= layer['x_scale'] * layer['w_scale']
+        if len(weights) > 1:
+            out += weights[1]
+        return out
+
+
+class PMLQuantizer(PMLNet):
+    """ PMLQuantizer is a subclass of PMLNet. This class is used to
+        quantize a trained model to int8, and to report the accuracy,
+        size, peak inference memory and latency of the quantized model
+        against the float model.
+    """
+
+    def __init__(self, data_dir, n_calibration=256, n_timing=20):
+        """
+            Args:
+                data_dir (str): absolute path of the directory with the
+                    training data and the saved model.
+                n_calibration (int): the number of training images used
+                    to calibrate the input scales. The default is 256.
+                n_timing (int): the number of single image predictions
+                    timed for each model. The default is 20.
+        """
+        PMLNet.__init__(self, data_dir)
+        self.n_calibration = n_calibration
+        self.n_timing = n_timing
+
+    def quantize(self, load_dir_model=''):
+        """ Quantizes the saved model, saves the quantized model next to
+            it and reports the effect of the quantization.
+
+            Args:
+                load_dir_model (str): directory of the saved model.
+                    The default is the model in use, as returned by
+                    get_current_model().
+
+            Returns:
+                (dict): the report, as returned by compare().
+        """
+        if load_dir_model == '':
+            load_dir_model = self.get_current_model()[0]
+        float_net = self.load_model(load_dir_model, engine='numpy')
+        label_index = self.load_label_index(load_dir_model)
+
+        # images are scaled as PMLPredictor scales them for predicting
+        (x_train, _), (x_test, y_test) = PMLData('all', self.data_dir)\
+            .load_data()
+        x_train = x_train.reshape(x_train.shape + (1,))
+        x_test = x_test.reshape(x_test.shape + (1,))
+        y_test = np.array([label_index.to_int(label) for label in y_test])
+
+        quantized_net = PMLQuantizedNet.from_float(
+            float_net, x_train[:self.n_calibration])
+        quantized_net.save('%s/%s' % (load_dir_model, self.model_int8_fn))
+
+        report = self.compare(float_net, quantized_net, x_test, y_test)
+        for key in sorted(report.keys()):
+            print('%s: %s' % (key, report[key]))
+        return report
+
+    def compare(self, float_net, quantized_net, x_test, y_test):
+        """ Compares the accuracy, resident weight size, peak inference
+            memory and latency of the float and quantized models on the
+            test data.
+
+            Returns:
+                (dict): formatted like:
+                {
+                    "float_accuracy": <accuracy>,
+                    "int8_accuracy": <accuracy>,
+                    "accuracy_delta": <int8 - float accuracy>,
+                    "float_weight_bytes": <bytes>,
+                    "int8_weight_bytes": <bytes>,
+                    "float_peak_inference_bytes": <bytes>,
+                    "int8_peak_inference_bytes": <bytes>,
+                    "float_latency_ms": <ms per image>,
+                    "int8_latency_ms": <ms per image>,
+                }
+        """
+        report = {}
+        for name, net in (('float', float_net), ('int8', quantized_net)):
+            pred_ints = net.predict(x_test).argmax(axis=1)
+            report['%s_accuracy' % (name)] = float(
+                np.mean(pred_ints == y_test))
+            report['%s_weight_bytes' % (name)] = \
+                self.get_weight_bytes(net)
+            report['%s_peak_inference_bytes' % (name)] = \
+                self.get_peak_inference_bytes(net, x_test[:1])
+
+            start_time = time.time()
+            for i_img in range(self.n_timing):
+                net.predict(x_test[i_img % len(x_test)][np.newaxis])
+            report['%s_latency_ms' % (name)] = \
+                1000. * (time.time() - start_time) / self.n_timing
+
+        report['accuracy_delta'] = \
+            report['int8_accuracy'] - report['float_accuracy']
+        return report
+
+    def get_weight_bytes(self, net):
+        """
+            Returns:
+                (int): the memory held by the weights of <net>, which
+                    is also their size as saved.
+        """
+        n_bytes = 0
+        for layer in net.layers:
+            n_bytes += sum(weight.nbytes for weight in layer['weights'])
+            if 'w_scale' in layer:
+                n_bytes += layer['w_scale'].nbytes
+        return n_bytes
+
+    def get_peak_inference_bytes(self, net, x):
+        """ Measures the peak memory of predicting <x> with <net>: the
+            memory held by the weights, plus the peak of the memory
+            allocated by the forward pass, which includes the float32
+            kernel of the running layer of a PMLQuantizedNet.
+
+            Returns:
+                (int): the peak memory in bytes, or None on python 2,
+                    which cannot trace the memory allocated by NumPy.
+        """
+        if tracemalloc is None:
+            return None
+        n_bytes = self.get_weight_bytes(net)
+
+        tracemalloc.start()
+        try:
+            net.predict(x)
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return n_bytes + peak_bytes
+
+
+if __name__ == '__main__':
+    data_dir = 'TODO'
+
+    # quantize the model in use, and report the accuracy delta, and
+    # the weight size, peak memory and latency against the float model:
+    quantizer = PMLQuantizer(data_dir)
+    quantizer.quantize()
@@ -0,0 +1,122 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import os
+import threading
+
+# config variables for the backend of PMLDatabase and PMLStorage:
+# 'aws' for DynamoDB and S3, or 'local' for a SQLite database file and
+# a directory, to run the services and the training pipeline on one
+# machine, e.g. for load tests. The environment variables override
+# them.
+backend_name = os.environ.get('PML_BACKEND', 'aws')
+local_db_path = os.environ.get(
+    'PML_LOCAL_DB_PATH', '/path/to/local/pml.sqlite')
+local_storage_dir = os.environ.get(
+    'PML_LOCAL_STORAGE_DIR', '/path/to/local/storage/dir')
+
+
+class PMLBackend:
+    """ Project Mona Lisa Backend class. The interface of the backends
+        of PMLDatabase and PMLStorage. A backend gets the tables and
+        buckets, which have the API of the boto3 DynamoDB Table and S3
+        Bucket, or the subset of it that PMLDatabase and PMLStorage use.
+    """
+
+    def get_table(self, name, key_names=('id',)):
+        """
+            Args:
+                name (str): name of the table.
+                key_names (tuple(str)): the primary key of the table:
+                    the partition key, and optionally the sort key. The
+                    default is ('id',).
+
+            Returns:
+                (obj): the table.
+        """
+        raise NotImplementedError()
+
+    def get_bucket(self, name):
+        """
+            Args:
+                name (str): name of the bucket.
+
+            Returns:
+                (obj): the bucket.
+        """
+        raise NotImplementedError()
+
+
+class PMLAWSBackend(PMLBackend):
+    """ PMLAWSBackend is a subclass of PMLBackend for DynamoDB and S3,
+        with the resources of the PMLClientProvider.
+    """
+
+    def get_table(self, name, key_names=('id',)):
+        from pml_clients import get_provider
+        return get_provider().get_resource('dynamodb').Table(name)
+
+    def get_bucket(self, name):
+        from pml_clients import get_provider
+        return get_provider().get_resource('s3').Bucket(name)
+
+
+class PMLLocalBackend(PMLBackend):
+    """ PMLLocalBackend is a subclass of PMLBackend that keeps all
+        tables in one SQLite database file (PMLSQLiteTable) and each
+        bucket in a directory (PMLDirectoryBucket).
+    """
+
+    def __init__(self, db_path, storage_dir):
+        """
+            Args:
+                db_path (str): path of the SQLite database file.
+                storage_dir (str): the directory of the buckets.
+        """
+        self.db_path = db_path
+        self.storage_dir = storage_dir
+        # the tables and buckets are thread safe, and are reused:
+        self.tables = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_table(self, name, key_names=('id',)):
+        from pml_sqlite_table import PMLSQLiteTable
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = PMLSQLiteTable(
+                    self.db_path, name, key_names)
+            return self.tables[name]
+
+    def get_bucket(self, name):
+        from pml_directory_bucket import PMLDirectoryBucket
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = PMLDirectoryBucket(
+                    self.storage_dir, name)
+            return self.buckets[name]
+
+
+backend = None
+backend_lock = threading.Lock()
+
+
+def get_backend():
+    """ Gets the process-wide backend selected by <backend_name>,
+        creating it the first time.
+
+        Returns:
+            (PMLBackend)
+    """
+    global backend
+    if backend is None:
+        with backend_lock:
+            if backend is None:
+                if backend_name == 'aws':
+                    backend = PMLAWSBackend()
+                elif backend_name == 'local':
+                    backend = PMLLocalBackend(
+                        local_db_path, local_storage_dir)
+                else:
+                    raise ValueError('Unknown backend: %s' % (backend_name))
+    return backend
@@ -0,0 +1,124 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from collections import OrderedDict
+import threading
+import time
+
+
+class PMLCache:
+    """ Project Mona Lisa Cache class. A bounded, thread-safe, in-process
+        read-through cache. Items are evicted when they are older than
+        <ttl> seconds, or, when the cache is full, the least recently
+        used item is evicted.
+    """
+
+    def __init__(self, max_size=128, ttl=300):
+        """
+            Args:
+                max_size (int): the maximum number of items in the
+                    cache. The default is 128.
+                ttl (float): the number of seconds an item is kept in
+                    the cache. The default is 300. None keeps items
+                    until they are evicted or invalidated.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expiry time, value), ordered from least to most
+        # recently used:
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Gets the cached value of <key>.
+
+            Returns:
+                the cached value, or <default> if <key> is not cached
+                or has expired.
+        """
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            expires, value = self.items.pop(key)
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # re-insert as the most recently used item
+            self.items[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Caches <value> for <key>, evicting the least recently used
+            item if the cache is full.
+
+            Returns:
+                bool: True if successful.
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return True
+
+    def get_or_load(self, key, load_func):
+        """ Read-through get: returns the cached value of <key>, or calls
+            <load_func>, caches and returns its result if <key> is not
+            cached. <load_func> is called outside of the lock, so a slow
+            load does not block other keys.
+
+            Args:
+                key (hashable): the cache key.
+                load_func (function): function without arguments that
+                    returns the value of <key>.
+
+            Returns:
+                the value of <key>.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = load_func()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """ Removes <key> from the cache, if it is cached.
+
+            Returns:
+                bool: True if successful.
+        """
+        with self.lock:
+            self.items.pop(key, None)
+        return True
+
+    def clear(self):
+        """ Removes all items from the cache.
+
+            Returns:
+                bool: True if successful.
+        """
+        with self.lock:
+            self.items.clear()
+        return True
+
+    def stats(self):
+        """
+            Returns:
+                (dict): the number of cache hits and misses, and the
+                    number of items in the cache, formatted like:
+                    {"hits": 7, "misses": 2, "size": 2}
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.items),
+            }
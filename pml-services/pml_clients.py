@@ -0,0 +1,197 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import threading
+import time
+
+import boto3
+import botocore
+from botocore.config import Config
+
+# config variables for the AWS clients:
+region_name = 'TODO'
+max_pool_connections = 50
+max_attempts = 5
+connect_timeout = 5  # seconds
+read_timeout = 30  # seconds
+
+
+class PMLClientProvider:
+    """ Project Mona Lisa Client Provider class. Process-wide provider of
+        the boto3 resources used by PMLDatabase and PMLStorage, so the
+        session, the credentials and the pooled keep-alive HTTP
+        connections are reused across calls instead of being created
+        for every call. There is one session and one low-level client
+        per service for the whole process, as botocore clients are
+        thread safe. boto3 resources are not, so each thread gets its
+        own resources, built on the shared clients: a new worker thread
+        only creates a light-weight resource object, and does not
+        resolve the credentials or open connections again. The latency
+        of every AWS call is recorded per operation.
+    """
+
+    def __init__(self, region_name, max_pool_connections=50,
+                 max_attempts=5, connect_timeout=5, read_timeout=30):
+        """
+            Args:
+                region_name (str): the AWS region.
+                max_pool_connections (int): the largest number of
+                    pooled connections of each resource. The default is
+                    50.
+                max_attempts (int): the largest number of attempts of a
+                    call, including botocore's retries of throttled
+                    calls. The default is 5.
+                connect_timeout (float): seconds. The default is 5.
+                read_timeout (float): seconds. The default is 30.
+        """
+        self.region_name = region_name
+        self.config = self.make_config(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={'max_attempts': max_attempts},
+            tcp_keepalive=True,
+        )
+        self.session = None
+        # service name -> shared client, and service name -> class of
+        # the boto3 resource:
+        self.clients = {}
+        self.resource_classes = {}
+        self.clients_lock = threading.Lock()
+        self.local = threading.local()
+        # '<service>.<operation>' -> {'calls', 'total_seconds',
+        # 'max_seconds'}:
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
+
+    def make_config(self, **config_kwargs):
+        """ Helper function. Creates the botocore Config, leaving out the
+            options that the installed botocore does not support yet
+            (retries and tcp_keepalive are newer than some versions,
+            see requirements.txt). Each option left out is printed.
+        """
+        for optional in ('tcp_keepalive', 'retries', None):
+            try:
+                return Config(**config_kwargs)
+            except TypeError:
+                if optional in config_kwargs:
+                    print('WARNING: botocore %s does not support the %s '
+                          'option, which is ignored' % (
+                              botocore.__version__, optional))
+                    config_kwargs.pop(optional)
+        print('WARNING: botocore %s does not support the client options, '
+              'the defaults are used' % (botocore.__version__))
+        return Config()
+
+    def get_client(self, service_name):
+        """ Gets the low-level boto3 client of <service_name> shared by
+            all threads, creating it the first time.
+
+            Args:
+                service_name (str): e.g. 'dynamodb' or 's3'.
+
+            Returns:
+                (obj): the boto3 client.
+        """
+        if service_name not in self.clients:
+            # creating the session and clients is not thread safe
+            with self.clients_lock:
+                if self.session is None:
+                    self.session = boto3.session.Session()
+                if service_name not in self.clients:
+                    resource = self.session.resource(
+                        service_name,
+                        region_name=self.region_name,
+                        config=self.config)
+                    client = resource.meta.client
+                    events = client.meta.events
+                    events.register('before-call', self.before_call)
+                    events.register('after-call', self.after_call)
+                    self.resource_classes[service_name] = type(resource)
+                    self.clients[service_name] = client
+        return self.clients[service_name]
+
+    def get_resource(self, service_name):
+        """ Gets the boto3 resource of <service_name> of the calling
+            thread, creating it on the shared client the first time.
+
+            Args:
+                service_name (str): e.g. 'dynamodb' or 's3'.
+
+            Returns:
+                (obj): the boto3 resource.
+        """
+        resources = getattr(self.local, 'resources', None)
+        if resources is None:
+            resources = self.local.resources = {}
+        if service_name not in resources:
+            client = self.get_client(service_name)
+            resources[service_name] = \
+                self.resource_classes[service_name](client=client)
+        return resources[service_name]
+
+    def before_call(self, context=None, **kwargs):
+        """ botocore event handler. Keeps the start time of a call. """
+        if context is not None:
+            context['pml_start_time'] = time.time()
+
+    def after_call(self, model=None, context=None, **kwargs):
+        """ botocore event handler. Records the latency of a call. """
+        if context is None or 'pml_start_time' not in context:
+            return
+        seconds = time.time() - context.pop('pml_start_time')
+        operation = '%s.%s' % (
+            model.service_model.service_name, model.name)
+        with self.latencies_lock:
+            latency = self.latencies.setdefault(
+                operation,
+                {'calls': 0, 'total_seconds': 0., 'max_seconds': 0.})
+            latency['calls'] += 1
+            latency['total_seconds'] += seconds
+            latency['max_seconds'] = max(latency['max_seconds'], seconds)
+
+    def get_latencies(self):
+        """
+            Returns:
+                (dict): the recorded latencies per operation, formatted
+                like:
+                {
+                    "dynamodb.Query": {
+                        "calls": 12,
+                        "total_seconds": 0.3,
+                        "max_seconds": 0.05,
+                        "mean_seconds": 0.025
+                    },
+                }
+        """
+        with self.latencies_lock:
+            latencies = dict((operation, dict(latency))
+                             for operation, latency in self.latencies.items())
+        for latency in latencies.values():
+            latency['mean_seconds'] = \
+                latency['total_seconds'] / latency['calls']
+        return latencies
+
+
+provider = None
+provider_lock = threading.Lock()
+
+
+def get_provider():
+    """ Gets the process-wide PMLClientProvider, creating it from the
+        config variables of this module the first time.
+
+        Returns:
+            (PMLClientProvider)
+    """
+    global provider
+    if provider is None:
+        with provider_lock:
+            if provider is None:
+                provider = PMLClientProvider(
+                    region_name,
+                    max_pool_connections=max_pool_connections,
+                    max_attempts=max_attempts,
+                    connect_timeout=connect_timeout,
+                    read_timeout=read_timeout)
+    return provider
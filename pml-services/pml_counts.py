@@ -0,0 +1,141 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from boto3.dynamodb.conditions import Key
+
+from pml_database import PMLDatabase
+
+
+class PMLCounts(PMLDatabase):
+    """ PMLCounts is a subclass of PMLDatabase. This class keeps a
+        materialized view of how many sketches were collected per
+        username and per label, so the leaderboard and the least
+        collected label are read from a handful of small items instead
+        of a scan of the collect table.
+
+        The counts table has the partition key 'kind' (the counted
+        attribute, e.g. 'label') and the sort key 'value' (e.g.
+        'circle'), and each item has a number attribute 'count'.
+    """
+
+    def __init__(self, db_name, attrs=('username', 'label')):
+        """
+            Args:
+                db_name (str): name of the counts database.
+                attrs (tuple(str)): the attributes of the collected
+                    items that are counted. The default is
+                    ('username', 'label').
+        """
+        PMLDatabase.__init__(self, db_name)
+        self.key_names = ('kind', 'value')
+        self.attrs = attrs
+
+    def increment(self, item):
+        """ Atomically adds one to the count of each counted attribute
+            of a collected item.
+
+            Args:
+                item (dict): the collected item, as posted in the
+                    collect database.
+
+            Returns:
+                bool: True if successful, otherwise an error is thrown.
+        """
+        table = self.get_table()
+        for attr in self.attrs:
+            table.update_item(
+                Key={'kind': attr, 'value': item[attr]},
+                UpdateExpression='ADD #count :one',
+                ExpressionAttributeNames={'#count': 'count'},
+                ExpressionAttributeValues={':one': 1},
+            )
+        return True
+
+    def decrement(self, item):
+        """ Atomically subtracts one from the count of each counted
+            attribute of a deleted collected item. Attributes that the
+            item does not have are skipped.
+
+            Args:
+                item (dict): the deleted item, with at least the
+                    counted attributes it had in the collect database.
+
+            Returns:
+                bool: True if successful, otherwise an error is thrown.
+        """
+        table = self.get_table()
+        for attr in self.attrs:
+            if attr not in item:
+                continue
+            table.update_item(
+                Key={'kind': attr, 'value': item[attr]},
+                UpdateExpression='ADD #count :minus_one',
+                ExpressionAttributeNames={'#count': 'count'},
+                ExpressionAttributeValues={':minus_one': -1},
+            )
+        return True
+
+    def get_counts(self, attr):
+        """ Gets the count of every value of <attr>.
+
+            Args:
+                attr (str): a counted attribute, e.g. 'label'.
+
+            Returns:
+                (dict): dictionary mapping each value to its count.
+                For example: {'circle': 12, 'square': 7}
+        """
+        items = self.query_items(
+            KeyConditionExpression=Key('kind').eq(attr),
+            ProjectionExpression='#value, #count',
+            ExpressionAttributeNames={'#value': 'value', '#count': 'count'},
+        )
+        return dict((item['value'], int(item['count'])) for item in items)
+
+    def get_count_map(self, attr):
+        """ Same as PMLDatabase.get_attr_count_map() on the collect
+            database, but read from the counts.
+
+            Returns:
+                (dict): For example:
+                {'attr_val1': {'count': 1}, 'attr_val2': {'count': 7},}
+        """
+        counts = self.get_counts(attr)
+        return dict((value, {'count': counts[value]}) for value in counts)
+
+    def rebuild(self, collect_db_name):
+        """ Repairs the counts by counting the collect database again in
+            a single scan, and overwriting the counts. Sketches posted
+            while the rebuild is running can be missed, so it should be
+            run when few sketches are collected.
+
+            Args:
+                collect_db_name (str): name of the collect database.
+
+            Returns:
+                bool: True if successful, otherwise an error is thrown.
+        """
+        print('counting %s . . .' % (collect_db_name))
+        counts = PMLDatabase(collect_db_name).count_attrs(list(self.attrs))
+
+        table = self.get_table()
+        with table.batch_writer() as batch:
+            for attr in self.attrs:
+                # remove the counts of values that no longer occur
+                for value in self.get_counts(attr):
+                    if value not in counts[attr]:
+                        batch.delete_item(
+                            Key={'kind': attr, 'value': value})
+                for value, count in counts[attr].items():
+                    batch.put_item(
+                        Item={'kind': attr, 'value': value, 'count': count})
+                print('%d %s counts written' % (len(counts[attr]), attr))
+        return True
+
+
+if __name__ == '__main__':
+    db_name_counts = 'TODO'
+    db_name_collect = 'TODO'
+
+    # rebuild the counts from a scan of the collect database:
+    PMLCounts(db_name_counts).rebuild(db_name_collect)
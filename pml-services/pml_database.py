@@ -1,34 +1,101 @@
 # Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
 from __future__ import print_function
-import boto3
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
 from random import randint, uniform
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import os
 import base64
+import threading
+import time
+import uuid
+
+from pml_backends import get_backend
+from pml_retry import get_error_code, is_retryable, retry_call
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+# global secondary index of the collect database on the partition key
+# 'created_day' and the sort key 'created_at', queried by
+# get_items_since(). Create it with create_created_index().
+CREATED_INDEX_NAME = 'created_day-created_at-index'
 
 
 class PMLDatabase:
     """ Project Mona Lisa Database class.
     """
 
-    def __init__(self, db_name, modename='all'):
+    def __init__(self, db_name, modename='all', table=None):
         """
             Args:
                 db_name (str): name of the database.
                 modename (str): the training mode. The default value
                 is 'all'.
+                table (obj): an object used in place of the boto3 table,
+                    e.g. a PMLFakeTable. The default is None.
         """
         self.db_name = db_name
         self.modename = modename
+        self.table = table
+        # the primary key of the database:
+        self.key_names = ('id',)
+        # rows, seconds, rows per second and retries of the last
+        # export_items():
+        self.export_stats = None
 
     def get_table(self):
         """
             Returns:
-                (obj): The boto3 AWS DynamoDB object.
+                (obj): The boto3 AWS DynamoDB object, or the table of
+                    the backend selected in pml_backends.
+        """
+        if self.table is not None:
+            return self.table
+        return get_backend().get_table(self.db_name, self.key_names)
+
+    def scan_items(self, **scan_kwargs):
+        """ Scans the whole table, following LastEvaluatedKey across
+            all pages of at most 1 MB.
+
+            Args:
+                scan_kwargs: keyword arguments for the boto3 scan,
+                    for example ProjectionExpression.
+
+            Yields:
+                (dict): each item in the table.
+        """
+        table = self.get_table()
+        while True:
+            page = table.scan(**scan_kwargs)
+            for item in page['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in page:
+                break
+            scan_kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    def query_items(self, **query_kwargs):
+        """ Queries the table, following LastEvaluatedKey across all
+            pages of at most 1 MB.
+
+            Args:
+                query_kwargs: keyword arguments for the boto3 query,
+                    for example IndexName and KeyConditionExpression.
+
+            Yields:
+                (dict): each item matching the query.
         """
-        dynamodb = boto3.resource('dynamodb', region_name='TODO')
-        return dynamodb.Table(self.db_name)
+        table = self.get_table()
+        while True:
+            page = table.query(**query_kwargs)
+            for item in page['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in page:
+                break
+            query_kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
 
     def get_prompt_item(self, p_bias=0.1):
         """ Get method for images in ML-PRJ prompt image Database.
@@ -101,12 +168,59 @@ class PMLDatabase:
         self.get_table().put_item(Item=item)
         return True
 
-    def get_all_items(self):
+    def post_new_item_in_db(self, item, key_name='id'):
+        """ Posts <item> in the database only if no item with the same
+            key exists yet. The check and the write are a single
+            conditional put, so of several concurrent posts of the same
+            key exactly one succeeds.
+
+            Args:
+                item (dict): as in post_item_in_db().
+                key_name (str): the primary key of the database. The
+                    default is 'id'.
+
+            Returns:
+                (bool): True if the item was posted, or False if the
+                    key is already in use.
         """
+        try:
+            self.get_table().put_item(
+                Item=item,
+                ConditionExpression=Attr(key_name).not_exists(),
+            )
+        except Exception as e:
+            if get_error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def has_label(self, label):
+        """ Checks if any item has the label <label>, with a single
+            query of the 'label' index.
+
+            Args:
+                label (str): name of the label.
+
+            Returns:
+                (bool): True if an item with the label exists.
         """
-        items = self.get_table().scan(
-            ProjectionExpression='id, label',
+        items = self.get_table().query(
+            IndexName='label',
+            ProjectionExpression='label',
+            KeyConditionExpression=Key('label').eq(label),
+            Limit=1,
         )['Items']
+        return len(items) > 0
+
+    def get_all_items(self):
+        """ Gets the filename and label of every item in the database.
+
+            Returns:
+                (tuple): (filenames (list(str)), labels (list(str)))
+        """
+        items = self.export_items(
+            ProjectionExpression='id, label',
+        )
 
         filenames = []
         labels = []
@@ -115,6 +229,103 @@ class PMLDatabase:
             labels.append(item['label'])
         return (filenames, labels)
 
+    def export_items(self, total_segments=8, max_workers=None,
+                     retries=8, **scan_kwargs):
+        """ Bulk export of the whole table with a parallel segmented
+            scan. Each of <total_segments> segments is scanned by a
+            worker thread, throttled pages are retried with exponential
+            backoff, and items are streamed out as the pages arrive. The
+            rows per second are printed and kept in <self.export_stats>.
+
+            Args:
+                total_segments (int): the number of segments the table
+                    is split into. The default is 8.
+                max_workers (int): the number of worker threads. The
+                    default is <total_segments>.
+                retries (int): the largest number of retries of a page.
+                    The default is 8.
+                scan_kwargs: keyword arguments for the boto3 scan,
+                    for example ProjectionExpression.
+
+            Yields:
+                (dict): each item in the table, in no particular order.
+        """
+        if max_workers is None:
+            max_workers = total_segments
+        pages = queue.Queue(maxsize=2 * max_workers)
+        stop = threading.Event()
+        done = object()
+        stats = {'retries': 0}
+
+        def count_retry(e):
+            if not is_retryable(e):
+                return False
+            stats['retries'] += 1
+            return True
+
+        def put(page):
+            # does not block forever if the consumer stopped reading
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def scan_segment(segment):
+            try:
+                table = self.get_table()
+                kwargs = dict(scan_kwargs, Segment=segment,
+                              TotalSegments=total_segments)
+                while not stop.is_set():
+                    page = retry_call(
+                        lambda: table.scan(**kwargs),
+                        retries=retries,
+                        should_retry=count_retry)
+                    if not put(page['Items']):
+                        return
+                    if 'LastEvaluatedKey' not in page:
+                        break
+                    kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+                put(done)
+            except Exception as e:
+                put(e)
+
+        start_time = time.time()
+        n_rows = 0
+        executor = ThreadPoolExecutor(max_workers)
+        try:
+            for segment in range(total_segments):
+                executor.submit(scan_segment, segment)
+            n_done = 0
+            while n_done < total_segments:
+                page = pages.get()
+                if page is done:
+                    n_done += 1
+                    continue
+                if isinstance(page, Exception):
+                    raise page
+                for item in page:
+                    yield item
+                n_rows += len(page)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+        seconds = time.time() - start_time
+        self.export_stats = {
+            'rows': n_rows,
+            'seconds': seconds,
+            'rows_per_second': n_rows / max(seconds, 1e-9),
+            'retries': stats['retries'],
+        }
+        print('exported %d rows from %s in %.2f s (%.0f rows/s, '
+              '%d segments, %d retries)' % (
+                  n_rows, self.db_name, seconds,
+                  self.export_stats['rows_per_second'], total_segments,
+                  stats['retries']))
+
     def get_attr_count_map(self, attr):
         """ Gets a dictionary mapping an attribute to the number of
             times each of it's specific values occurs in the database.
@@ -123,7 +334,7 @@ class PMLDatabase:
              {'id': 2, 'filename':'file2'},
              {'id': 3, 'filename':'file1'},]
             and <attr> is 'filename' then this method would return:
-            {'file1': 2, 'file2': 1}
+            {'file1': {'count': 2}, 'file2': {'count': 1}}
 
             Args:
                 attr (str): the attribute.
@@ -132,58 +343,298 @@ class PMLDatabase:
                 (dict): dictionary mapping all values of the given
                 attribute to the number of times they occur in the
                 database. For example:
-                {'attr_val1': 1,'attr_val2': 7,'attr_val3': 13,}
+                {'attr_val1': {'count': 1}, 'attr_val2': {'count': 7},}
         """
-        scan = self.get_table().scan(
-            ProjectionExpression=attr,
-        )['Items']
-        attrs = [scan[i][attr] for i in range(len(scan))]
-        dict_map = dict(zip(attrs, map(attrs.count, attrs)))
+        counts = self.count_attrs([attr])[attr]
         count_dict = {}
-        for key in dict_map.keys():
-            count_dict[key] = {"count": dict_map[key]}
+        for key in counts.keys():
+            count_dict[key] = {"count": counts[key]}
 
         return count_dict
 
+    def count_attrs(self, attrs, projection=None):
+        """ Counts the values of several attributes in a single scan of
+            all pages of the table. Items are counted as the pages
+            stream in, so memory only grows with the number of distinct
+            values, not with the number of items.
+
+            Args:
+                attrs (list(str)): the attributes to count.
+                projection (str): the ProjectionExpression of the scan.
+                    The default only reads <attrs>.
+
+            Returns:
+                (dict): dictionary mapping each attribute to a Counter
+                of its values. For example, with <attrs> equal to
+                ['label', 'username']:
+                {'label': Counter({'circle': 12, 'square': 7}),
+                 'username': Counter({'user1': 15, 'user2': 4})}
+        """
+        if projection is None:
+            projection = ', '.join(attrs)
+        counts = dict((attr, Counter()) for attr in attrs)
+        for item in self.scan_items(ProjectionExpression=projection):
+            for attr in attrs:
+                if attr in item:
+                    counts[attr][item[attr]] += 1
+        return counts
+
     def get_rand_item(self):
-        """ Gets a random item from the
+        """ Gets a random item from the table, or from the items of
+            <self.modename>. This reads every matching item; the web
+            services use PMLPromptCatalog instead.
         """
         if self.modename == 'all':
-            items = self.get_table().scan(
+            items = list(self.scan_items(
                 ProjectionExpression='filename, label'
-            )['Items']
+            ))
 
         else:
             primary_key = 'modename'
-            items = self.get_table()\
-                .query(
+            items = list(self.query_items(
                 IndexName=primary_key,
                 ProjectionExpression='filename, label',
                 KeyConditionExpression=Key(primary_key).eq(self.modename),
-            )['Items']
+            ))
 
         rand_index = randint(0, len(items) - 1)
 
         return items[rand_index]
 
-    def remove_items(self, key_name, values):
-        """TODO: this method currently does not work, and
-            items will have to be manually deleted from the database.
+    def remove_items(self, key_name, values, max_workers=4, retries=8):
+        """ Removes, from the database, the items with the keys
+            <values>. See delete_items().
+
+            Returns:
+                bool: True if all items were deleted, otherwise False.
         """
-        table = self.get_table()
-        count = 0
+        outcome = self.delete_items(key_name, values,
+                                    max_workers=max_workers,
+                                    retries=retries)
+        print('%d items deleted from the database, %d failed' % (
+            len(outcome['deleted']), len(outcome['errors'])))
+        return len(outcome['errors']) == 0
+
+    def delete_items(self, key_name, values, max_workers=4, retries=8):
+        """ Bulk delete of the items with the keys <values>, in
+            batch_write_item requests of 25 keys (the DynamoDB limit)
+            sent by <max_workers> threads. Unprocessed keys and
+            throttled requests are retried with exponential backoff.
+            Deleting a key that does not exist is not an error, and a
+            key given several times is deleted once, as DynamoDB
+            rejects a batch that holds the same key twice.
+
+            Args:
+                key_name (str): the primary key of the database.
+                values (list(str)): the keys of the items to delete.
+                max_workers (int): the number of threads. The default
+                    is 4.
+                retries (int): the largest number of retries of a
+                    batch. The default is 8.
+
+            Returns:
+                (dict): the outcome of each key, formatted like:
+                {
+                    "deleted": [<key>, ...],
+                    "errors": {<key>: <error message>, ...}
+                }
+        """
+        unique_values, seen = [], set()
         for value in values:
-            #########################################
-            # items are not being deleted:
-            table.delete_item(Key={key_name: value})
-            #########################################
-            print('db item deleted')
-            count += 1
-
-        print(str(count) + ' items deleted from the database')
+            if value not in seen:
+                seen.add(value)
+                unique_values.append(value)
+        values = unique_values
+        chunks = [values[i:i + 25] for i in range(0, len(values), 25)]
+
+        def delete_chunk(chunk):
+            client = self.get_table().meta.client
+            requests = [{'DeleteRequest': {'Key': {key_name: value}}}
+                        for value in chunk]
+            pending = {'requests': requests}
+
+            def write():
+                response = client.batch_write_item(
+                    RequestItems={self.db_name: pending['requests']})
+                unprocessed = response.get(
+                    'UnprocessedItems', {}).get(self.db_name, [])
+                if unprocessed:
+                    pending['requests'] = unprocessed
+                    raise PMLUnprocessedItemsError(len(unprocessed))
+                return True
+
+            try:
+                retry_call(write, retries=retries,
+                           should_retry=lambda e: (
+                               isinstance(e, PMLUnprocessedItemsError) or
+                               is_retryable(e)))
+            except Exception as e:
+                failed = set(request['DeleteRequest']['Key'][key_name]
+                             for request in pending['requests'])
+                return ([value for value in chunk if value not in failed],
+                        dict((value, str(e)) for value in failed))
+            return chunk, {}
+
+        outcome = {'deleted': [], 'errors': {}}
+        executor = ThreadPoolExecutor(max_workers)
+        try:
+            for deleted, errors in executor.map(delete_chunk, chunks):
+                outcome['deleted'].extend(deleted)
+                outcome['errors'].update(errors)
+        finally:
+            executor.shutdown(wait=True)
+        return outcome
+
+    def get_new_id(self, created_at=None):
+        """ Gets a new, time-ordered id. The id starts with the creation
+            time in milliseconds, zero padded, so ids sort by the time
+            they were created, followed by 12 random hex digits, so ids
+            created at the same millisecond do not collide.
+
+            Args:
+                created_at (int): the creation time in milliseconds
+                    since the epoch, as returned by get_created_at().
+                    The default is the current time.
+
+            Returns:
+                (str): the id, for example '1508323200000-3f2a9c0d1b7e'.
+        """
+        if created_at is None:
+            created_at = self.get_created_at()
+        return '%013d-%s' % (created_at, uuid.uuid4().hex[:12])
+
+    def get_created_at(self):
+        """
+            Returns:
+                (int): the current time in milliseconds since the epoch,
+                    stored in the 'created_at' attribute of new items.
+        """
+        return int(time.time() * 1000)
+
+    def get_created_day(self, created_at):
+        """
+            Returns:
+                (str): the UTC day of <created_at> (milliseconds), for
+                    example '2017-10-18', stored in the 'created_day'
+                    attribute of new items.
+        """
+        return time.strftime('%Y-%m-%d', time.gmtime(created_at / 1000.))
+
+    def create_created_index(self, index_name=CREATED_INDEX_NAME,
+                             read_capacity=5, write_capacity=5):
+        """ Creates the global secondary index on the partition key
+            'created_day' and the sort key 'created_at', with the
+            attribute 'label', used by get_items_since(). DynamoDB
+            fills the index from the existing items in the background;
+            it can be queried once has_index() returns True.
+
+            Args:
+                index_name (str): name of the index. The default is
+                    CREATED_INDEX_NAME.
+                read_capacity (int): the provisioned read capacity units
+                    of the index. The default is 5.
+                write_capacity (int): the provisioned write capacity
+                    units of the index. The default is 5.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        self.get_table().meta.client.update_table(
+            TableName=self.db_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'created_day', 'AttributeType': 'S'},
+                {'AttributeName': 'created_at', 'AttributeType': 'N'},
+            ],
+            GlobalSecondaryIndexUpdates=[{'Create': {
+                'IndexName': index_name,
+                'KeySchema': [
+                    {'AttributeName': 'created_day', 'KeyType': 'HASH'},
+                    {'AttributeName': 'created_at', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['label'],
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': read_capacity,
+                    'WriteCapacityUnits': write_capacity,
+                },
+            }}])
+        print('creating the index %s of %s' % (index_name, self.db_name))
         return True
 
-    def get_new_id(self):
-        """ # todo: implement so collisions are avoided
+    def has_index(self, index_name):
         """
-        return str(randint(0, 10**12))
+            Returns:
+                (bool): True if the global secondary index <index_name>
+                    exists and can be queried.
+        """
+        description = self.get_table().meta.client.describe_table(
+            TableName=self.db_name)['Table']
+        for index in description.get('GlobalSecondaryIndexes', []):
+            if index['IndexName'] == index_name:
+                return index.get('IndexStatus', 'ACTIVE') == 'ACTIVE'
+        return False
+
+    def get_items_since(self, created_at, index_name=None,
+                        projection='id, label, created_at'):
+        """ Gets the items created after <created_at>. Items written
+            before the 'created_at' attribute existed are never
+            returned.
+
+            Args:
+                created_at (int): milliseconds since the epoch.
+                index_name (str): name of a global secondary index with
+                    the partition key 'created_day' and the sort key
+                    'created_at', as created by create_created_index().
+                    If given, only the days since <created_at> are
+                    queried, so the read cost grows with the new items
+                    only. The default is None, in which case the whole
+                    table is scanned and paid for, with a filter.
+                projection (str): the ProjectionExpression. The default
+                    is 'id, label, created_at'.
+
+            Yields:
+                (dict): each item created after <created_at>.
+        """
+        if index_name is None:
+            print('WARNING: scanning all of %s for the items created '
+                  'since %d, as no index was given' % (
+                      self.db_name, created_at))
+            for item in self.export_items(
+                    ProjectionExpression=projection,
+                    FilterExpression=Attr('created_at').gt(created_at)):
+                yield item
+            return
+
+        day_ms = 24 * 60 * 60 * 1000
+        day = created_at - created_at % day_ms
+        while day <= self.get_created_at():
+            for item in self.query_items(
+                    IndexName=index_name,
+                    ProjectionExpression=projection,
+                    KeyConditionExpression=(
+                        Key('created_day').eq(self.get_created_day(day)) &
+                        Key('created_at').gt(created_at))):
+                yield item
+            day += day_ms
+
+
+class PMLUnprocessedItemsError(Exception):
+    """ Raised by PMLDatabase.delete_items() when a batch_write_item
+        request returns unprocessed items, so they are retried.
+    """
+
+    def __init__(self, n_unprocessed):
+        Exception.__init__(
+            self, '%d items were not processed' % (n_unprocessed))
+        self.n_unprocessed = n_unprocessed
+
+
+if __name__ == '__main__':
+    db_name_collect = 'TODO'
+
+    # one-time setup of the index of the incremental training data
+    # download (PMLData.download_train_data(incremental=True)):
+    PMLDatabase(db_name_collect).create_created_index()
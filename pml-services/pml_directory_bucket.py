@@ -0,0 +1,256 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from botocore.exceptions import ClientError
+from datetime import datetime
+from io import BytesIO
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+
+class PMLDirectoryBucket:
+    """ Project Mona Lisa Directory Bucket class. A local stand-in for a
+        boto3 S3 Bucket, that stores each object as a file in
+        <storage_dir>/<name>/<key>. It supports the parts of the Bucket
+        API used by PMLStorage and the jobs built on it: Object().get()
+        (with Range and IfNoneMatch), put_object, upload_file,
+        download_file, delete_objects and objects.all()/filter().
+
+        Objects are written to a temporary file and renamed, so readers
+        never see a partial object. ETags are the MD5 of the content,
+        like the ETags of S3 objects that were not uploaded in parts.
+    """
+
+    def __init__(self, storage_dir, name):
+        """
+            Args:
+                storage_dir (str): the directory of all buckets.
+                name (str): name of the bucket.
+        """
+        self.name = name
+        self.root_dir = os.path.abspath('%s/%s' % (storage_dir, name))
+        self.tmp_dir = os.path.abspath('%s/.tmp' % (storage_dir))
+        for directory in (self.root_dir, self.tmp_dir):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another process
+                    pass
+        self.objects = PMLDirectoryObjects(self)
+        # path -> (modification time, size, ETag):
+        self.etags = {}
+        self.etags_lock = threading.Lock()
+
+    def get_path(self, key):
+        """ Helper function.
+
+            Returns:
+                (str): the path of the file of the object <key>.
+        """
+        path = os.path.abspath(os.path.join(self.root_dir, key))
+        if not path.startswith(self.root_dir + os.sep):
+            raise ClientError({'Error': {
+                'Code': 'InvalidArgument',
+                'Message': 'Invalid key %s' % (key)}}, 'PutObject')
+        return path
+
+    def get_etag(self, path):
+        """ Helper function. Gets the ETag of a file, computing it only
+            when the file changed.
+
+            Returns:
+                (str): the ETag, without quotes.
+        """
+        file_stat = os.stat(path)
+        with self.etags_lock:
+            cached = self.etags.get(path)
+        if cached is not None and \
+                cached[:2] == (file_stat.st_mtime, file_stat.st_size):
+            return cached[2]
+        md5 = hashlib.md5()
+        with open(path, 'rb') as object_file:
+            for chunk in iter(lambda: object_file.read(1024 * 1024), b''):
+                md5.update(chunk)
+        etag = md5.hexdigest()
+        with self.etags_lock:
+            self.etags[path] = (file_stat.st_mtime, file_stat.st_size, etag)
+        return etag
+
+    def write(self, key, source):
+        """ Helper function. Writes the object <key> from <source>, a
+            file-like object, through a temporary file.
+        """
+        path = self.get_path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        tmp_path = '%s/%s' % (self.tmp_dir, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as tmp_file:
+            shutil.copyfileobj(source, tmp_file)
+        os.rename(tmp_path, path)
+        return True
+
+    def Object(self, key):
+        """ Same as boto3 Bucket.Object().
+        """
+        return PMLDirectoryObject(self, key)
+
+    def put_object(self, Key, Body, **kwargs):
+        """ Same as boto3 Bucket.put_object(). <Body> can be bytes, a
+            string or a file-like object.
+        """
+        if isinstance(Body, type(u'')):
+            Body = Body.encode('utf-8')
+        if isinstance(Body, bytes):
+            Body = BytesIO(Body)
+        self.write(Key, Body)
+        return self.Object(Key)
+
+    def upload_file(self, Filename, Key, ExtraArgs=None, Callback=None,
+                    Config=None):
+        """ Same as boto3 Bucket.upload_file().
+        """
+        with open(Filename, 'rb') as source:
+            self.write(Key, source)
+
+    def download_file(self, Key, Filename, ExtraArgs=None, Callback=None,
+                      Config=None):
+        """ Same as boto3 Bucket.download_file().
+        """
+        body = self.Object(Key).get()['Body']
+        with open(Filename, 'wb') as destination:
+            shutil.copyfileobj(body, destination)
+        body.close()
+
+    def delete_objects(self, Delete, **kwargs):
+        """ Same as boto3 Bucket.delete_objects(). Like S3, deleting a
+            key that does not exist is not an error.
+        """
+        response = {'Deleted': [], 'Errors': []}
+        for obj in Delete['Objects']:
+            try:
+                os.remove(self.get_path(obj['Key']))
+            except OSError as e:
+                if os.path.exists(self.get_path(obj['Key'])):
+                    response['Errors'].append({
+                        'Key': obj['Key'],
+                        'Code': 'InternalError',
+                        'Message': str(e),
+                    })
+                    continue
+            response['Deleted'].append({'Key': obj['Key']})
+        return response
+
+
+class PMLDirectoryObject:
+    """ The stand-in of a boto3 S3 Object of a PMLDirectoryBucket.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def get(self, Range=None, IfNoneMatch=None, **kwargs):
+        """ Same as boto3 Object.get().
+        """
+        path = self.bucket.get_path(self.key)
+        if not os.path.isfile(path):
+            raise ClientError({'Error': {
+                'Code': 'NoSuchKey',
+                'Message': 'The specified key does not exist.'}},
+                'GetObject')
+        etag = '"%s"' % (self.bucket.get_etag(path))
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise ClientError({'Error': {
+                'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+
+        size = os.path.getsize(path)
+        body = open(path, 'rb')
+        if Range is not None:
+            # 'bytes=<first>-<last>'
+            first, last = Range[len('bytes='):].split('-')
+            first = int(first)
+            last = min(int(last), size - 1)
+            body.seek(first)
+            data = body.read(last - first + 1)
+            body.close()
+            body = BytesIO(data)
+            size = len(data)
+        return {
+            'Body': body,
+            'ETag': etag,
+            'ContentLength': size,
+            'LastModified': datetime.utcfromtimestamp(
+                os.path.getmtime(path)),
+        }
+
+    def put(self, Body, **kwargs):
+        """ Same as boto3 Object.put().
+        """
+        self.bucket.put_object(Key=self.key, Body=Body)
+        return {'ETag': '"%s"' % (self.bucket.get_etag(
+            self.bucket.get_path(self.key)))}
+
+    def delete(self, **kwargs):
+        """ Same as boto3 Object.delete().
+        """
+        return self.bucket.delete_objects(
+            Delete={'Objects': [{'Key': self.key}]})
+
+
+class PMLDirectoryObjects:
+    """ The stand-in of the 'objects' collection of a boto3 Bucket.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def all(self):
+        """ Same as boto3 Bucket.objects.all().
+        """
+        return self.filter()
+
+    def filter(self, Prefix=''):
+        """ Same as boto3 Bucket.objects.filter(), for a <Prefix>.
+
+            Yields:
+                (PMLDirectoryObjectSummary): each object, ordered by key
+                    like in S3.
+        """
+        root_dir = self.bucket.root_dir
+        keys = []
+        for directory, _, filenames in os.walk(root_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                key = os.path.relpath(path, root_dir).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        for key in sorted(keys):
+            path = os.path.join(root_dir, key)
+            try:
+                yield PMLDirectoryObjectSummary(
+                    key,
+                    os.path.getsize(path),
+                    '"%s"' % (self.bucket.get_etag(path)),
+                    datetime.utcfromtimestamp(os.path.getmtime(path)))
+            except OSError:
+                # deleted while listing
+                continue
+
+
+class PMLDirectoryObjectSummary:
+    """ The stand-in of a boto3 S3 ObjectSummary.
+    """
+
+    def __init__(self, key, size, e_tag, last_modified):
+        self.key = key
+        self.size = size
+        self.e_tag = e_tag
+        self.last_modified = last_modified
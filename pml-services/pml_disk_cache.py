@@ -0,0 +1,250 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import hashlib
+import mmap
+import os
+import threading
+import time
+import uuid
+
+
+class PMLDiskCache:
+    """ Project Mona Lisa Disk Cache class. A size-bounded,
+        content-addressed cache of storage objects on the local disk,
+        that several processes can share.
+
+        The data of an object is kept once per ETag, in
+        <cache_dir>/blobs/, so objects with the same content share an
+        entry. A small ref file per storage key, in <cache_dir>/refs/,
+        holds the ETag the key had when it was last validated; its
+        modification time is the time of that validation. All files
+        are written to a temporary file and renamed, so a reader never
+        sees a partial file. When the blobs exceed <max_bytes>, the
+        least recently used blobs are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2**30, validate_interval=60):
+        """
+            Args:
+                cache_dir (str): the directory of the cache.
+                max_bytes (int): the largest size of the cached data.
+                    The default is 1 GB.
+                validate_interval (float): the number of seconds a
+                    cached object is used without checking that its
+                    ETag is still the ETag in storage. The default is
+                    60.
+        """
+        self.cache_dir = cache_dir
+        self.blobs_dir = '%s/blobs' % (cache_dir)
+        self.refs_dir = '%s/refs' % (cache_dir)
+        self.max_bytes = max_bytes
+        self.validate_interval = validate_interval
+        # bytes written by this process since the last eviction:
+        self.written_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'validations': 0,
+            'evictions': 0,
+        }
+        for directory in (self.blobs_dir, self.refs_dir):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another process
+                    pass
+
+    def get(self, key, fetch, use_mmap=False):
+        """ Read-through get of the storage object <key>.
+
+            Args:
+                key (str): the storage key, unique across buckets, e.g.
+                    '<bucket name>/<filename>'.
+                fetch (function): function that takes the cached ETag,
+                    or None, and returns None if the object in storage
+                    still has that ETag, or otherwise a tuple of
+                    (data (bytes), ETag (str)) of the object.
+                use_mmap (bool): if True, a read-only memory map of the
+                    cached file is returned instead of bytes. The
+                    default is False.
+
+            Returns:
+                (bytes or mmap): the data of the object.
+        """
+        ref_path = self.get_ref_path(key)
+        etag, validated_at = self.get_ref(ref_path)
+        if etag is not None and time.time() - validated_at \
+                > self.validate_interval:
+            self.count('validations')
+            fetched = fetch(etag)
+            if fetched is None:
+                self.set_ref(ref_path, etag)
+            else:
+                self.count('misses')
+                return self.put(ref_path, fetched[1], fetched[0], use_mmap)
+
+        if etag is not None:
+            data = self.read(etag, use_mmap)
+            if data is not None:
+                self.count('hits')
+                return data
+
+        self.count('misses')
+        data, etag = fetch(None)
+        return self.put(ref_path, etag, data, use_mmap)
+
+    def put(self, ref_path, etag, data, use_mmap=False):
+        """ Helper function for get(). Caches <data> under <etag> and
+            points <ref_path> to it.
+
+            Returns:
+                (bytes or mmap): <data>, or a memory map of it if
+                    <use_mmap> is True.
+        """
+        blob_path = self.get_blob_path(etag)
+        if not os.path.isfile(blob_path):
+            blob_dir = os.path.dirname(blob_path)
+            if not os.path.isdir(blob_dir):
+                try:
+                    os.makedirs(blob_dir)
+                except OSError:
+                    pass
+            self.write_file(blob_path, data)
+            with self.lock:
+                self.written_bytes += len(data)
+                evict = self.written_bytes > self.max_bytes // 20
+                if evict:
+                    self.written_bytes = 0
+            if evict:
+                self.evict()
+        self.set_ref(ref_path, etag)
+        if use_mmap:
+            mapped = self.read(etag, use_mmap)
+            if mapped is not None:
+                return mapped
+        return data
+
+    def read(self, etag, use_mmap=False):
+        """ Helper function. Reads the cached data of <etag>, and marks
+            it as recently used.
+
+            Returns:
+                (bytes or mmap): the data, or None if it is not cached.
+        """
+        blob_path = self.get_blob_path(etag)
+        try:
+            with open(blob_path, 'rb') as blob_file:
+                os.utime(blob_path, None)
+                if not use_mmap:
+                    return blob_file.read()
+                if os.fstat(blob_file.fileno()).st_size == 0:
+                    # an empty file can not be memory mapped
+                    return b''
+                return mmap.mmap(blob_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            # not cached, or evicted by another process
+            return None
+
+    def evict(self):
+        """ Removes the least recently used blobs until the cached data
+            is at most 90% of <self.max_bytes>.
+
+            Returns:
+                (int): the number of evicted blobs.
+        """
+        blobs = []
+        total_bytes = 0
+        for directory, _, filenames in os.walk(self.blobs_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    blob_stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((blob_stat.st_mtime, blob_stat.st_size, path))
+                total_bytes += blob_stat.st_size
+        if total_bytes <= self.max_bytes:
+            return 0
+
+        n_evicted = 0
+        target_bytes = self.max_bytes * 0.9
+        for _, size, path in sorted(blobs):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            n_evicted += 1
+        self.count('evictions', n_evicted)
+        return n_evicted
+
+    def get_ref(self, ref_path):
+        """ Helper function.
+
+            Returns:
+                (tuple): (the cached ETag of a key (str),
+                    time of its last validation (float)), or
+                    (None, None) if the key is not cached.
+        """
+        try:
+            with open(ref_path) as ref_file:
+                etag = ref_file.read()
+            return etag, os.path.getmtime(ref_path)
+        except (IOError, OSError):
+            return None, None
+
+    def set_ref(self, ref_path, etag):
+        """ Helper function. Points a key to <etag>, validated now.
+        """
+        self.write_file(ref_path, etag.encode('utf-8'))
+        return True
+
+    def write_file(self, path, data):
+        """ Helper function. Writes <data> to a temporary file and
+            renames it to <path>.
+        """
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, path)
+        return True
+
+    def get_ref_path(self, key):
+        """
+            Returns:
+                (str): the path of the ref file of the storage key
+                    <key>.
+        """
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return '%s/%s' % (self.refs_dir, digest)
+
+    def get_blob_path(self, etag):
+        """
+            Returns:
+                (str): the path of the cached data with the ETag
+                    <etag>.
+        """
+        # ETags are hex digests, optionally with a '-<n parts>' suffix
+        etag = ''.join(c for c in etag if c.isalnum() or c == '-')
+        return '%s/%s/%s' % (self.blobs_dir, etag[:2], etag)
+
+    def count(self, stat, n=1):
+        """ Helper function. Adds <n> to the counter <stat>.
+        """
+        with self.lock:
+            self.stats[stat] += n
+
+    def get_stats(self):
+        """
+            Returns:
+                (dict): the hits, misses, validations and evictions of
+                    this process.
+        """
+        with self.lock:
+            return dict(self.stats)
@@ -0,0 +1,109 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from random import random
+import time
+
+from pml_database import PMLDatabase
+
+
+class PMLFakeThrottleError(Exception):
+    """ Error raised by PMLFakeTable when a page is throttled. It has
+        the same 'response' attribute as a botocore ClientError.
+    """
+
+    def __init__(self):
+        Exception.__init__(self, 'The fake table throttled the request')
+        self.response = {
+            'Error': {'Code': 'ProvisionedThroughputExceededException'}
+        }
+
+
+class PMLFakeTable:
+    """ Project Mona Lisa Fake Table class. An in-memory stand-in for a
+        boto3 DynamoDB table that supports the parts of scan() used by
+        PMLDatabase: pages, Limit, ExclusiveStartKey, ProjectionExpression
+        and parallel Segment/TotalSegments. It can add latency to every
+        page and throttle a share of the pages, so bulk reads can be
+        benchmarked without AWS.
+    """
+
+    def __init__(self, items, key_name='id', page_size=100, latency=0.,
+                 throttle_rate=0.):
+        """
+            Args:
+                items (list(dict)): the items of the table.
+                key_name (str): the primary key. The default is 'id'.
+                page_size (int): the number of items per page. The
+                    default is 100.
+                latency (float): seconds added to every page. The
+                    default is 0.
+                throttle_rate (float): the probability that a page
+                    raises PMLFakeThrottleError. The default is 0.
+        """
+        self.items = items
+        self.key_name = key_name
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        # segment -> (items of the segment, key -> position), per
+        # number of segments:
+        self.segments = {}
+
+    def get_segment(self, segment, total_segments):
+        """ Helper function. Gets the items of a segment and their
+            positions.
+        """
+        if total_segments not in self.segments:
+            segments = []
+            for i_segment in range(total_segments):
+                seg_items = self.items[i_segment::total_segments]
+                positions = dict(
+                    (item[self.key_name], i_item)
+                    for i_item, item in enumerate(seg_items))
+                segments.append((seg_items, positions))
+            # assigned at once, as worker threads scan concurrently
+            self.segments[total_segments] = segments
+        return self.segments[total_segments][segment]
+
+    def scan(self, **kwargs):
+        """ Same as the boto3 DynamoDB Table.scan(). """
+        if self.latency:
+            time.sleep(self.latency)
+        if random() < self.throttle_rate:
+            raise PMLFakeThrottleError()
+
+        seg_items, positions = self.get_segment(
+            kwargs.get('Segment', 0), kwargs.get('TotalSegments', 1))
+        start = 0
+        if 'ExclusiveStartKey' in kwargs:
+            start = positions[kwargs['ExclusiveStartKey'][self.key_name]] + 1
+        end = start + min(kwargs.get('Limit', self.page_size),
+                          self.page_size)
+        page_items = seg_items[start:end]
+
+        if 'ProjectionExpression' in kwargs:
+            attrs = [attr.strip() for attr in
+                     kwargs['ProjectionExpression'].split(',')]
+            page_items = [dict((attr, item[attr]) for attr in attrs
+                               if attr in item) for item in page_items]
+
+        page = {'Items': page_items, 'Count': len(page_items)}
+        if end < len(seg_items):
+            page['LastEvaluatedKey'] = {
+                self.key_name: seg_items[end - 1][self.key_name]}
+        return page
+
+
+if __name__ == '__main__':
+    # benchmark the parallel export against a fake table with 10 ms of
+    # latency per page and 5% throttled pages:
+    items = [{'id': str(i), 'label': 'label%d' % (i % 17)}
+             for i in range(100000)]
+    table = PMLFakeTable(items, latency=0.01, throttle_rate=0.05)
+    database = PMLDatabase('fake', table=table)
+    for total_segments in (1, 4, 16):
+        n_rows = sum(1 for _ in database.export_items(
+            ProjectionExpression='id, label',
+            total_segments=total_segments))
+        assert n_rows == len(items)
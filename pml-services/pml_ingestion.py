@@ -0,0 +1,345 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import atexit
+import base64
+import errno
+import json
+import os
+import threading
+
+from pml_database import PMLDatabase
+from pml_storage import PMLStorage
+from pml_counts import PMLCounts
+from pml_retry import retry_call
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+class PMLIngestionQueue:
+    """ Project Mona Lisa Ingestion Queue class. Write-behind queue for
+        collected sketches: a request only enqueues the sketch, and a
+        pool of background workers writes the sketches in batches to
+        storage, to the database with a batch writer, and to the
+        counts. The queue is bounded, failed writes are retried, and
+        sketches that could not be written, or were still queued at
+        shutdown, are spilled to disk and queued again at the next
+        start.
+    """
+
+    def __init__(self, db_name, storage_name, counts_db_name=None,
+                 spill_dir=None, max_depth=1000, n_workers=4,
+                 batch_size=25, retries=5):
+        """
+            Args:
+                db_name (str): name of the collect database.
+                storage_name (str): name of the collect storage.
+                counts_db_name (str): name of the counts database, or
+                    None to not update counts. The default is None.
+                spill_dir (str): directory where unwritten sketches are
+                    spilled, or None to not spill. The default is None.
+                max_depth (int): the largest number of queued sketches.
+                    The default is 1000.
+                n_workers (int): the number of worker threads. The
+                    default is 4.
+                batch_size (int): the largest number of sketches a
+                    worker writes at once. The default is 25, the
+                    largest DynamoDB batch write.
+                retries (int): the number of retries of a failed write.
+                    The default is 5.
+        """
+        self.db_name = db_name
+        self.storage_name = storage_name
+        self.counts_db_name = counts_db_name
+        self.spill_dir = spill_dir
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.pending = queue.Queue(maxsize=max_depth)
+        self.stop = threading.Event()
+        self.workers = []
+        self.stats = {'written': 0, 'failed': 0, 'spilled': 0}
+        self.stats_lock = threading.Lock()
+
+    def start(self):
+        """ Queues the sketches spilled by earlier runs, and starts the
+            worker threads.
+
+            Returns:
+                (bool) True if successful.
+        """
+        self.load_spilled()
+        for _ in range(self.n_workers):
+            worker = threading.Thread(target=self.run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        atexit.register(self.shutdown)
+        return True
+
+    def enqueue(self, item, img):
+        """ Queues a sketch to be written.
+
+            Args:
+                item (dict): the meta-data to post in the database.
+                img (bytes): the png image data to post in storage.
+
+            Returns:
+                (bool): True if the sketch was queued, or False if the
+                    queue is full.
+        """
+        try:
+            self.pending.put_nowait((item, img))
+            return True
+        except queue.Full:
+            return False
+
+    def get_depth(self):
+        """
+            Returns:
+                (int): the number of queued sketches.
+        """
+        return self.pending.qsize()
+
+    def next_batch(self):
+        """ Helper function for run_worker(). Waits for a sketch, then
+            takes more queued sketches up to <self.batch_size>.
+
+            Returns:
+                list(tuple): (item, img) pairs, empty when stopping.
+        """
+        batch = []
+        while not batch and not self.stop.is_set():
+            try:
+                batch.append(self.pending.get(timeout=0.5))
+            except queue.Empty:
+                continue
+        while batch and len(batch) < self.batch_size:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run_worker(self):
+        """ Loop of a worker thread. """
+        while not self.stop.is_set():
+            batch = self.next_batch()
+            if batch:
+                self.flush(batch)
+
+    def flush(self, batch):
+        """ Writes a batch of sketches: the images to storage first, so
+            a database item never points to a missing image, then the
+            items to the database and the counts. Sketches that fail
+            after all retries are spilled to disk.
+
+            Args:
+                batch (list(tuple)): (item, img) pairs.
+
+            Returns:
+                (bool): True if the whole batch was written.
+        """
+        storage = PMLStorage(self.storage_name)
+        stored = []
+        for item, img in batch:
+            try:
+                retry_call(
+                    lambda: storage.post_item_in_storage(item['id'], img),
+                    retries=self.retries)
+                stored.append((item, img))
+            except Exception as e:
+                print('failed to store sketch %s: %s' % (item['id'], e))
+                self.spill([(item, img)], failed=True)
+
+        if not stored:
+            return False
+        try:
+            retry_call(lambda: self.write_items(stored),
+                       retries=self.retries)
+        except Exception as e:
+            print('failed to write %d sketches: %s' % (len(stored), e))
+            self.spill(stored, failed=True)
+            return False
+
+        if self.counts_db_name is not None:
+            counts = PMLCounts(self.counts_db_name)
+            for item, _ in stored:
+                try:
+                    retry_call(lambda: counts.increment(item),
+                               retries=self.retries)
+                except Exception as e:
+                    # the sketch is stored; the counts can be rebuilt
+                    print('failed to count sketch %s: %s' % (item['id'], e))
+
+        with self.stats_lock:
+            self.stats['written'] += len(stored)
+        return len(stored) == len(batch)
+
+    def write_items(self, stored):
+        """ Helper function for flush(). Posts the items in the database
+            with a batch writer, which also resends unprocessed items.
+        """
+        table = PMLDatabase(self.db_name).get_table()
+        with table.batch_writer() as writer:
+            for item, _ in stored:
+                writer.put_item(Item=item)
+        return True
+
+    def spill(self, batch, failed=False):
+        """ Appends sketches to a spill file in <self.spill_dir>, one
+            json object per line, so they are queued again by the next
+            start().
+
+            Args:
+                batch (list(tuple)): (item, img) pairs.
+                failed (bool): True if the sketches failed to be
+                    written, otherwise they are spilled at shutdown.
+
+            Returns:
+                (bool): True if the sketches were spilled.
+        """
+        with self.stats_lock:
+            self.stats['failed' if failed else 'spilled'] += len(batch)
+        if self.spill_dir is None or not batch:
+            return False
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        spill_path = '%s/ingest-%d-%d.jsonl' % (
+            self.spill_dir, os.getpid(), threading.current_thread().ident)
+        with open(spill_path, 'a') as spill_file:
+            for item, img in batch:
+                spill_file.write(json.dumps({
+                    'item': item,
+                    'img': base64.b64encode(img).decode('ascii'),
+                    'failed': failed,
+                }) + '\n')
+        return True
+
+    def load_spilled(self):
+        """ Queues the sketches in the spill files of <self.spill_dir>.
+            Each file is first renamed, so when several processes share
+            the spill directory only one of them queues it, and is only
+            removed once its sketches are queued or spilled again. The
+            files claimed by a process that is no longer running are
+            claimed again. Lines that can not be decoded, such as the
+            last line of a spill interrupted by a crash, are skipped.
+
+            The sketches are stamped again with the current time, see
+            restamp(), so the next incremental download of the training
+            data, which only reads the items created since the last one,
+            does not miss them.
+
+            Returns:
+                (int): the number of queued sketches.
+        """
+        if self.spill_dir is None or not os.path.isdir(self.spill_dir):
+            return 0
+        count = 0
+        n_skipped = 0
+        for filename in os.listdir(self.spill_dir):
+            spill_path = '%s/%s' % (self.spill_dir, filename)
+            if filename.endswith('.claimed'):
+                # <spill file>.<pid>.claimed
+                original_path, pid, _ = spill_path.rsplit('.', 2)
+                if not pid.isdigit() or int(pid) == os.getpid() or \
+                        self.is_running(int(pid)):
+                    continue
+            elif filename.endswith('.jsonl'):
+                original_path = spill_path
+            else:
+                continue
+            claimed_path = '%s.%d.claimed' % (original_path, os.getpid())
+            try:
+                os.rename(spill_path, claimed_path)
+            except OSError:
+                continue  # claimed by another process
+            with open(claimed_path) as spill_file:
+                lines = [line for line in spill_file if line.strip()]
+            unqueued = []
+            for line in lines:
+                try:
+                    spilled = json.loads(line)
+                    img = base64.b64decode(spilled['img'])
+                    item = self.restamp(
+                        spilled['item'], spilled.get('failed', True))
+                except (ValueError, TypeError, KeyError):
+                    n_skipped += 1
+                    continue
+                if self.enqueue(item, img):
+                    count += 1
+                else:
+                    unqueued.append((item, img))
+            # keep what did not fit in the queue for the next start
+            self.spill(unqueued)
+            os.remove(claimed_path)
+        print('%d spilled sketches queued, %d undecodable lines skipped'
+              % (count, n_skipped))
+        return count
+
+    def is_running(self, pid):
+        """ Helper function for load_spilled().
+
+            Returns:
+                (bool): True if the process <pid> is running.
+        """
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            # EPERM: running, but owned by another user
+            return e.errno == errno.EPERM
+        return True
+
+    def restamp(self, item, failed):
+        """ Helper function for load_spilled(). Sets the 'created_at'
+            and 'created_day' of a spilled sketch to the current time.
+            A sketch spilled at shutdown was never written, so it also
+            gets a new time-ordered id. A sketch that failed to be
+            written keeps its id, as it may already be in storage or
+            in the database, and writing it again must not duplicate
+            it.
+
+            Returns:
+                (dict): the item of the sketch.
+        """
+        if 'created_at' not in item:
+            return item
+        database = PMLDatabase(self.db_name)
+        created_at = database.get_created_at()
+        item = dict(item)
+        item['created_at'] = created_at
+        item['created_day'] = database.get_created_day(created_at)
+        if not failed:
+            item['id'] = database.get_new_id(created_at)
+        return item
+
+    def shutdown(self, timeout=10):
+        """ Stops the workers after their current batch, and spills the
+            sketches that are still queued.
+
+            Args:
+                timeout (float): seconds to wait for each worker. The
+                    default is 10.
+
+            Returns:
+                (bool) True if successful.
+        """
+        if self.stop.is_set():
+            return True
+        self.stop.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        remaining = []
+        while True:
+            try:
+                remaining.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        self.spill(remaining)
+        if remaining:
+            print('%d queued sketches spilled to %s' % (
+                len(remaining), self.spill_dir))
+        return True
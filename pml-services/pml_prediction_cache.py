@@ -0,0 +1,105 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import hashlib
+
+import numpy as np
+from pml_cache import PMLCache
+
+
+class PMLPredictionCache:
+    """ Project Mona Lisa Prediction Cache class. Memoizes predicted
+        labels, keyed by the version of the model and the preprocessed
+        image array that is fed into the model. Predictions of a model
+        version that is no longer in use are not looked up anymore, and
+        are evicted like any other least recently used entry.
+    """
+
+    def __init__(self, max_size=4096, ttl=None, perceptual=False,
+                 hash_dim=16):
+        """
+            Args:
+                max_size (int): the maximum number of cached
+                    predictions. The default is 4096.
+                ttl (float): the number of seconds a prediction is
+                    cached. The default is None, which keeps predictions
+                    until they are evicted.
+                perceptual (bool): if True, images are keyed by an
+                    average hash, so images that differ by only a few
+                    pixels share a cache entry. Otherwise the key is
+                    a hash of the exact image. The default is False.
+                hash_dim (int): the side of the down-sampled image used
+                    by the average hash. The default is 16.
+        """
+        self.cache = PMLCache(max_size, ttl)
+        self.perceptual = perceptual
+        self.hash_dim = hash_dim
+
+    def get_key(self, img_array, model_version):
+        """ Gets the cache key of a preprocessed image.
+
+            Args:
+                img_array (numpy array): image of shape (height, width).
+                model_version (str): version of the model.
+
+            Returns:
+                (tuple): (<model_version>, hex digest of the image)
+        """
+        if self.perceptual:
+            img_array = self.average_hash(img_array)
+        digest = hashlib.sha1(str(img_array.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(img_array).tobytes())
+        return model_version, digest.hexdigest()
+
+    def average_hash(self, img_array):
+        """ Down-samples the image to <self.hash_dim> by
+            <self.hash_dim> blocks, and sets each block to whether it is
+            brighter than the mean of all blocks.
+
+            Args:
+                img_array (numpy array): image of shape (height, width),
+                    where both sides are a multiple of <self.hash_dim>.
+
+            Returns:
+                (numpy array): packed bits of the average hash.
+        """
+        lx, ly = img_array.shape
+        blocks = img_array.reshape(
+            self.hash_dim, lx // self.hash_dim,
+            self.hash_dim, ly // self.hash_dim).mean(axis=(1, 3))
+        return np.packbits(blocks > blocks.mean())
+
+    def get(self, img_array, model_version):
+        """ Gets the cached label of a preprocessed image.
+
+            Args:
+                img_array (numpy array): image of shape (height, width).
+                model_version (str): version of the model in use.
+
+            Returns:
+                (str): the cached label, or None if the image is not
+                    cached for <model_version>.
+        """
+        return self.cache.get(self.get_key(img_array, model_version))
+
+    def set(self, img_array, model_version, label):
+        """ Caches the label predicted for a preprocessed image.
+
+            Args:
+                img_array (numpy array): image of shape (height, width).
+                model_version (str): version of the model that
+                    predicted <label>.
+                label (str): the predicted label.
+
+            Returns:
+                bool: True if successful.
+        """
+        return self.cache.set(
+            self.get_key(img_array, model_version), label)
+
+    def stats(self):
+        """
+            Returns:
+                (dict): the hit and miss counters of the cache.
+        """
+        return self.cache.stats()
@@ -0,0 +1,188 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from random import choice, uniform
+import threading
+import time
+
+from pml_database import PMLDatabase
+
+
+class PMLPromptCatalog:
+    """ Project Mona Lisa Prompt Catalog class. Keeps the prompt table
+        in memory as lists of (filename, label) per training mode and
+        per label, so a random prompt is picked in O(1) without reading
+        the table. The whole table is read again in the background
+        every <refresh_interval> seconds, and new prompts are added as
+        they are posted with add_item().
+    """
+
+    def __init__(self, db_name, refresh_interval=600, sampler=None):
+        """
+            Args:
+                db_name (str): name of the prompt database.
+                refresh_interval (float): the number of seconds after
+                    which the catalog is read again from the database.
+                    The default is 600.
+                sampler (PMLPromptSampler): draws the label of biased
+                    prompts, weighted by how little each label was
+                    collected. The default is None, which always uses
+                    the least collected label from
+                    PMLDatabase.get_bias_label() instead.
+        """
+        self.db_name = db_name
+        self.refresh_interval = refresh_interval
+        self.sampler = sampler
+        # modename -> list of (filename, label), where the modename
+        # 'all' has all prompts:
+        self.items_by_mode = None
+        # label -> list of (filename, label):
+        self.items_by_label = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+        # held by the first load, so the requests that arrive while the
+        # catalog is empty wait for one scan of the table:
+        self.first_load_lock = threading.Lock()
+
+    def load(self):
+        """ Reads all pages of the prompt table and replaces the catalog.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        items_by_mode = {'all': []}
+        items_by_label = {}
+        items = PMLDatabase(self.db_name).scan_items(
+            ProjectionExpression='filename, label, modename')
+        for item in items:
+            self.add_to_lists(item, items_by_mode, items_by_label)
+
+        with self.lock:
+            self.items_by_mode = items_by_mode
+            self.items_by_label = items_by_label
+            self.loaded_at = time.time()
+        if self.sampler is not None:
+            self.sampler.set_labels(items_by_label.keys())
+        return True
+
+    def add_to_lists(self, item, items_by_mode, items_by_label):
+        """ Helper function. Adds <item> to the lists of its mode and
+            label.
+        """
+        entry = (item['filename'], item['label'])
+        items_by_mode['all'].append(entry)
+        if item.get('modename', 'all') != 'all':
+            items_by_mode.setdefault(item['modename'], []).append(entry)
+        items_by_label.setdefault(item['label'], []).append(entry)
+
+    def add_item(self, item):
+        """ Adds a prompt that was just posted in the database, without
+            reading the table again.
+
+            Args:
+                item (dict): the prompt item, with the keys 'filename',
+                    'label' and 'modename'.
+
+            Returns:
+                (bool) True if successful.
+        """
+        with self.lock:
+            if self.items_by_mode is None:
+                return True
+            self.add_to_lists(
+                item, self.items_by_mode, self.items_by_label)
+            labels = list(self.items_by_label.keys())
+        if self.sampler is not None:
+            self.sampler.set_labels(labels)
+        return True
+
+    def check_loaded(self):
+        """ Helper function. Loads the catalog the first time it is
+            used, and starts a background refresh when it is older than
+            <self.refresh_interval> seconds.
+        """
+        if self.items_by_mode is None:
+            with self.first_load_lock:
+                if self.items_by_mode is None:
+                    self.load()
+        elif time.time() - self.loaded_at > self.refresh_interval:
+            with self.lock:
+                if self.refreshing:
+                    return
+                self.refreshing = True
+            refresher = threading.Thread(target=self.refresh)
+            refresher.daemon = True
+            refresher.start()
+
+    def refresh(self):
+        """ Reads the catalog again. Errors are printed and the old
+            catalog is kept, so a failed refresh does not stop prompts
+            from being served.
+        """
+        try:
+            self.load()
+        except Exception as e:
+            print('prompt catalog refresh failed: %s' % (str(e)))
+            self.loaded_at = time.time()
+        finally:
+            self.refreshing = False
+
+    def get_rand_item(self, modename='all'):
+        """ Gets a random prompt of the training mode <modename>.
+
+            Returns:
+                (dict): the item, formatted like:
+                {"filename": "<filename>", "label": "<label>"}
+        """
+        self.check_loaded()
+        entries = self.items_by_mode.get(modename)
+        if not entries:
+            raise ValueError('There are no prompts for the mode: %s'
+                             % (modename))
+        filename, label = choice(entries)
+        return {'filename': filename, 'label': label}
+
+    def get_item_for_label(self, label):
+        """ Gets a random prompt with the label <label>.
+
+            Returns:
+                (dict): the item, formatted like:
+                {"filename": "<filename>", "label": "<label>"}
+        """
+        self.check_loaded()
+        entries = self.items_by_label.get(label)
+        if not entries:
+            raise ValueError('There are no prompts for the label: %s'
+                             % (label))
+        filename, label = choice(entries)
+        return {'filename': filename, 'label': label}
+
+    def get_prompt_item(self, modename='all', p_bias=0.1):
+        """ Same as PMLDatabase.get_prompt_item(), but picks the prompt
+            from the catalog.
+
+            Args:
+                modename (str): the training mode. The default value
+                    is 'all'.
+                p_bias (float): the probability of picking the label
+                    from the bias toward labels with less collected
+                    training data. The default value is 0.1.
+
+            Returns:
+                (dict): the item, formatted like:
+                {"filename": "<filename>", "label": "<label>"}
+        """
+        if (modename == 'all') and (uniform(0, 1) < p_bias):
+            return self.get_item_for_label(self.get_bias_label())
+        return self.get_rand_item(modename)
+
+    def get_bias_label(self):
+        """ Helper function. Draws the label of a biased prompt from
+            <self.sampler>.
+        """
+        if self.sampler is None:
+            return PMLDatabase(self.db_name).get_bias_label()
+        self.check_loaded()
+        return self.sampler.sample()
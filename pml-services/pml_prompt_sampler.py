@@ -0,0 +1,166 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from random import randint, random
+import threading
+import time
+
+
+class PMLPromptSampler:
+    """ Project Mona Lisa Prompt Sampler class. Draws prompt labels with
+        a probability weighted by how far each label is behind the most
+        collected label, so collecting data balances itself. The
+        collected count of each label is kept in memory, updated as
+        sketches are posted, and read again from PMLCounts every
+        <refresh_interval> seconds. Labels are drawn in O(1) with the
+        alias method.
+    """
+
+    def __init__(self, counts, refresh_interval=60, smoothing=1):
+        """
+            Args:
+                counts (PMLCounts): the collected counts.
+                refresh_interval (float): the number of seconds after
+                    which the label counts are read again from
+                    <counts>. The default is 60.
+                smoothing (int): added to the deficit of every label,
+                    so the most collected labels are still drawn
+                    sometimes. The default is 1.
+        """
+        self.counts = counts
+        self.refresh_interval = refresh_interval
+        self.smoothing = smoothing
+        self.labels = []
+        self.label_counts = {}
+        self.loaded_at = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        # alias table, rebuilt when the labels or the counts change:
+        self.alias_table = None
+
+    def set_labels(self, labels):
+        """ Sets the labels that can be drawn, i.e. the labels that have
+            a prompt.
+
+            Returns:
+                (bool) True if successful.
+        """
+        with self.lock:
+            self.labels = sorted(labels)
+            self.alias_table = None
+        return True
+
+    def record(self, label):
+        """ Adds a sketch that was just collected to the in-memory
+            counts.
+
+            Returns:
+                (bool) True if successful.
+        """
+        with self.lock:
+            self.label_counts[label] = self.label_counts.get(label, 0) + 1
+            self.alias_table = None
+        return True
+
+    def load(self):
+        """ Reads the label counts from <self.counts>.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        label_counts = self.counts.get_counts('label')
+        with self.lock:
+            self.label_counts = label_counts
+            self.alias_table = None
+            self.loaded_at = time.time()
+        return True
+
+    def check_loaded(self):
+        """ Helper function. Loads the counts the first time they are
+            used, and starts a background refresh when they are older
+            than <self.refresh_interval> seconds.
+        """
+        if self.loaded_at is None:
+            self.load()
+        elif time.time() - self.loaded_at > self.refresh_interval:
+            with self.lock:
+                if self.refreshing:
+                    return
+                self.refreshing = True
+            refresher = threading.Thread(target=self.refresh)
+            refresher.daemon = True
+            refresher.start()
+
+    def refresh(self):
+        """ Reads the counts again. Errors are printed and the old
+            counts are kept.
+        """
+        try:
+            self.load()
+        except Exception as e:
+            print('prompt sampler refresh failed: %s' % (str(e)))
+            self.loaded_at = time.time()
+        finally:
+            self.refreshing = False
+
+    def get_weights(self):
+        """ Gets the deficit weight of each label: the number of
+            sketches it is behind the most collected label, plus
+            <self.smoothing>.
+
+            Returns:
+                list(int): the weights, in the order of <self.labels>.
+        """
+        counts = [self.label_counts.get(label, 0) for label in self.labels]
+        max_count = max(counts)
+        return [max_count - count + self.smoothing for count in counts]
+
+    def build_alias_table(self):
+        """ Helper function. Builds the alias table of Vose's alias
+            method from the deficit weights, in O(<number of labels>).
+
+            Returns:
+                (tuple): (probabilities (list(float)),
+                    aliases (list(int)))
+        """
+        weights = self.get_weights()
+        n_labels = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * n_labels / total for weight in weights]
+        probs = [1.] * n_labels
+        aliases = list(range(n_labels))
+
+        small = [i for i in range(n_labels) if scaled[i] < 1.]
+        large = [i for i in range(n_labels) if scaled[i] >= 1.]
+        while small and large:
+            i_small = small.pop()
+            i_large = large.pop()
+            probs[i_small] = scaled[i_small]
+            aliases[i_small] = i_large
+            scaled[i_large] -= 1. - scaled[i_small]
+            if scaled[i_large] < 1.:
+                small.append(i_large)
+            else:
+                large.append(i_large)
+        return probs, aliases
+
+    def sample(self):
+        """ Draws a label, weighted by its deficit, in O(1).
+
+            Returns:
+                (str): the label.
+        """
+        self.check_loaded()
+        with self.lock:
+            if not self.labels:
+                raise ValueError('There are no labels to sample from')
+            if self.alias_table is None:
+                self.alias_table = self.build_alias_table()
+            probs, aliases = self.alias_table
+            labels = self.labels
+
+        i_label = randint(0, len(labels) - 1)
+        if random() >= probs[i_label]:
+            i_label = aliases[i_label]
+        return labels[i_label]
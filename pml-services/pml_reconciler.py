@@ -0,0 +1,422 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from pml_counts import PMLCounts
+from pml_database import PMLDatabase
+from pml_storage import PMLStorage
+
+
+class PMLReconciler:
+    """ Project Mona Lisa Reconciler class. Reconciles a collect
+        database, where each item has an 'id', with a collect storage,
+        where each item has an image '<id>.png', in bounded memory.
+
+        Both sides are listed concurrently. Each listing is cut into
+        sorted runs of at most <run_size> ids, written to temporary
+        files, and the runs of each side are streamed back in order with
+        heapq.merge, so the two sides can be compared with a single
+        sorted-merge pass. The orphans, ids on only one side, are
+        written to a json lines diff report, which repair() applies.
+        The database orphans keep their counted attributes in the
+        report, so repair() can take the items it deletes out of the
+        PMLCounts.
+    """
+
+    def __init__(self, db_name, storage_name, report_dir,
+                 run_size=100000, min_age_seconds=3600,
+                 shards_storage_name=None, counts_db_name=None):
+        """
+            Args:
+                db_name (str): name of the collect database.
+                storage_name (str): name of the collect storage.
+                report_dir (str): directory of the diff reports.
+                run_size (int): the largest number of ids sorted in
+                    memory at once. The default is 100000.
+                min_age_seconds (float): items younger than this are
+                    never orphans, as they may still be in the middle of
+                    being written to both sides. The default is 3600.
+                shards_storage_name (str): name of the storage of the
+                    shards written by PMLShardCompactor, from which
+                    repair() restores missing images. The default is
+                    None, in which case nothing is restored.
+                counts_db_name (str): name of the PMLCounts database
+                    of the collect database, from which repair()
+                    subtracts the database items it deletes. The
+                    default is None, in which case the counts are not
+                    updated.
+        """
+        self.db_name = db_name
+        self.storage_name = storage_name
+        self.report_dir = report_dir
+        self.run_size = run_size
+        self.min_age_seconds = min_age_seconds
+        self.shards_storage_name = shards_storage_name
+        self.counts_db_name = counts_db_name
+        self.counted_attrs = ('username', 'label')
+
+    def reconcile(self):
+        """ Lists and compares both sides, and writes the diff report.
+
+            Returns:
+                (dict): the summary, formatted like:
+                {
+                    "report_path": "<path of the diff report>",
+                    "matched": <ids on both sides>,
+                    "db_only": <ids only in the database>,
+                    "storage_only": <ids only in storage>,
+                    "ignored": <storage keys that are not '<id>.png'>,
+                    "seconds": <duration>
+                }
+                Each line of the report is formatted like:
+                {"side": "db" or "storage", "id": "<id>"}
+                where the lines of the database orphans also have the
+                attributes of <self.counted_attrs> that the item has.
+        """
+        start_time = time.time()
+        cutoff = start_time - self.min_age_seconds
+        if not os.path.isdir(self.report_dir):
+            os.makedirs(self.report_dir)
+        runs_dir = tempfile.mkdtemp(dir=self.report_dir)
+        summary = {'matched': 0, 'db_only': 0, 'storage_only': 0}
+        try:
+            executor = ThreadPoolExecutor(2)
+            try:
+                db_future = executor.submit(
+                    self.write_runs, self.list_db(cutoff),
+                    '%s/db' % (runs_dir))
+                storage_future = executor.submit(
+                    self.write_runs, self.list_storage(cutoff, summary),
+                    '%s/storage' % (runs_dir))
+                db_runs = db_future.result()
+                storage_runs = storage_future.result()
+            finally:
+                executor.shutdown(wait=True)
+
+            report_path = '%s/reconcile-%s-%s.jsonl' % (
+                self.report_dir, time.strftime('%Y%m%d-%H%M%S'),
+                uuid.uuid4().hex[:8])
+            with open(report_path, 'w') as report_file:
+                diffs = self.diff(self.merge_runs(db_runs),
+                                  self.merge_runs(storage_runs))
+                for side, record in diffs:
+                    if side is None:
+                        summary['matched'] += 1
+                        continue
+                    summary['%s_only' % (side)] += 1
+                    entry = dict(record[2], side=side, id=record[0])
+                    report_file.write(json.dumps(entry) + '\n')
+        finally:
+            shutil.rmtree(runs_dir)
+
+        summary['report_path'] = report_path
+        summary['seconds'] = time.time() - start_time
+        summary.setdefault('ignored', 0)
+        print('reconciled %s and %s in %.1f s: %d matched, %d only in the '
+              'database, %d only in storage, report at %s' % (
+                  self.db_name, self.storage_name, summary['seconds'],
+                  summary['matched'], summary['db_only'],
+                  summary['storage_only'], report_path))
+        return summary
+
+    def list_db(self, cutoff):
+        """ Helper function for reconcile().
+
+            Yields:
+                (tuple): (id (str), True if the item is younger than
+                    <cutoff> (bool), its counted attributes (dict)) of
+                    each item in the database.
+        """
+        items = PMLDatabase(self.db_name).export_items(
+            ProjectionExpression=', '.join(
+                ('id', 'created_at') + self.counted_attrs))
+        for item in items:
+            attrs = dict((attr, item[attr]) for attr in self.counted_attrs
+                         if attr in item)
+            yield (item['id'], item.get('created_at', 0) > cutoff * 1000,
+                   attrs)
+
+    def list_storage(self, cutoff, summary):
+        """ Helper function for reconcile(). Keys that are not
+            '<id>.png' are counted in summary['ignored'] and left out.
+
+            Yields:
+                (tuple): (id (str), True if the image is younger than
+                    <cutoff> (bool), {}) of each image in storage.
+        """
+        n_ignored = 0
+        for obj in PMLStorage(self.storage_name).list_objects():
+            if not obj['key'].endswith('.png'):
+                n_ignored += 1
+                continue
+            yield obj['key'][:-4], obj['last_modified'] > cutoff, {}
+        summary['ignored'] = n_ignored
+
+    def write_runs(self, records, runs_prefix):
+        """ Helper function for reconcile(). Writes <records> to sorted
+            runs of at most <self.run_size> records.
+
+            Returns:
+                list(str): the paths of the runs.
+        """
+        run_paths = []
+        run = []
+        for record in records:
+            run.append(record)
+            if len(run) >= self.run_size:
+                run_paths.append(self.write_run(run, runs_prefix,
+                                                len(run_paths)))
+                run = []
+        if run:
+            run_paths.append(self.write_run(run, runs_prefix,
+                                            len(run_paths)))
+        return run_paths
+
+    def write_run(self, run, runs_prefix, i_run):
+        """ Helper function for write_runs(). Sorts and writes a run,
+            one '<id>\\t<0 or 1>\\t<attributes as json>' line per
+            record.
+
+            Returns:
+                (str): the path of the run.
+        """
+        run_path = '%s-%d.run' % (runs_prefix, i_run)
+        run.sort(key=lambda record: record[0])
+        with open(run_path, 'w') as run_file:
+            for item_id, is_young, attrs in run:
+                run_file.write('%s\t%d\t%s\n' % (
+                    item_id, is_young, json.dumps(attrs)))
+        return run_path
+
+    def merge_runs(self, run_paths):
+        """ Helper function for reconcile().
+
+            Yields:
+                (tuple): (id (str), is young (bool), attributes (dict))
+                    of all runs, in sorted order.
+        """
+        run_files = [open(run_path) for run_path in run_paths]
+        try:
+            for line in heapq.merge(*run_files):
+                item_id, is_young, attrs = line.rstrip('\n').split('\t', 2)
+                yield item_id, is_young == '1', json.loads(attrs)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+    def diff(self, db_records, storage_records):
+        """ Helper function for reconcile(). Sorted-merge comparison of
+            the two sides.
+
+            Yields:
+                (tuple): (side, record) of each id, where side is None
+                    if the id is on both sides, otherwise 'db' or
+                    'storage' if it is an orphan on that side, and
+                    record is the record of merge_runs() of that side.
+                    Young orphans are left out.
+        """
+        db_record = next(db_records, None)
+        storage_record = next(storage_records, None)
+        while db_record is not None or storage_record is not None:
+            if storage_record is None or (
+                    db_record is not None and
+                    db_record[0] < storage_record[0]):
+                if not db_record[1]:
+                    yield 'db', db_record
+                db_record = next(db_records, None)
+            elif db_record is None or storage_record[0] < db_record[0]:
+                if not storage_record[1]:
+                    yield 'storage', storage_record
+                storage_record = next(storage_records, None)
+            else:
+                yield None, db_record
+                db_record = next(db_records, None)
+                storage_record = next(storage_records, None)
+
+    def iter_report(self, report_path, side=None):
+        """ Reads a diff report.
+
+            Args:
+                report_path (str): the path of the report.
+                side (str): 'db' or 'storage' to only read the orphans
+                    of that side. The default is None, all orphans.
+
+            Yields:
+                (dict): each line of the report.
+        """
+        with open(report_path) as report_file:
+            for line in report_file:
+                entry = json.loads(line)
+                if side is None or entry['side'] == side:
+                    yield entry
+
+    def repair(self, report_path, restore=True, batch_size=10000):
+        """ Applies a diff report. Images missing from storage are
+            restored from the shards if they are there, the database
+            items of the other missing images are deleted, and the
+            images without a database item are deleted. With
+            <self.counts_db_name>, each deleted database item is
+            subtracted from the counts.
+
+            The report is read and applied <batch_size> ids at a time,
+            so the memory used does not grow with the number of
+            orphans. The shard indexes are read once per batch of
+            database orphans.
+
+            Args:
+                report_path (str): the path of a report of reconcile().
+                restore (bool): if False, no image is restored, and all
+                    orphans are deleted. The default is True.
+                batch_size (int): the number of ids restored or deleted
+                    at once. The default is 10000.
+
+            Returns:
+                (dict): the outcome of each key, formatted like:
+                {
+                    "restored": [<id>, ...],
+                    "db": <outcome of PMLDatabase.delete_items()>,
+                    "storage": <outcome of PMLStorage.delete_items()>
+                }
+        """
+        outcome = {
+            'restored': [],
+            'db': {'deleted': [], 'errors': {}},
+            'storage': {'deleted': [], 'errors': {}},
+        }
+        shards = None
+        if restore and self.shards_storage_name is not None:
+            shards = PMLStorage(self.shards_storage_name)\
+                .get_shard_manifest()['shards']
+
+        counts = None
+        if self.counts_db_name is not None:
+            counts = PMLCounts(self.counts_db_name)
+
+        database = PMLDatabase(self.db_name)
+        for db_orphans in self.iter_batches(
+                self.iter_report(report_path, 'db'), batch_size):
+            if shards:
+                restored = self.restore_from_shards(
+                    [entry['id'] for entry in db_orphans], shards)
+                outcome['restored'].extend(restored)
+                restored = set(restored)
+                db_orphans = [entry for entry in db_orphans
+                              if entry['id'] not in restored]
+            if not db_orphans:
+                continue
+            db_outcome = database.delete_items(
+                'id', [entry['id'] for entry in db_orphans])
+            self.add_outcome(outcome['db'], db_outcome)
+            if counts is not None:
+                self.subtract_counts(counts, db_orphans,
+                                     db_outcome['deleted'])
+
+        storage = PMLStorage(self.storage_name)
+        for storage_orphans in self.iter_batches(
+                self.iter_report(report_path, 'storage'), batch_size):
+            self.add_outcome(outcome['storage'], storage.delete_items(
+                ['%s.png' % (entry['id']) for entry in storage_orphans]))
+
+        print('%d images restored, %d database items deleted (%d failed),'
+              ' %d images deleted (%d failed)' % (
+                  len(outcome['restored']),
+                  len(outcome['db']['deleted']),
+                  len(outcome['db']['errors']),
+                  len(outcome['storage']['deleted']),
+                  len(outcome['storage']['errors'])))
+        return outcome
+
+    def iter_batches(self, entries, batch_size):
+        """ Helper function for repair().
+
+            Yields:
+                list(dict): <batch_size> report entries at a time.
+        """
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def restore_from_shards(self, item_ids, shards):
+        """ Helper function for repair(). Uploads the images of
+            <item_ids> that are in one of <shards> back to the collect
+            storage.
+
+            Args:
+                item_ids (list(str)): the ids of the images.
+                shards (list(dict)): the shards, as in the shard
+                    manifest.
+
+            Returns:
+                list(str): the restored ids.
+        """
+        item_ids = set(item_ids)
+        shards_storage = PMLStorage(self.shards_storage_name)
+        storage = PMLStorage(self.storage_name)
+        restored = []
+        for shard in shards:
+            if not item_ids:
+                break
+            for entry in shards_storage.get_shard_index(shard):
+                if entry['id'] not in item_ids:
+                    continue
+                data = shards_storage.read_shard_item(shard, entry)
+                storage.post_item_in_storage(entry['id'], data)
+                item_ids.discard(entry['id'])
+                restored.append(entry['id'])
+        return restored
+
+    def subtract_counts(self, counts, entries, deleted_ids):
+        """ Helper function for repair(). Subtracts the database items
+            of <entries> that were deleted from the counts.
+
+            Args:
+                counts (PMLCounts): the counts of the collect database.
+                entries (list(dict)): report entries of database
+                    orphans.
+                deleted_ids (list(str)): the ids of the deleted items.
+        """
+        deleted_ids = set(deleted_ids)
+        for entry in entries:
+            if entry['id'] in deleted_ids:
+                # an id is only subtracted once, even if it is in the
+                # report twice:
+                deleted_ids.discard(entry['id'])
+                counts.decrement(entry)
+
+    def add_outcome(self, total, outcome):
+        """ Helper function for repair(). Adds a delete outcome to
+            <total>.
+        """
+        total['deleted'].extend(outcome['deleted'])
+        total['errors'].update(outcome['errors'])
+        return total
+
+
+if __name__ == '__main__':
+    db_name_collect = 'TODO'
+    storage_name_collect = 'TODO'
+    storage_name_shards = 'TODO'
+    db_name_counts = 'TODO'
+    report_dir = 'TODO'
+
+    reconciler = PMLReconciler(
+        db_name_collect,
+        storage_name_collect,
+        report_dir,
+        shards_storage_name=storage_name_shards,
+        counts_db_name=db_name_counts)
+    summary = reconciler.reconcile()
+    # reconciler.repair(summary['report_path'])
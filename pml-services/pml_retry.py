@@ -0,0 +1,69 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from random import uniform
+import time
+
+# AWS error codes that are worth retrying after a backoff:
+RETRYABLE_ERROR_CODES = set([
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'InternalError',
+    'InternalServerError',
+    'ServiceUnavailable',
+])
+
+
+def get_error_code(error):
+    """ Gets the AWS error code of a botocore ClientError, or of any
+        error with the same 'response' attribute.
+
+        Returns:
+            (str): the error code, or None.
+    """
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+def is_retryable(error):
+    """
+        Returns:
+            (bool): True if <error> is a throttling or a temporary
+                server error.
+    """
+    return get_error_code(error) in RETRYABLE_ERROR_CODES
+
+
+def retry_call(func, retries=5, base_delay=0.05, max_delay=5.,
+               should_retry=is_retryable):
+    """ Calls <func>, and calls it again after an exponential backoff
+        with full jitter each time it raises a retryable error.
+
+        Args:
+            func (function): function without arguments.
+            retries (int): the largest number of retries. The default
+                is 5.
+            base_delay (float): the backoff, in seconds, before the
+                first retry. It doubles on every retry. The default is
+                0.05.
+            max_delay (float): the largest backoff, in seconds. The
+                default is 5.
+            should_retry (function): function that takes the raised
+                error and returns True if it should be retried. The
+                default is is_retryable().
+
+        Returns:
+            the result of <func>, otherwise the last error is thrown.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries or not should_retry(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            time.sleep(uniform(0, delay))
+            attempt += 1
@@ -3,17 +3,24 @@
 from __future__ import print_function
 from flask import Flask, jsonify, request, make_response
 from flask_cors import CORS
-from random import randint
 import base64
 from pml_database import PMLDatabase
 from pml_storage import PMLStorage
+from pml_cache import PMLCache
+from pml_disk_cache import PMLDiskCache
+from pml_prediction_cache import PMLPredictionCache
+from pml_prompt_catalog import PMLPromptCatalog
+from pml_counts import PMLCounts
+from pml_prompt_sampler import PMLPromptSampler
+from pml_ingestion import PMLIngestionQueue
+from pml_clients import get_provider
 
 import sys
 pml_ml_path = '/path/to/ml/repo/TODO'
 sys.path.insert(0, pml_ml_path)
 from pml_image import PMLImage
-from pml_net import PMLNet
-from pml_predictor import PMLPredictor
+from pml_model_manager import PMLModelManager
+from pml_batch_predictor import PMLBatchPredictor
 
 
 #########################
@@ -31,13 +38,213 @@ CORS(app)
 ### Keras Model ###
 ###################
 data_dir = '/path/to/dir/with/data'
-model = PMLNet(data_dir).load_model()
+# the model is not loaded at import time. With <model_load_mode> set
+# to 'background' it starts loading in a background thread right
+# away, with 'lazy' it is loaded by the first request that needs it.
+# Either way, /health/ready reports when it is loaded and warmed up.
+model_load_mode = 'background'
+# the inference engine: 'keras', 'numpy' to predict with
+# PMLNumpyNet without loading Keras and its backend, or 'int8' to
+# predict with the model quantized by PMLQuantizer:
+model_engine = 'keras'
+model_manager = PMLModelManager(data_dir, engine=model_engine)
+if model_load_mode == 'background':
+    model_manager.start()
+# seconds between checks for a newly published model version in the
+# model registry, or None to only reload through /v1/model/reload:
+model_watch_interval = 30
+if model_watch_interval is not None:
+    model_manager.watch(model_watch_interval)
+
+# concurrent predict requests are batched into one forward pass.
+# a batch is run after <predict_max_wait_ms> milliseconds, or as soon
+# as <predict_max_batch_size> images are waiting:
+predict_max_batch_size = 32
+predict_max_wait_ms = 5
+batch_predictor = PMLBatchPredictor(
+    model_manager,
+    max_batch_size=predict_max_batch_size,
+    max_wait_ms=predict_max_wait_ms)
+# the largest number of images accepted by /v1/diagram/predict/batch:
+predict_batch_max_imgs = 128
+
+# predicted labels memoized by the preprocessed image. With
+# <prediction_cache_perceptual> set to True, images that differ by
+# only a few pixels share a cached prediction:
+prediction_cache_max_size = 4096
+prediction_cache_perceptual = False
+prediction_cache = PMLPredictionCache(
+    prediction_cache_max_size,
+    perceptual=prediction_cache_perceptual)
 
 # config variables for the database and storage in AWS:
 db_name_prompt = 'TODO'
 db_name_collect = 'TODO'
 storage_name_prompt = 'TODO'
 storage_name_collect = 'TODO'
+# collected sketch counts per username and per label, kept up to date
+# by post_training_sketch. Rebuild them with pml_counts.py.
+db_name_counts = 'TODO'
+
+# with <ingest_mode> set to 'async', post_training_sketch only
+# validates and queues the sketch, and background workers write it to
+# storage and the database. Sketches still queued at shutdown are
+# spilled to <ingest_spill_dir> and queued again at the next start.
+ingest_mode = 'sync'
+ingest_spill_dir = '/path/to/ingest/spill/dir'
+ingest_max_depth = 1000
+ingest_n_workers = 4
+ingest_queue = None
+if ingest_mode == 'async':
+    ingest_queue = PMLIngestionQueue(
+        db_name_collect,
+        storage_name_collect,
+        counts_db_name=db_name_counts,
+        spill_dir=ingest_spill_dir,
+        max_depth=ingest_max_depth,
+        n_workers=ingest_n_workers)
+    ingest_queue.start()
+
+# in-process caches shared by the prompt and predict routes:
+# label -> prompt meta-data item from the database, and
+# filename -> svg image data from storage.
+cache_max_size = 256
+cache_ttl = 600  # seconds
+label_item_cache = PMLCache(cache_max_size, cache_ttl)
+svg_cache = PMLCache(cache_max_size, cache_ttl)
+
+# local disk cache of the objects read from storage, below the
+# in-process caches. Several workers, and training hosts, can share
+# <storage_cache_dir>. Set it to None to always read from storage:
+storage_cache_dir = None
+storage_cache_max_bytes = 2**30
+storage_cache_validate_interval = 60  # seconds
+storage_disk_cache = None
+if storage_cache_dir is not None:
+    storage_disk_cache = PMLDiskCache(
+        storage_cache_dir,
+        storage_cache_max_bytes,
+        storage_cache_validate_interval)
+
+# the prompt table, kept in memory and read again every
+# <prompt_catalog_refresh_interval> seconds. With probability
+# <prompt_p_bias>, the prompt label is drawn weighted by how far it is
+# behind the most collected label, using label counts that are read
+# again every <prompt_sampler_refresh_interval> seconds:
+prompt_catalog_refresh_interval = 600
+prompt_sampler_refresh_interval = 60
+prompt_p_bias = 0.1
+prompt_sampler = PMLPromptSampler(
+    PMLCounts(db_name_counts),
+    prompt_sampler_refresh_interval)
+prompt_catalog = PMLPromptCatalog(
+    db_name_prompt,
+    prompt_catalog_refresh_interval,
+    prompt_sampler)
+
+
+def get_svg(filename):
+    """ Gets the svg image data of a prompt image, from the cache or
+        otherwise from storage.
+
+        Args:
+            filename (str): the filename of the svg in storage.
+
+        Returns:
+            (str): the svg image data.
+    """
+    return svg_cache.get_or_load(
+        filename,
+        lambda: PMLStorage(storage_name_prompt, storage_disk_cache)
+        .get_item_from_storage(filename).decode('utf-8'))
+
+
+def get_predict_item(label):
+    """ Gets the prompt meta-data for the predicted <label>, from the
+        cache or otherwise from the database.
+
+        Args:
+            label (str): the predicted label.
+
+        Returns:
+            (dict): the item, containing the 'filename' of the svg.
+    """
+    return label_item_cache.get_or_load(
+        label,
+        lambda: PMLDatabase(db_name_prompt).get_predict_item(label))
+
+
+@app.route('/health/live', methods=['GET'])
+def get_health_live():
+    """ Liveness probe: the process is up and serving requests.
+
+    Returns:
+        HTTP response: String saying "OK" with status code 200.
+    """
+    response = make_response('OK')
+    response.status_code = 200
+    return response
+
+
+@app.route('/health/ready', methods=['GET'])
+def get_health_ready():
+    """ Readiness probe: the model is loaded and warmed up.
+
+    Returns:
+        HTTP response: (application/json) containing:
+            {
+                "ready" : <true or false>,
+                "model_version" : "<version of the loaded model>",
+                "error" : "<error if the model failed to load>",
+                "load_seconds" : <seconds to load the model>,
+                "warm_up_seconds" : <seconds of the warm-up prediction>,
+                "cold_start_seconds" : <seconds from startup to ready>
+            }
+            with status code 200 if the model is ready, otherwise
+            status code 503.
+    """
+    response = jsonify(model_manager.status())
+    if not model_manager.is_ready():
+        response.status_code = 503
+    return response
+
+
+@app.route('/health/metrics', methods=['GET'])
+def get_health_metrics():
+    """ Get method for the latency of the AWS calls made by this
+        process.
+
+    Returns:
+        HTTP response: (application/json) object formatted like:
+            {
+                "aws": {
+                    "<service>.<operation>": {
+                        "calls": <count>,
+                        "total_seconds": <seconds>,
+                        "max_seconds": <seconds>,
+                        "mean_seconds": <seconds>
+                    },
+                }
+            }
+    """
+    return jsonify(aws=get_provider().get_latencies())
+
+
+@app.route('/v1/model/reload', methods=['POST'])
+def post_model_reload():
+    """ Post method to load the model version published in the model
+        registry. The new model is loaded and warmed up in the
+        background, and the current model keeps serving until it is
+        swapped in.
+
+    Returns:
+        HTTP response: (application/json) with the status of the model
+            manager, as returned by /health/ready, with status code 202.
+    """
+    model_manager.reload_in_background()
+    response = jsonify(model_manager.status())
+    response.status_code = 202
+    return response
 
 
 @app.route('/v1/training/shapes/prompt', methods=['GET'])
@@ -69,11 +276,10 @@ def get_prompt(modename='all'):
             }
     """
     try:
-        item = PMLDatabase(db_name_prompt, modename).get_prompt_item()
+        item = prompt_catalog.get_prompt_item(modename, prompt_p_bias)
         filename = item['filename']
 
-        img_data = PMLStorage(storage_name_prompt)\
-            .get_item_from_storage(filename)
+        img_data = get_svg(filename)
 
         item_json = jsonify(img_data=img_data, label=item['label'])
         return item_json  # includes status code 200
@@ -96,8 +302,11 @@ def post_training_sketch():
 
         Returns:
             HTTP response: String saying "Image Successfully uploaded."
-                with status code 200, otherwise an error will be thrown
-                and status code 400 will be returned with the error.
+                with status code 200, or, when <ingest_mode> is 'async',
+                "Image accepted for upload." with status code 202, or
+                status code 503 if the ingestion queue is full.
+                Otherwise an error will be thrown and status code 400
+                will be returned with the error.
     """
     try:
         # arguments:
@@ -107,24 +316,52 @@ def post_training_sketch():
         username = json_args['username']
         is_mobile = json_args['is_mobile']
 
-        # posting item in database
-        newID = PMLDatabase(db_name_collect).get_new_id()
+        # strip the prefix off the image data:
+        img = img.lstrip('data:image/png;base64')
+        img = base64.b64decode(img)
+        if not img.startswith(b'\x89PNG'):
+            raise ValueError('The image is not a png')
+
+        db_collect = PMLDatabase(db_name_collect)
+        created_at = db_collect.get_created_at()
+        newID = db_collect.get_new_id(created_at)
         item = {
             'id': newID,
             'label': label,
             'username': username,
             'is_mobile': is_mobile,
+            'created_at': created_at,
+            'created_day': db_collect.get_created_day(created_at),
         }
 
-        PMLDatabase(db_name_collect).post_item_in_db(item)
-
-        # posting item in storage
-        # strip the prefix off the image data:
-        img = img.lstrip('data:image/png;base64')
-        img = base64.b64decode(img)
+        if ingest_queue is not None:
+            # written to storage and the database in the background
+            if not ingest_queue.enqueue(item, img):
+                response = make_response(
+                    'Too many uploads, please try again later.')
+                response.status_code = 503
+                return response
+            prompt_sampler.record(label)
+            response = make_response('Image accepted for upload.')
+            response.status_code = 202
+            return response
+
+        # posting item in storage first, so a database item never
+        # points to a missing image, like the ingestion queue does:
         PMLStorage(storage_name_collect)\
             .post_item_in_storage(newID, img)
 
+        # posting item in database
+        db_collect.post_item_in_db(item)
+
+        # the sketch is only counted once it is fully written
+        try:
+            PMLCounts(db_name_counts).increment(item)
+        except Exception as e:
+            # the sketch is stored; the counts can be rebuilt
+            print('failed to count sketch %s: %s' % (newID, e))
+        prompt_sampler.record(label)
+
         response = make_response('Image successfully uploaded.')
         response.status_code = 200
         return response
@@ -154,8 +391,8 @@ def get_leaderboard():
     """
     try:
         primary_key = 'username'
-        leaderboard = PMLDatabase(db_name_collect)\
-            .get_attr_count_map(primary_key)
+        leaderboard = PMLCounts(db_name_counts)\
+            .get_count_map(primary_key)
         response_json = jsonify(leaderboard)
         return response_json  # automatically includes status code 200.
     except Exception as e:
@@ -218,9 +455,10 @@ def add_prompt():
         username = json_args['username']
         filename = label + '.svg'
 
-        newID = str(randint(0, 10**12))
+        # the id is the filename, so the conditional put below also
+        # makes the filename unique.
         item = {
-            'id': newID,
+            'id': filename,
             'label': label,
             'filename': filename,
             'mode': mode,
@@ -229,21 +467,30 @@ def add_prompt():
             'is_custom': 'true',
         }
 
-        # check if filename exists in the database
-        key = "filename"
+        # the svg is stored under the label, so an existing prompt with
+        # the label would be overwritten in storage.
         database = PMLDatabase(db_name_prompt)
-        filenames = database.get_attr_count_map(key)
-
-        if filename in filenames:
+        if database.has_label(label):
+            raise ValueError('The filename: %s is already in use' % (filename))
+        # claim the filename in the database before writing to storage,
+        # so a concurrent upload of the same label can not overwrite it.
+        if not database.post_new_item_in_db(item):
             raise ValueError('The filename: %s is already in use' % (filename))
-        # filename does not exist, post in database
-        database.post_item_in_db(item)
         # posting item in storage
         # strip the prefix off the image data:
-        img = img.lstrip('data:image/svg+xml;base64,')
-        img = base64.b64decode(img)
-        PMLStorage(storage_name_prompt)\
-            .post_item_in_storage(label, img, 'svg')
+        try:
+            img = img.lstrip('data:image/svg+xml;base64,')
+            img = base64.b64decode(img)
+            PMLStorage(storage_name_prompt)\
+                .post_item_in_storage(label, img, 'svg')
+        except Exception:
+            # release the claim, so the prompt can be added again.
+            database.remove_items('id', [filename])
+            raise
+        # drop any cached data of the new prompt
+        label_item_cache.invalidate(label)
+        svg_cache.invalidate(filename)
+        prompt_catalog.add_item(item)
 
         response = make_response('Image successfully uploaded.')
         response.status_code = 200
@@ -274,31 +521,33 @@ def post_predicted_img():
 
         # strip the prefix off the image data:
         img = img.lstrip('data:image/png;base64')
-        # save the img as a temporary file
-        tmp_img_path = 'tmp_img.png'
-        with open(tmp_img_path, 'wb') as f:
-            f.write(base64.b64decode(img))
-
-        # create the image file object
-        pml_img_obj = PMLImage(tmp_img_path, tmp_img_path)
-        pml_img_obj.process_img_for_predict()
 
-        # get a numpy array from the png
-        processed_img_array = pml_img_obj.img_obj_to_array()
+        # grey, crop and resize the png in memory and get
+        # the processed image as a numpy array
+        processed_img_array = PMLImage()\
+            .process_img_data_for_predict(base64.b64decode(img))
         # now feed the img into the conv net. and
-        # get the prediction label
-        # model is a global variable defined near the top of the file.
-        pml_predictor = PMLPredictor(data_dir, model)
-        pred_label = pml_predictor.predict(processed_img_array)
+        # get the prediction label, unless the same image was
+        # already predicted by this model.
+        # batch_predictor is a global variable defined near the top
+        # of the file.
+        model_version, _ = model_manager.get_current()
+        pred_label = prediction_cache.get(
+            processed_img_array, model_version)
+        if pred_label is None:
+            # cached under the version that made the prediction, which
+            # is not <model_version> if the model was just reloaded:
+            model_version, pred_label = batch_predictor\
+                .predict_versioned(processed_img_array)
+            prediction_cache.set(
+                processed_img_array, model_version, pred_label)
 
         # get the cooresponding svg img:
         # meta-data from the database:
-        item = PMLDatabase(db_name_prompt)\
-            .get_predict_item(pred_label)
+        item = get_predict_item(pred_label)
         filename = item['filename']
         # getting the svg from storage:
-        img_data = PMLStorage(storage_name_prompt)\
-            .get_item_from_storage(filename)
+        img_data = get_svg(filename)
 
         # send the data as a response (application/ json)
         item_json = jsonify(
@@ -312,6 +561,109 @@ def post_predicted_img():
         response.status_code = 400
         return response
 
+@app.route('/v1/diagram/predict/stats', methods=['GET'])
+def get_predict_stats():
+    """ Get method for the hit and miss counters of the prediction
+        caches.
+
+        Returns:
+            HTTP response: (application/json) object formatted like:
+            {
+                "predictions": {
+                    "hits": <count>,
+                    "misses": <count>,
+                    "size": <count>
+                },
+                "labels": {"hits": <count>, "misses": <count>, ...},
+                "svgs": {"hits": <count>, "misses": <count>, ...},
+                "storage_disk": {"hits": <count>, "misses": <count>,
+                                 "validations": <count>,
+                                 "evictions": <count>}
+            }
+            where "storage_disk" is null without a disk cache.
+    """
+    storage_disk_stats = None
+    if storage_disk_cache is not None:
+        storage_disk_stats = storage_disk_cache.get_stats()
+    return jsonify(
+        predictions=prediction_cache.stats(),
+        labels=label_item_cache.stats(),
+        svgs=svg_cache.stats(),
+        storage_disk=storage_disk_stats,
+    )
+
+
+@app.route('/v1/diagram/predict/batch', methods=['POST'])
+def post_predicted_imgs():
+    """ Post method for getting the predicted images of several pngs
+        in one request.
+
+    Args (from the POST Request):
+        imgs (list(str)): list of base64 encoded image data.
+        top_k (int): optional, the number of labels returned per
+            image, at least 1. The default is 3.
+
+    Returns:
+        HTTP response: (application/json) containing, for each image
+            in the same order as <imgs>:
+            {
+                "predictions": [
+                    {
+                        "img_data" : "<base64 encoded string>",
+                        "label" : "<most likely label for the image>",
+                        "top_k" : [
+                            {
+                                "label": "<label>",
+                                "probability": <probability>
+                            },
+                        ]
+                    },
+                ]
+            }
+    """
+    try:
+        json_args = request.get_json(force=True)
+        imgs = json_args['imgs']
+        top_k = int(json_args.get('top_k', 3))
+        if top_k < 1:
+            raise ValueError('top_k must be at least 1')
+
+        if len(imgs) > predict_batch_max_imgs:
+            raise ValueError('At most %d images can be predicted at once'
+                             % (predict_batch_max_imgs))
+
+        # preprocess all images in memory:
+        processed_img_arrays = []
+        for img in imgs:
+            # strip the prefix off the image data:
+            img = img.lstrip('data:image/png;base64')
+            processed_img_arrays.append(
+                PMLImage()
+                .process_img_data_for_predict(base64.b64decode(img)))
+
+        # one forward pass of one model version for all of the
+        # images, that does not run concurrently with the forward
+        # passes of the shared batch_predictor:
+        _, top_k_preds = batch_predictor.predict_batch(
+            processed_img_arrays, top_k)
+
+        predictions = []
+        for preds in top_k_preds:
+            pred_label = preds[0]['label']
+            filename = get_predict_item(pred_label)['filename']
+            predictions.append({
+                'img_data': get_svg(filename),
+                'label': pred_label,
+                'top_k': preds,
+            })
+
+        return jsonify(predictions=predictions)  # includes status code 200
+
+    except Exception as e:
+        response = make_response('An error has occurred: '+str(e) + ".")
+        response.status_code = 400
+        return response
+
 # use for local testing:
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=80)
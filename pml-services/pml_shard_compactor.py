@@ -0,0 +1,379 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from io import BytesIO
+
+from pml_database import PMLDatabase
+from pml_storage import PMLStorage, SHARD_MANIFEST_KEY
+from pml_retry import get_error_code, retry_call
+
+# key of the lock object of the compaction runs, in the storage of the
+# shards:
+LOCK_KEY = 'compactor.lock'
+
+
+class PMLShardCompactor:
+    """ Project Mona Lisa Shard Compactor class. Packs the collected
+        sketches, which are stored as one small png object each, into
+        large shards in a separate storage, so bulk reads, like the
+        download of the training data, take a few requests per shard
+        instead of one request per sketch.
+
+        A shard 'shards/<shard id>.bin' is the concatenation of the png
+        data of its sketches. Its index 'shards/<shard id>.index.json.gz'
+        lists the id, label, offset and length of each sketch, and
+        'manifest.json' lists the shards. Shards are never changed once
+        written: each run packs the sketches that are not in a shard yet
+        into new shards, and only adds them to the manifest after the
+        shard and its index are written. The original objects are kept.
+
+        Only one run may compact a storage at a time, otherwise two runs
+        pack the same sketches and each drops the shards of the other
+        from the manifest. A run holds the lock object 'compactor.lock'
+        while it compacts, and fails if another run holds it. Before it
+        updates the manifest, it also checks that the manifest and the
+        lock were not changed by another run.
+    """
+
+    def __init__(self, db_name, storage_name, shards_storage_name,
+                 shard_bytes=256 * 2**20, max_workers=16, retries=5,
+                 lock_seconds=3600):
+        """
+            Args:
+                db_name (str): name of the collect database.
+                storage_name (str): name of the collect storage.
+                shards_storage_name (str): name of the storage of the
+                    shards.
+                shard_bytes (int): the size at which a shard is
+                    written. The default is 256 MB.
+                max_workers (int): the number of threads reading the
+                    sketches. The default is 16.
+                retries (int): the largest number of retries of a
+                    request. The default is 5.
+                lock_seconds (float): the number of seconds the lock is
+                    held without writing a shard, after which another
+                    run can take it, e.g. after a crash. The default is
+                    3600.
+        """
+        self.db_name = db_name
+        self.storage_name = storage_name
+        self.shards_storage_name = shards_storage_name
+        self.shard_bytes = shard_bytes
+        self.max_workers = max_workers
+        self.retries = retries
+        self.lock_seconds = lock_seconds
+        self.run_id = uuid.uuid4().hex
+        # ETag of the manifest as last read or written by this run:
+        self.manifest_etag = None
+
+    def compact(self, flush=False):
+        """ Packs the sketches of the collect database that are not in
+            a shard yet into new shards.
+
+            Args:
+                flush (bool): if True, the last sketches are written to
+                    a shard even if it is smaller than
+                    <self.shard_bytes>. Otherwise they are left for the
+                    next run. The default is False.
+
+            Returns:
+                (dict): the new shards, as listed in the manifest.
+        """
+        self.acquire_lock()
+        try:
+            return self.compact_locked(flush)
+        finally:
+            self.release_lock()
+
+    def compact_locked(self, flush):
+        """ Helper function for compact(), that runs while the lock is
+            held.
+        """
+        shards_storage = PMLStorage(self.shards_storage_name)
+        manifest, self.manifest_etag = self.read_manifest()
+        packed_ids = set()
+        for shard in manifest['shards']:
+            for entry in shards_storage.get_shard_index(shard):
+                packed_ids.add(entry['id'])
+
+        items = PMLDatabase(self.db_name).export_items(
+            ProjectionExpression='id, label')
+        # time-ordered ids keep the sketches of a shard close in time
+        items = sorted((item for item in items
+                        if item['id'] not in packed_ids),
+                       key=lambda item: item['id'])
+        print('%d sketches to compact' % (len(items)))
+
+        new_shards = []
+        writer = None
+        n_missing = 0
+        executor = ThreadPoolExecutor(self.max_workers)
+        try:
+            # read the sketches in chunks, so only one chunk is in memory
+            chunk_size = 50 * self.max_workers
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                for item, data in zip(chunk,
+                                      executor.map(self.fetch, chunk)):
+                    if data is None:
+                        n_missing += 1
+                        continue
+                    if writer is None:
+                        writer = PMLShardWriter()
+                    writer.add(item, data)
+                    if writer.size >= self.shard_bytes:
+                        new_shards.append(self.publish(writer, manifest))
+                        writer = None
+            if writer is not None and flush:
+                new_shards.append(self.publish(writer, manifest))
+                writer = None
+        finally:
+            executor.shutdown(wait=True)
+            if writer is not None:
+                writer.close()
+
+        print('wrote %d shards, %d sketches without an image' % (
+            len(new_shards), n_missing))
+        return new_shards
+
+    def fetch(self, item):
+        """ Helper function for compact(). Reads the png of a sketch.
+
+            Returns:
+                (bytes): the image data, or None if it is not in
+                    storage.
+        """
+        storage = PMLStorage(self.storage_name)
+        try:
+            return retry_call(
+                lambda: storage.fetch_item('%s.png' % (item['id']))[0],
+                retries=self.retries)
+        except Exception as e:
+            if get_error_code(e) in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def read_manifest(self):
+        """ Helper function. Reads the manifest of the shards.
+
+            Returns:
+                (tuple): (the manifest (dict), its ETag (str), or None if
+                    there is no manifest yet)
+        """
+        try:
+            response = PMLStorage(self.shards_storage_name).get_bucket()\
+                .Object(SHARD_MANIFEST_KEY).get()
+        except Exception as e:
+            if get_error_code(e) in ('NoSuchKey', '404'):
+                return {'shards': []}, None
+            raise
+        manifest = json.loads(response['Body'].read().decode('utf-8'))
+        return manifest, response['ETag'].strip('"')
+
+    def read_lock(self):
+        """ Helper function.
+
+            Returns:
+                (dict): the lock, formatted like:
+                {"run_id": "<id of the run>", "expires_at": <seconds>},
+                or None if no run holds it.
+        """
+        try:
+            data = PMLStorage(self.shards_storage_name).get_bucket()\
+                .Object(LOCK_KEY).get()['Body'].read()
+        except Exception as e:
+            if get_error_code(e) in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(data.decode('utf-8'))
+
+    def write_lock(self):
+        """ Helper function. Takes, or extends, the lock for
+            <self.lock_seconds>.
+        """
+        lock = {
+            'run_id': self.run_id,
+            'expires_at': time.time() + self.lock_seconds,
+        }
+        bucket = PMLStorage(self.shards_storage_name).get_bucket()
+        retry_call(lambda: bucket.put_object(
+            Key=LOCK_KEY,
+            Body=json.dumps(lock).encode('utf-8'),
+            ServerSideEncryption='AES256',
+            ContentType='application/json'),
+            retries=self.retries)
+        return True
+
+    def acquire_lock(self):
+        """ Takes the lock of the compaction runs, unless another run
+            holds it.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        lock = self.read_lock()
+        if lock is not None and lock['run_id'] != self.run_id \
+                and lock['expires_at'] > time.time():
+            raise RuntimeError(
+                'Another compaction (run %s) holds %s for %d more seconds'
+                % (lock['run_id'], LOCK_KEY,
+                   lock['expires_at'] - time.time()))
+        self.write_lock()
+        # two runs that took the lock at the same time: the last write
+        # wins, and the other run fails here.
+        self.check_lock()
+        return True
+
+    def check_lock(self):
+        """ Helper function. Checks that this run still holds the lock.
+
+            Returns:
+                (bool) True if successful, otherwise an error is
+                thrown.
+        """
+        lock = self.read_lock()
+        if lock is None or lock['run_id'] != self.run_id:
+            raise RuntimeError(
+                'The compaction lost %s to another run' % (LOCK_KEY))
+        return True
+
+    def release_lock(self):
+        """ Helper function. Removes the lock, if this run holds it.
+
+            Returns:
+                (bool) True if the lock was removed.
+        """
+        lock = self.read_lock()
+        if lock is None or lock['run_id'] != self.run_id:
+            return False
+        PMLStorage(self.shards_storage_name).get_bucket()\
+            .Object(LOCK_KEY).delete()
+        return True
+
+    def publish(self, writer, manifest):
+        """ Helper function for compact(). Uploads a shard and its index,
+            then adds it to the manifest, if the manifest was not changed
+            by another run.
+
+            Args:
+                writer (PMLShardWriter): the written shard.
+                manifest (dict): the manifest, updated in place.
+
+            Returns:
+                (dict): the shard, as listed in the manifest.
+        """
+        shard_id = '%013d-%s' % (int(time.time() * 1000),
+                                 uuid.uuid4().hex[:12])
+        shard = {
+            'shard': shard_id,
+            'key': 'shards/%s.bin' % (shard_id),
+            'index_key': 'shards/%s.index.json.gz' % (shard_id),
+            'n_items': len(writer.index),
+            'bytes': writer.size,
+        }
+        bucket = PMLStorage(self.shards_storage_name).get_bucket()
+        try:
+            writer.shard_file.flush()
+            # upload_file uses multipart uploads for large shards
+            retry_call(lambda: bucket.upload_file(
+                writer.shard_path, shard['key'],
+                ExtraArgs={'ServerSideEncryption': 'AES256'}),
+                retries=self.retries)
+            retry_call(lambda: bucket.put_object(
+                Key=shard['index_key'],
+                Body=writer.get_index_data(),
+                ServerSideEncryption='AES256',
+                ContentType='application/gzip'),
+                retries=self.retries)
+        finally:
+            writer.close()
+
+        self.check_lock()
+        if self.read_manifest()[1] != self.manifest_etag:
+            # the shard would never be listed
+            bucket.delete_objects(Delete={'Objects': [
+                {'Key': shard['key']}, {'Key': shard['index_key']}]})
+            raise RuntimeError(
+                'The shard manifest was changed by another run')
+        manifest['shards'].append(shard)
+        manifest_data = json.dumps(manifest, indent=2, sort_keys=True)\
+            .encode('utf-8')
+        retry_call(lambda: bucket.put_object(
+            Key=SHARD_MANIFEST_KEY,
+            Body=manifest_data,
+            ServerSideEncryption='AES256',
+            ContentType='application/json'),
+            retries=self.retries)
+        # the ETag of an object that was not uploaded in parts is its MD5
+        self.manifest_etag = hashlib.md5(manifest_data).hexdigest()
+        self.write_lock()
+        print('wrote shard %s: %d sketches, %.1f MB' % (
+            shard_id, shard['n_items'], shard['bytes'] / 1e6))
+        return shard
+
+
+class PMLShardWriter:
+    """ Project Mona Lisa Shard Writer class. Appends sketches to a
+        temporary shard file, and keeps its index.
+    """
+
+    def __init__(self):
+        fd, self.shard_path = tempfile.mkstemp(suffix='.bin')
+        self.shard_file = os.fdopen(fd, 'wb')
+        self.index = []
+        self.size = 0
+
+    def add(self, item, data):
+        """ Appends the image data of a sketch.
+
+            Args:
+                item (dict): the sketch, with the keys 'id' and 'label'.
+                data (bytes): the image data.
+        """
+        self.shard_file.write(data)
+        self.index.append({
+            'id': item['id'],
+            'label': item['label'],
+            'offset': self.size,
+            'length': len(data),
+        })
+        self.size += len(data)
+        return True
+
+    def get_index_data(self):
+        """
+            Returns:
+                (bytes): the gzip compressed json of the index.
+        """
+        index_data = BytesIO()
+        with gzip.GzipFile(fileobj=index_data, mode='wb') as gzip_file:
+            gzip_file.write(json.dumps(self.index).encode('utf-8'))
+        return index_data.getvalue()
+
+    def close(self):
+        """ Removes the temporary shard file.
+        """
+        self.shard_file.close()
+        if os.path.exists(self.shard_path):
+            os.remove(self.shard_path)
+        return True
+
+
+if __name__ == '__main__':
+    db_name_collect = 'TODO'
+    storage_name_collect = 'TODO'
+    storage_name_shards = 'TODO'
+
+    PMLShardCompactor(
+        db_name_collect,
+        storage_name_collect,
+        storage_name_shards).compact()
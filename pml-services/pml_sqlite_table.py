@@ -0,0 +1,635 @@
+# Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+from boto3.dynamodb.conditions import AttributeBase, ConditionBase
+from botocore.exceptions import ClientError
+from decimal import Decimal
+import json
+import re
+import sqlite3
+import threading
+import zlib
+
+# attributes with an index in SQLite, for the queries of the 'label',
+# 'modename' and 'created_day' secondary indexes:
+INDEXED_ATTRS = ('label', 'modename', 'created_day')
+
+
+class PMLSQLiteTable:
+    """ Project Mona Lisa SQLite Table class. A local stand-in for a
+        boto3 DynamoDB Table, stored in a SQLite database file that
+        several threads and processes can share. It supports the parts
+        of the Table API used by PMLDatabase and its subclasses:
+        put_item (with a ConditionExpression), get_item, update_item
+        (SET, ADD and REMOVE), delete_item, paginated scan (with
+        FilterExpression, ProjectionExpression and Segment/TotalSegments)
+        and query (any IndexName, with a KeyConditionExpression),
+        batch_writer() and meta.client.batch_write_item.
+
+        Conditions must be boto3.dynamodb.conditions objects. Numbers
+        are returned as Decimal, like boto3 does. Items are ordered by
+        their primary key, also in queries.
+    """
+
+    def __init__(self, db_path, name, key_names=('id',), page_size=100):
+        """
+            Args:
+                db_path (str): path of the SQLite database file.
+                name (str): name of the table.
+                key_names (tuple(str)): the primary key: the partition
+                    key, and optionally the sort key. The default is
+                    ('id',).
+                page_size (int): the largest number of items in a page
+                    of scan() and query(). The default is 100.
+        """
+        self.db_path = db_path
+        self.name = name
+        self.table_name = name
+        self.key_names = tuple(key_names)
+        self.page_size = page_size
+        self.local = threading.local()
+        self.meta = PMLSQLiteMeta(PMLSQLiteClient(db_path))
+        connection = self.get_connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO tables (table_name, key_names) '
+            'VALUES (?, ?)', (name, json.dumps(self.key_names)))
+
+    def get_connection(self):
+        """ Helper function. Gets the SQLite connection of the calling
+            thread, creating the schema the first time.
+
+            Returns:
+                (sqlite3.Connection)
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = connect(self.db_path)
+        return connection
+
+    def get_pk(self, key):
+        """ Helper function.
+
+            Returns:
+                (str): the primary key of <key>, an item or a Key dict,
+                    as stored in SQLite.
+        """
+        try:
+            return dumps([key[name] for name in self.key_names])
+        except KeyError:
+            raise ClientError({'Error': {
+                'Code': 'ValidationException',
+                'Message': 'The item is missing the key %s' % (
+                    ', '.join(self.key_names))}}, 'PutItem')
+
+    def load(self, connection, pk):
+        """ Helper function.
+
+            Returns:
+                (dict): the item with the primary key <pk>, or None.
+        """
+        row = connection.execute(
+            'SELECT item FROM items WHERE table_name = ? AND pk = ?',
+            (self.name, pk)).fetchone()
+        if row is None:
+            return None
+        return loads(row[0])
+
+    def store(self, connection, item):
+        """ Helper function. Inserts or replaces <item>.
+        """
+        pk = self.get_pk(item)
+        connection.execute(
+            'INSERT OR REPLACE INTO items (table_name, pk, hash, item) '
+            'VALUES (?, ?, ?, ?)',
+            (self.name, pk, zlib.crc32(pk.encode('utf-8')) & 0xffffffff,
+             dumps(item)))
+
+    def check_condition(self, condition, item, operation, names=None):
+        """ Helper function. Raises the ConditionalCheckFailedException
+            of DynamoDB if <item> does not match <condition>.
+        """
+        if condition is None:
+            return True
+        if not evaluate(condition, item or {}, names):
+            raise ClientError({'Error': {
+                'Code': 'ConditionalCheckFailedException',
+                'Message': 'The conditional request failed'}}, operation)
+        return True
+
+    def put_item(self, Item, ConditionExpression=None,
+                 ExpressionAttributeNames=None, **kwargs):
+        """ Same as boto3 Table.put_item().
+        """
+        connection = self.get_connection()
+        with transaction(connection):
+            if ConditionExpression is not None:
+                self.check_condition(
+                    ConditionExpression,
+                    self.load(connection, self.get_pk(Item)),
+                    'PutItem', ExpressionAttributeNames)
+            self.store(connection, Item)
+        return {}
+
+    def get_item(self, Key, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, **kwargs):
+        """ Same as boto3 Table.get_item().
+        """
+        item = self.load(self.get_connection(), self.get_pk(Key))
+        if item is None:
+            return {}
+        return {'Item': project(item, ProjectionExpression,
+                                ExpressionAttributeNames)}
+
+    def delete_item(self, Key, ConditionExpression=None,
+                    ExpressionAttributeNames=None, **kwargs):
+        """ Same as boto3 Table.delete_item().
+        """
+        connection = self.get_connection()
+        pk = self.get_pk(Key)
+        with transaction(connection):
+            if ConditionExpression is not None:
+                self.check_condition(
+                    ConditionExpression, self.load(connection, pk),
+                    'DeleteItem', ExpressionAttributeNames)
+            connection.execute(
+                'DELETE FROM items WHERE table_name = ? AND pk = ?',
+                (self.name, pk))
+        return {}
+
+    def update_item(self, Key, UpdateExpression,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None,
+                    ConditionExpression=None, **kwargs):
+        """ Same as boto3 Table.update_item(), for update expressions
+            made of SET <attr> = <value>, ADD <attr> <value> and
+            REMOVE <attr> clauses.
+        """
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        connection = self.get_connection()
+        pk = self.get_pk(Key)
+        with transaction(connection):
+            item = self.load(connection, pk)
+            self.check_condition(ConditionExpression, item,
+                                 'UpdateItem', names)
+            if item is None:
+                item = dict(Key)
+            for action, attr, value in parse_update(
+                    UpdateExpression, names, values):
+                if action == 'SET':
+                    item[attr] = value
+                elif action == 'REMOVE':
+                    item.pop(attr, None)
+                elif isinstance(value, (set, frozenset)):
+                    item[attr] = set(item.get(attr, set())) | value
+                else:
+                    item[attr] = item.get(attr, 0) + value
+            self.store(connection, item)
+        return {}
+
+    def scan(self, ExclusiveStartKey=None, Limit=None,
+             ProjectionExpression=None, FilterExpression=None,
+             ExpressionAttributeNames=None, Segment=None,
+             TotalSegments=None, **kwargs):
+        """ Same as boto3 Table.scan(). Like DynamoDB, <Limit> and the
+            page size count the items read before the FilterExpression
+            is applied.
+        """
+        where = []
+        params = []
+        if TotalSegments is not None:
+            where.append('hash % ? = ?')
+            params.extend([TotalSegments, Segment])
+        return self.read_page(where, params, None, ExclusiveStartKey,
+                              Limit, ProjectionExpression,
+                              FilterExpression, ExpressionAttributeNames)
+
+    def query(self, KeyConditionExpression, IndexName=None,
+              ExclusiveStartKey=None, Limit=None,
+              ProjectionExpression=None, FilterExpression=None,
+              ExpressionAttributeNames=None, **kwargs):
+        """ Same as boto3 Table.query(). Any <IndexName> is accepted:
+            the KeyConditionExpression is evaluated on the items.
+        """
+        where = []
+        params = []
+        # use the SQLite indexes for the equality on the partition key
+        partition = KeyConditionExpression
+        if partition.get_expression()['operator'] == 'AND':
+            partition = partition.get_expression()['values'][0]
+        expression = partition.get_expression()
+        if expression['operator'] == '=' and \
+                isinstance(expression['values'][1], (str, type(u''))):
+            where.append('json_extract(item, ?) = ?')
+            params.extend(['$."%s"' % (expression['values'][0].name),
+                           expression['values'][1]])
+        return self.read_page(where, params, KeyConditionExpression,
+                              ExclusiveStartKey, Limit,
+                              ProjectionExpression, FilterExpression,
+                              ExpressionAttributeNames)
+
+    def read_page(self, where, params, key_condition, start_key, limit,
+                  projection, filter_condition, names):
+        """ Helper function for scan() and query(). Reads one page of
+            items, ordered by primary key.
+
+            Returns:
+                (dict): the response, formatted like the boto3 response:
+                {"Items": [...], "Count": <count>,
+                 "ScannedCount": <count>, "LastEvaluatedKey": {...}}
+                where LastEvaluatedKey is only there if there are more
+                pages.
+        """
+        page_size = self.page_size
+        if limit is not None:
+            page_size = min(page_size, limit)
+        where = ['table_name = ?'] + where
+        params = [self.name] + params
+        if start_key is not None:
+            where.append('pk > ?')
+            params.append(self.get_pk(start_key))
+
+        items = []
+        n_scanned = 0
+        last_item = None
+        cursor = self.get_connection().execute(
+            'SELECT item FROM items WHERE %s ORDER BY pk' % (
+                ' AND '.join(where)), params)
+        for row in cursor:
+            item = loads(row[0])
+            if key_condition is not None and \
+                    not evaluate(key_condition, item, names):
+                continue
+            n_scanned += 1
+            last_item = item
+            if filter_condition is None or \
+                    evaluate(filter_condition, item, names):
+                items.append(project(item, projection, names))
+            if n_scanned >= page_size:
+                break
+        else:
+            last_item = None
+        cursor.close()
+
+        response = {
+            'Items': items,
+            'Count': len(items),
+            'ScannedCount': n_scanned,
+        }
+        if last_item is not None:
+            response['LastEvaluatedKey'] = dict(
+                (name, last_item[name]) for name in self.key_names)
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        """ Same as boto3 Table.batch_writer().
+        """
+        return PMLSQLiteBatchWriter(self)
+
+
+class PMLSQLiteBatchWriter:
+    """ Project Mona Lisa SQLite Batch Writer class. The stand-in of the
+        boto3 batch writer of a PMLSQLiteTable: puts and deletes are
+        written in transactions of 25.
+    """
+
+    def __init__(self, table, flush_amount=25):
+        self.table = table
+        self.flush_amount = flush_amount
+        self.requests = []
+
+    def put_item(self, Item):
+        self.requests.append(('put', Item))
+        if len(self.requests) >= self.flush_amount:
+            self.flush()
+
+    def delete_item(self, Key):
+        self.requests.append(('delete', Key))
+        if len(self.requests) >= self.flush_amount:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered requests in one transaction.
+        """
+        connection = self.table.get_connection()
+        with transaction(connection):
+            for action, item in self.requests:
+                if action == 'put':
+                    self.table.store(connection, item)
+                else:
+                    connection.execute(
+                        'DELETE FROM items WHERE table_name = ? AND pk = ?',
+                        (self.table.name, self.table.get_pk(item)))
+        self.requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+
+class PMLSQLiteMeta:
+    """ The 'meta' attribute of a PMLSQLiteTable.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+
+class PMLSQLiteClient:
+    """ Project Mona Lisa SQLite Client class. The stand-in of the
+        low-level DynamoDB client, for batch_write_item(), and for the
+        global secondary indexes of update_table() and describe_table().
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # table name -> PMLSQLiteTable:
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def get_table(self, table_name):
+        """ Helper function. Gets the table <table_name>, with the key
+            it was created with.
+
+            Returns:
+                (PMLSQLiteTable)
+        """
+        with self.lock:
+            if table_name not in self.tables:
+                connection = connect(self.db_path)
+                row = connection.execute(
+                    'SELECT key_names FROM tables WHERE table_name = ?',
+                    (table_name,)).fetchone()
+                connection.close()
+                key_names = ('id',) if row is None else json.loads(row[0])
+                self.tables[table_name] = PMLSQLiteTable(
+                    self.db_path, table_name, key_names)
+            return self.tables[table_name]
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        """ Same as the boto3 client batch_write_item(), with items in
+            the format of the boto3 Table (not the low-level format).
+            All requests are processed.
+        """
+        for table_name, requests in RequestItems.items():
+            writer = PMLSQLiteBatchWriter(self.get_table(table_name))
+            for request in requests:
+                if 'PutRequest' in request:
+                    writer.put_item(request['PutRequest']['Item'])
+                else:
+                    writer.delete_item(request['DeleteRequest']['Key'])
+            writer.flush()
+        return {'UnprocessedItems': {}}
+
+    def update_table(self, TableName, GlobalSecondaryIndexUpdates=None,
+                     **kwargs):
+        """ Same as the boto3 client update_table(), for creating and
+            deleting global secondary indexes. The indexes are only
+            recorded: query() accepts any IndexName.
+        """
+        connection = connect(self.db_path)
+        with transaction(connection):
+            for update in GlobalSecondaryIndexUpdates or []:
+                if 'Create' in update:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO indexes '
+                        '(table_name, index_name) VALUES (?, ?)',
+                        (TableName, update['Create']['IndexName']))
+                elif 'Delete' in update:
+                    connection.execute(
+                        'DELETE FROM indexes '
+                        'WHERE table_name = ? AND index_name = ?',
+                        (TableName, update['Delete']['IndexName']))
+        connection.close()
+        return {}
+
+    def describe_table(self, TableName, **kwargs):
+        """ Same as the boto3 client describe_table(), with only the
+            names and status of the global secondary indexes.
+        """
+        connection = connect(self.db_path)
+        rows = connection.execute(
+            'SELECT index_name FROM indexes WHERE table_name = ? '
+            'ORDER BY index_name', (TableName,)).fetchall()
+        connection.close()
+        description = {'TableName': TableName}
+        if rows:
+            description['GlobalSecondaryIndexes'] = [
+                {'IndexName': row[0], 'IndexStatus': 'ACTIVE'}
+                for row in rows]
+        return {'Table': description}
+
+
+class transaction:
+    """ Context manager of a write transaction of a SQLite connection
+        in autocommit mode.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        # take the write lock first, so a conditional write can not
+        # interleave with another writer
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+
+def connect(db_path):
+    """ Opens a connection to the SQLite database at <db_path>, and
+        creates the schema if needed.
+
+        Returns:
+            (sqlite3.Connection)
+    """
+    connection = sqlite3.connect(db_path, timeout=30,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+    # readers do not block the writer, across processes
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS items ('
+        'table_name TEXT NOT NULL, pk TEXT NOT NULL, '
+        'hash INTEGER NOT NULL, item TEXT NOT NULL, '
+        'PRIMARY KEY (table_name, pk))')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS tables ('
+        'table_name TEXT PRIMARY KEY, key_names TEXT NOT NULL)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS indexes ('
+        'table_name TEXT NOT NULL, index_name TEXT NOT NULL, '
+        'PRIMARY KEY (table_name, index_name))')
+    for attr in INDEXED_ATTRS:
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS items_%s ON items '
+            '(table_name, json_extract(item, \'$."%s"\'))' % (attr, attr))
+    return connection
+
+
+def dumps(obj):
+    """ Serializes an item, or a list of key values, to json.
+    """
+    return json.dumps(obj, sort_keys=True, default=encode_default)
+
+
+def encode_default(obj):
+    """ Helper function of dumps(), for the types that json does not
+        know: Decimal and sets.
+    """
+    if isinstance(obj, Decimal):
+        if obj == obj.to_integral_value():
+            return int(obj)
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError('%r is not json serializable' % (obj,))
+
+
+def loads(item_json):
+    """ Deserializes an item, with numbers as Decimal like boto3.
+    """
+    return json.loads(item_json, parse_float=Decimal, parse_int=Decimal)
+
+
+def to_number(value):
+    """ Helper function. Converts ints and floats to Decimal, so values
+        compare and add like they do in DynamoDB.
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    return value
+
+
+def get_names(expression_names, names):
+    """ Helper function. Splits a ProjectionExpression or the names of
+        an UpdateExpression, resolving the #placeholders.
+    """
+    names = names or {}
+    return [names.get(name.strip(), name.strip())
+            for name in expression_names.split(',')]
+
+
+def project(item, projection, names=None):
+    """ Helper function.
+
+        Returns:
+            (dict): the attributes of <item> in the ProjectionExpression
+                <projection>, or all of them if it is None.
+    """
+    if projection is None:
+        return item
+    return dict((name, item[name])
+                for name in get_names(projection, names) if name in item)
+
+
+def parse_update(expression, names, values):
+    """ Helper function of PMLSQLiteTable.update_item(). Parses an
+        UpdateExpression.
+
+        Yields:
+            (tuple): (action ('SET', 'ADD' or 'REMOVE'), attribute (str),
+                value) of each update.
+    """
+    clauses = re.findall(
+        r'\b(SET|ADD|REMOVE)\s+(.*?)(?=\s+\b(?:SET|ADD|REMOVE)\s|\s*$)',
+        expression, re.IGNORECASE | re.DOTALL)
+    for action, body in clauses:
+        action = action.upper()
+        for update in body.split(','):
+            update = update.strip()
+            if action == 'SET':
+                attr, value = [part.strip() for part in update.split('=')]
+            elif action == 'ADD':
+                attr, value = update.split()
+            else:
+                attr, value = update, None
+            if value is not None:
+                if value not in values:
+                    raise NotImplementedError(
+                        'Only values like :value are supported in '
+                        'update expressions by the local backend')
+                value = to_number(values[value])
+            yield action, names.get(attr, attr), value
+
+
+def evaluate(condition, item, names=None):
+    """ Evaluates a boto3.dynamodb.conditions condition on an item.
+
+        Args:
+            condition (ConditionBase): e.g. Attr('created_at').gt(1000).
+            item (dict): the item.
+            names (dict): the ExpressionAttributeNames, not used by
+                condition objects. The default is None.
+
+        Returns:
+            (bool): True if <item> matches <condition>.
+    """
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    if operator == 'AND':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if operator == 'OR':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if operator == 'NOT':
+        return not evaluate(values[0], item)
+    if operator == 'attribute_exists':
+        return values[0].name in item
+    if operator == 'attribute_not_exists':
+        return values[0].name not in item
+
+    missing = object()
+    operands = []
+    for value in values:
+        if isinstance(value, AttributeBase):
+            value = item.get(value.name, missing)
+        elif isinstance(value, ConditionBase):
+            # e.g. Attr('x').size(), which is not supported
+            raise NotImplementedError(
+                '%s is not supported by the local backend' % (operator))
+        elif isinstance(value, (list, tuple)):
+            value = [to_number(v) for v in value]
+        else:
+            value = to_number(value)
+        if value is missing:
+            # comparisons with a missing attribute are false
+            return False
+        operands.append(value)
+
+    try:
+        if operator == '=':
+            return operands[0] == operands[1]
+        if operator == '<>':
+            return operands[0] != operands[1]
+        if operator == '<':
+            return operands[0] < operands[1]
+        if operator == '<=':
+            return operands[0] <= operands[1]
+        if operator == '>':
+            return operands[0] > operands[1]
+        if operator == '>=':
+            return operands[0] >= operands[1]
+        if operator == 'BETWEEN':
+            return operands[1] <= operands[0] <= operands[2]
+        if operator == 'IN':
+            return operands[0] in operands[1]
+        if operator == 'begins_with':
+            return operands[0].startswith(operands[1])
+        if operator == 'contains':
+            return operands[1] in operands[0]
+    except TypeError:
+        # values of different types never match, like in DynamoDB
+        return False
+    raise NotImplementedError(
+        '%s is not supported by the local backend' % (operator))
@@ -1,41 +1,91 @@
 # Copyright 2017 Novartis Institutes for BioMedical Research Inc. Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0. Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
 from __future__ import print_function
-import boto3
 from boto3.dynamodb.conditions import Key
-from random import randint
+from random import randint, uniform
+from concurrent.futures import ThreadPoolExecutor
 import os
 import base64
+import calendar
+import gzip
+import hashlib
+import json
+import threading
+import time
+from io import BytesIO
+
+from pml_backends import get_backend
+from pml_retry import RETRYABLE_ERROR_CODES, get_error_code, retry_call
+
+# key of the manifest of the shards written by PMLShardCompactor:
+SHARD_MANIFEST_KEY = 'manifest.json'
 
 
 class PMLStorage:
     """ Project Mona Lisa Storage class.
     """
 
-    def __init__(self, storage_name):
+    def __init__(self, storage_name, disk_cache=None):
+        """
+            Args:
+                storage_name (str): name of the storage.
+                disk_cache (PMLDiskCache): local disk cache of the
+                    objects read by get_item_from_storage(). The default
+                    is None, no disk cache.
+        """
         self.storage_name = storage_name
+        self.disk_cache = disk_cache
+        # the throughput of the last download_imgs(), or None:
+        self.download_stats = None
 
     def get_bucket(self):
         """
             Returns:
-                (obj): The boto3 AWS S3 bucket object.
+                (obj): The boto3 AWS S3 bucket object, or the bucket of
+                    the backend selected in pml_backends.
         """
-        s3 = boto3.resource('s3', region_name='TODO')
-        return s3.Bucket(self.storage_name)
+        return get_backend().get_bucket(self.storage_name)
 
-    def get_item_from_storage(self, item_key):
+    def get_item_from_storage(self, item_key, use_mmap=False):
         """ Get method for a image data in ML-PRJ image storage.
 
             Args:
-                bucket_name (str): name for the storage.
                 item_key (str): key or filename for the item in storage.
+                use_mmap (bool): if True, and there is a disk cache, a
+                    read-only memory map of the cached file is returned.
+                    The default is False.
+
+            Returns:
+                item (bytes or mmap)
+        """
+        if self.disk_cache is None:
+            return self.fetch_item(item_key)[0]
+        return self.disk_cache.get(
+            '%s/%s' % (self.storage_name, item_key),
+            lambda etag: self.fetch_item(item_key, etag),
+            use_mmap)
+
+    def fetch_item(self, item_key, etag=None):
+        """ Helper function for get_item_from_storage(). Gets the data of
+            <item_key> from S3, unless it still has the ETag <etag>.
 
             Returns:
-                item (obj)
+                (tuple): (data (bytes), ETag (str)), or None if the
+                    object still has the ETag <etag>.
         """
         # get the image data in the S3 bucket
         img_obj = self.get_bucket().Object(item_key)
-        return str(img_obj.get()['Body'].read())
+        try:
+            if etag is None:
+                response = img_obj.get()
+            else:
+                response = img_obj.get(IfNoneMatch='"%s"' % (etag))
+        except Exception as e:
+            if etag is not None and \
+                    get_error_code(e) in ('304', 'NotModified'):
+                return None
+            raise
+        return response['Body'].read(), response['ETag'].strip('"')
 
     def post_item_in_storage(self, key, body, type='png'):
         """ Posting collected image data in storage.
@@ -57,9 +107,18 @@ class PMLStorage:
         )
         return True
 
-    def download_imgs(self, load_fns, save_dir):
+    def download_imgs(self, load_fns, save_dir, max_workers=16,
+                      retries=3, verify=True, list_bucket=False):
         """ Downloads all files in <load_fns> from storage to
-            the directory <save_dir>.
+            the directory <save_dir>, with <max_workers> threads.
+
+            Each file is written to <filename>.part and renamed when it
+            is complete, and recorded in the manifest
+            <save_dir>/.manifest.jsonl with its ETag, so a download that
+            was interrupted is resumed by calling this method again:
+            the files in the manifest are skipped, and only the rest
+            are downloaded. Only the files in <load_fns> are requested,
+            so downloading a few new files takes a few requests.
 
             Args:
                 load_fns (list(str)): A list of strings of the filenames
@@ -68,22 +127,273 @@ class PMLStorage:
                     save the files. Formatted as:
                     /full/path/to/dir  ...  without a '/' character at
                     the end of the <save_dir>.
+                max_workers (int): the number of threads. The default
+                    is 16.
+                retries (int): the largest number of retries of a file.
+                    Files that are not in storage are not retried. The
+                    default is 3.
+                verify (bool): if True, the size and the MD5 of each
+                    downloaded file is checked against the ContentLength
+                    and the ETag of its GET response. The default is
+                    True.
+                list_bucket (bool): if True, the whole bucket is listed
+                    first, so the files in the manifest whose ETag
+                    changed are downloaded again, and the files that are
+                    not in storage are not requested. The default is
+                    False.
 
             Returns:
-                bool: True if successful, otherwise, an error will
-                be thrown.
+                bool: True if all files were downloaded, otherwise False.
+                    The throughput is printed and kept in
+                    <self.download_stats>.
         """
         print('downloading images from s3 . . .')
-        bucket = self.get_bucket()
-        pre_existing_fns = os.listdir(save_dir)
-        count = 0
-        for filename in load_fns:
-            count += 1
-            print(count)
-            if filename in pre_existing_fns:
+        start_time = time.time()
+        manifest_path = '%s/.manifest.jsonl' % (save_dir)
+        manifest = self.load_manifest(manifest_path)
+        pre_existing_fns = set(os.listdir(save_dir))
+
+        listing = None
+        if list_bucket:
+            listing = {}
+            for obj in self.list_objects():
+                listing[obj['key']] = obj
+
+        todo = []
+        for filename in set(load_fns):
+            if filename in pre_existing_fns and self.is_downloaded(
+                    '%s/%s' % (save_dir, filename),
+                    (listing or {}).get(filename),
+                    manifest.get(filename)):
                 continue
-            bucket.download_file(filename, save_dir + '/' + filename)
-        return True
+            todo.append(filename)
+        n_skipped = len(set(load_fns)) - len(todo)
+
+        stats_lock = threading.Lock()
+        stats = {'files': 0, 'bytes': 0, 'errors': {}, 'missing': []}
+
+        def download(filename):
+            if listing is not None and filename not in listing:
+                # a retry cannot find a file that is not in storage
+                with stats_lock:
+                    stats['missing'].append(filename)
+                return False
+            for attempt in range(retries + 1):
+                try:
+                    n_bytes, etag = self.download_file(
+                        filename, save_dir, verify)
+                    break
+                except Exception as e:
+                    missing = get_error_code(e) in ('NoSuchKey', '404')
+                    if missing or attempt == retries:
+                        with stats_lock:
+                            if missing:
+                                stats['missing'].append(filename)
+                            else:
+                                stats['errors'][filename] = str(e)
+                        return False
+                    time.sleep(uniform(0, min(5., 0.1 * 2 ** attempt)))
+            with stats_lock:
+                stats['files'] += 1
+                stats['bytes'] += n_bytes
+                with open(manifest_path, 'a') as manifest_file:
+                    manifest_file.write(json.dumps(
+                        {'key': filename, 'etag': etag}) + '\n')
+            return True
+
+        executor = ThreadPoolExecutor(max_workers)
+        try:
+            for _ in executor.map(download, todo):
+                pass
+        finally:
+            executor.shutdown(wait=True)
+
+        seconds = max(time.time() - start_time, 1e-9)
+        self.download_stats = {
+            'files': stats['files'],
+            'bytes': stats['bytes'],
+            'skipped': n_skipped,
+            'errors': stats['errors'],
+            'missing': sorted(stats['missing']),
+            'seconds': seconds,
+            'mb_per_second': stats['bytes'] / 1e6 / seconds,
+            'files_per_second': stats['files'] / seconds,
+        }
+        print('downloaded %d files (%.1f MB) in %.1f s: %.2f MB/s, '
+              '%.1f files/s, %d skipped, %d failed, %d not in storage' % (
+                  stats['files'], stats['bytes'] / 1e6, seconds,
+                  self.download_stats['mb_per_second'],
+                  self.download_stats['files_per_second'],
+                  n_skipped, len(stats['errors']), len(stats['missing'])))
+        for filename, error in sorted(stats['errors'].items()):
+            print('failed to download %s: %s' % (filename, error))
+        for filename in self.download_stats['missing']:
+            print('failed to download %s: not in storage' % (filename))
+        return len(stats['errors']) == 0 and len(stats['missing']) == 0
+
+    def download_file(self, filename, save_dir, verify=True):
+        """ Helper function for download_imgs(). Streams one file to
+            <save_dir>/<filename>.part and renames it to
+            <save_dir>/<filename> once it is complete and verified.
+
+            Args:
+                filename (str): the key of the file.
+                save_dir (str): as in download_imgs().
+                verify (bool): as in download_imgs().
+
+            Returns:
+                (tuple): (size of the file in bytes (int),
+                    ETag of the file (str))
+        """
+        save_path = '%s/%s' % (save_dir, filename)
+        part_path = '%s.part' % (save_path)
+        response = self.get_bucket().Object(filename).get()
+        body = response['Body']
+        md5 = hashlib.md5()
+        n_bytes = 0
+        with open(part_path, 'wb') as part_file:
+            while True:
+                chunk = body.read(1024 * 1024)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                part_file.write(chunk)
+                n_bytes += len(chunk)
+        etag = response['ETag'].strip('"')
+
+        if verify:
+            if n_bytes != response['ContentLength']:
+                raise IOError('%s has %d bytes instead of %d' % (
+                    filename, n_bytes, response['ContentLength']))
+            # multipart ETags (with a '-') are not the MD5 of the file
+            if '-' not in etag and md5.hexdigest() != etag:
+                raise IOError('%s does not match its ETag' % (filename))
+        os.rename(part_path, save_path)
+        return n_bytes, etag
+
+    def is_downloaded(self, save_path, listed, manifest_etag):
+        """ Helper function for download_imgs(). Checks if the existing
+            file at <save_path> is up to date: it has the ETag of the
+            listed file in the manifest, or, if it is not in the
+            manifest, it has the listed size. Files are only renamed to
+            <save_path> once complete, so a file that is not listed,
+            e.g. because the bucket was not listed, is assumed to be up
+            to date.
+
+            Returns:
+                (bool)
+        """
+        if listed is None:
+            return True
+        if manifest_etag is not None:
+            return manifest_etag == listed['etag']
+        return os.path.getsize(save_path) == listed['size']
+
+    def load_manifest(self, manifest_path):
+        """ Helper function for download_imgs().
+
+            Returns:
+                (dict): the ETag of each file in the manifest at
+                    <manifest_path>, or an empty dict if there is no
+                    manifest.
+        """
+        manifest = {}
+        if not os.path.isfile(manifest_path):
+            return manifest
+        with open(manifest_path) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted download
+                    continue
+                manifest[entry['key']] = entry['etag']
+        return manifest
+
+    def get_shard_manifest(self):
+        """ Gets the manifest of the shards written by
+            PMLShardCompactor to this storage.
+
+            Returns:
+                (dict): the manifest, formatted like:
+                {
+                    "shards": [
+                        {
+                            "shard": "<shard id>",
+                            "key": "shards/<shard id>.bin",
+                            "index_key": "shards/<shard id>.index.json.gz",
+                            "n_items": <count>,
+                            "bytes": <size of the shard>
+                        },
+                    ]
+                }
+                with no shards if nothing was compacted yet.
+        """
+        try:
+            data = self.get_bucket().Object(SHARD_MANIFEST_KEY)\
+                .get()['Body'].read()
+        except Exception as e:
+            if get_error_code(e) in ('NoSuchKey', '404'):
+                return {'shards': []}
+            raise
+        return json.loads(data.decode('utf-8'))
+
+    def get_shard_index(self, shard):
+        """ Gets the index of a shard.
+
+            Args:
+                shard (dict): the shard, as listed in the manifest.
+
+            Returns:
+                list(dict): the items in the shard, ordered by offset,
+                    each formatted like:
+                    {"id": "<id>", "label": "<label>",
+                     "offset": <bytes>, "length": <bytes>}
+        """
+        data = self.get_bucket().Object(shard['index_key'])\
+            .get()['Body'].read()
+        with gzip.GzipFile(fileobj=BytesIO(data)) as index_file:
+            return json.loads(index_file.read().decode('utf-8'))
+
+    def read_shard_item(self, shard, entry):
+        """ Reads one item of a shard with a range request.
+
+            Args:
+                shard (dict): the shard, as listed in the manifest.
+                entry (dict): the item, as listed in the shard index.
+
+            Returns:
+                (bytes): the image data of the item.
+        """
+        byte_range = 'bytes=%d-%d' % (
+            entry['offset'], entry['offset'] + entry['length'] - 1)
+        return self.get_bucket().Object(shard['key'])\
+            .get(Range=byte_range)['Body'].read()
+
+    def iter_shard(self, shard, index=None):
+        """ Streams a whole shard with a single request.
+
+            Args:
+                shard (dict): the shard, as listed in the manifest.
+                index (list(dict)): the shard index. The default is
+                    None, in which case it is read by get_shard_index().
+
+            Yields:
+                (tuple): (entry (dict), image data (bytes)) of each
+                    item, in the order of the shard.
+        """
+        if index is None:
+            index = self.get_shard_index(shard)
+        body = self.get_bucket().Object(shard['key']).get()['Body']
+        position = 0
+        for entry in sorted(index, key=lambda e: e['offset']):
+            if entry['offset'] > position:
+                body.read(entry['offset'] - position)
+            data = body.read(entry['length'])
+            if len(data) != entry['length']:
+                raise IOError('shard %s is truncated' % (shard['shard']))
+            position = entry['offset'] + entry['length']
+            yield entry, data
 
     def get_all_filenames(self):
         """ Gets all filenames in storage.
@@ -96,22 +406,105 @@ class PMLStorage:
         filenames = [obj.key for obj in iterobjs]
         return filenames
 
-    def remove_items(self, filenames):
-        """ Removes, from storage, all files from <filenames>.
+    def list_objects(self, prefix=''):
+        """ Lists the files in storage, one page of 1000 keys at a time.
 
             Args:
-                filenames list(str): List of filenames, where
-                each filename is a string, of the filename contained
-                in the bucket.
+                prefix (str): only list the keys starting with <prefix>.
+                    The default is '', all keys.
 
-            Returns:
-                bool: True if successful, otherwise an error is thrown.
+            Yields:
+                (dict): each file, formatted like:
+                {
+                    "key": "<filename>",
+                    "size": <bytes>,
+                    "etag": "<etag, without the quotes>",
+                    "last_modified": <seconds since the epoch>
+                }
         """
-        bucket = self.get_bucket()
-        fn_objects = [{'Key': fn} for fn in filenames]
-        bucket.delete_objects(
-            Delete={
-                'Objects': fn_objects
+        for obj in self.get_bucket().objects.filter(Prefix=prefix):
+            yield {
+                'key': obj.key,
+                'size': obj.size,
+                'etag': obj.e_tag.strip('"'),
+                'last_modified': calendar.timegm(
+                    obj.last_modified.utctimetuple()),
             }
-        )
-        return True
+
+    def remove_items(self, filenames, max_workers=4, retries=5):
+        """ Removes, from storage, all files from <filenames>. See
+            delete_items().
+
+            Returns:
+                bool: True if all files were deleted, otherwise False.
+        """
+        outcome = self.delete_items(filenames, max_workers=max_workers,
+                                    retries=retries)
+        print('%d files deleted from storage, %d failed' % (
+            len(outcome['deleted']), len(outcome['errors'])))
+        return len(outcome['errors']) == 0
+
+    def delete_items(self, filenames, max_workers=4, retries=5):
+        """ Bulk delete of the files <filenames>, in delete_objects
+            requests of 1000 keys (the S3 limit) sent by <max_workers>
+            threads. Throttled requests, and keys that failed with a
+            temporary error, are retried with exponential backoff.
+            Deleting a file that does not exist is not an error.
+
+            Args:
+                filenames (list(str)): the keys of the files.
+                max_workers (int): the number of threads. The default
+                    is 4.
+                retries (int): the largest number of retries of a
+                    request. The default is 5.
+
+            Returns:
+                (dict): the outcome of each key, formatted like:
+                {
+                    "deleted": [<key>, ...],
+                    "errors": {<key>: <error code: message>, ...}
+                }
+        """
+        chunks = [filenames[i:i + 1000]
+                  for i in range(0, len(filenames), 1000)]
+
+        def delete_chunk(chunk):
+            bucket = self.get_bucket()
+            deleted = []
+            errors = {}
+            pending = chunk
+            for attempt in range(retries + 1):
+                try:
+                    response = retry_call(
+                        lambda: bucket.delete_objects(Delete={
+                            'Objects': [{'Key': fn} for fn in pending],
+                            'Quiet': False,
+                        }),
+                        retries=retries)
+                except Exception as e:
+                    errors.update((fn, str(e)) for fn in pending)
+                    break
+                deleted.extend(obj['Key']
+                               for obj in response.get('Deleted', []))
+                pending = []
+                for error in response.get('Errors', []):
+                    if error.get('Code') in RETRYABLE_ERROR_CODES \
+                            and attempt < retries:
+                        pending.append(error['Key'])
+                    else:
+                        errors[error['Key']] = '%s: %s' % (
+                            error.get('Code'), error.get('Message'))
+                if not pending:
+                    break
+                time.sleep(uniform(0, min(5., 0.05 * 2 ** attempt)))
+            return deleted, errors
+
+        outcome = {'deleted': [], 'errors': {}}
+        executor = ThreadPoolExecutor(max_workers)
+        try:
+            for deleted, errors in executor.map(delete_chunk, chunks):
+                outcome['deleted'].extend(deleted)
+                outcome['errors'].update(errors)
+        finally:
+            executor.shutdown(wait=True)
+        return outcome